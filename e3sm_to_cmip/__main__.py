@@ -7,16 +7,29 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import numpy as np
 from e3sm_to_cmip.lib import run_serial
 from e3sm_to_cmip.lib import run_parallel
+from e3sm_to_cmip.lib import init_worker
 from e3sm_to_cmip.util import precheck
 from e3sm_to_cmip.util import print_debug
 from e3sm_to_cmip.util import copy_user_metadata
 from e3sm_to_cmip.util import add_metadata
+from e3sm_to_cmip.util import get_directory_index
+from e3sm_to_cmip.util import get_node_memory
+from e3sm_to_cmip.util import get_cpu_layout
+from e3sm_to_cmip.util import set_thread_limits
+from e3sm_to_cmip.util import configure_encoding
+from e3sm_to_cmip.util import load_checkpoint
+from e3sm_to_cmip.util import CHECKPOINT_NAME
 from e3sm_to_cmip.util import load_handlers
 from e3sm_to_cmip.util import print_var_info
 from e3sm_to_cmip.util import parse_arguments
 from e3sm_to_cmip.util import print_message
 from e3sm_to_cmip import resources
 from e3sm_to_cmip import cmor_handlers
+from e3sm_to_cmip.metrics import start_metrics
+from e3sm_to_cmip.metrics import stop_metrics
+from e3sm_to_cmip.profiling import configure_profiling
+from e3sm_to_cmip.profiling import format_summary
+from e3sm_to_cmip.profiling import write_report
 
 import os
 import sys
@@ -62,6 +75,48 @@ def main():
     simple = _args.get('simple', False)
     precheck_path = _args.get('precheck', False)
     freq = _args.get('freq')
+    chunk_size = _args.get('chunk_size')
+    output_format = _args.get('output_format')
+    max_memory = _args.get('max_memory_per_worker')
+    if max_memory:
+        max_memory = int(max_memory * 1024**3)
+    segment_years = _args.get('segment_years')
+    memory_budget = _args.get('memory_budget')
+    if memory_budget:
+        memory_budget = int(memory_budget * 1024**3)
+
+    # divide the cores between the workers, their dask threads and the BLAS
+    # threads, and limit the BLAS threads before any worker is started
+    cpu_layout = get_cpu_layout(
+        nproc,
+        cpu_budget=_args.get('cpu_budget'),
+        dask_threads=_args.get('dask_threads'),
+        serial=serial)
+    if not serial:
+        nproc = cpu_layout['processes']
+    set_thread_limits(cpu_layout['blas_threads'])
+
+    # the memory each worker can use, to size the dask chunks of the MPAS
+    # handlers from
+    worker_memory = max_memory
+    if not worker_memory:
+        worker_memory = memory_budget or get_node_memory()
+        if worker_memory and not serial:
+            worker_memory = worker_memory // nproc
+    dask_config = (
+        _args.get('dask_scheduler'),
+        cpu_layout['dask_threads'],
+        _args.get('dask_chunks'),
+        worker_memory)
+    encoding_config = (
+        _args.get('encoding'),
+        realm,
+        _args.get('deflate_level'))
+    timing_report = _args.get('timing_report')
+    profiling_config = (
+        bool(timing_report or _args.get('profile_dir')),
+        _args.get('profile_dir'))
+    configure_profiling(*profiling_config)
 
     if simple:
         no_metadata = True
@@ -80,8 +135,17 @@ def main():
         handlers_path, _ = os.path.split(
             os.path.abspath(cmor_handlers.__file__))
 
+    # index the input directory once, for all the handlers to share
+    if input_path and os.path.isdir(input_path):
+        get_directory_index(input_path, cache_path=_args.get('index_cache'))
+
     if precheck_path:
-        new_var_list = precheck(input_path, precheck_path, var_list, realm)
+        new_var_list = precheck(
+            input_path,
+            precheck_path,
+            var_list,
+            realm,
+            manifest_path=_args.get('precheck_manifest'))
         if not new_var_list:
             print("All variables previously computed")
             os.mkdir(os.path.join(output_path, 'CMIP6'))
@@ -143,14 +207,39 @@ def main():
         filemode='w',
         level=logging.INFO)
 
+    # the checkpoint journal of an interrupted run is only used with --resume
+    checkpoint = None
+    if _args.get('resume'):
+        checkpoint = load_checkpoint(output_path)
+    else:
+        journal_path = os.path.join(output_path, CHECKPOINT_NAME)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
     # copy the users metadata json file with the updated output directory
     if not simple:
         copy_user_metadata(
             user_metadata, output_path)
 
+    print_message(
+        f"Using {cpu_layout['cores']} cores: {cpu_layout['processes']} worker process(es), "
+        f"{cpu_layout['dask_threads']} dask thread(s) per worker, "
+        f"{cpu_layout['blas_threads']} BLAS thread(s) per dask thread", 'ok')
+
+    # report the progress of the run to the status file and the metrics endpoint
+    progress_queue = start_metrics(
+        status_path=_args.get('status_file'),
+        interval=_args.get('status_interval'),
+        port=_args.get('metrics_port'),
+        parallel=not serial)
+
     # run in the user-selected mode
     if serial:
         print_message('Running CMOR handlers in serial', 'ok')
+        # the mpas module pulls in dask, so it's only imported for the runs that use it
+        from e3sm_to_cmip.mpas import configure_dask
+        configure_dask(*dask_config)
+        configure_encoding(*encoding_config)
         try:
             status = run_serial(
                 handlers=handlers,
@@ -162,17 +251,27 @@ def main():
                 logdir=cmor_log_dir,
                 simple=simple,
                 outpath=output_path,
-                freq=freq)
+                freq=freq,
+                chunk_size=chunk_size,
+                max_memory=max_memory,
+                checkpoint=checkpoint,
+                output_format=output_format)
         except KeyboardInterrupt as error:
             print_message(' -- keyboard interrupt -- ', 'error')
+            stop_metrics()
             return 1
         except Exception as e:
             print_debug(e)
+            stop_metrics()
             return 1
     else:
         print_message('Running CMOR handlers in parallel', 'ok')
         try:
-            pool = Pool(max_workers=nproc)
+            pool = Pool(
+                max_workers=nproc,
+                initializer=init_worker,
+                initargs=(cpu_layout['blas_threads'], dask_config, encoding_config,
+                          profiling_config, (progress_queue,)))
             status = run_parallel(
                 pool=pool,
                 handlers=handlers,
@@ -181,16 +280,33 @@ def main():
                 metadata_path=new_metadata_path,
                 map_path=map_path,
                 realm=realm,
+                nproc=nproc,
+                memory_budget=memory_budget,
+                segment_years=segment_years,
                 logdir=cmor_log_dir,
                 simple=simple,
                 outpath=output_path,
-                freq=freq)
+                freq=freq,
+                chunk_size=chunk_size,
+                max_memory=max_memory,
+                checkpoint=checkpoint,
+                output_format=output_format)
         except KeyboardInterrupt as error:
             print_message(' -- keyboard interrupt -- ', 'error')
+            stop_metrics()
             return 1
         except Exception as error:
             print_debug(error)
+            stop_metrics()
             return 1
+    stop_metrics()
+
+    if profiling_config[0]:
+        print(format_summary())
+        if timing_report:
+            write_report(timing_report)
+            print_message(f'Wrote the stage timings to {timing_report}', 'ok')
+
     if status != 0:
         print_message(
             f"Error running handlers: { ' '.join([x['name'] for x in handlers]) }")
@@ -200,7 +316,8 @@ def main():
         add_metadata(
             file_path=output_path,
             var_list=var_list,
-            metadata=custom_metadata)
+            metadata_path=custom_metadata,
+            nproc=1 if serial else nproc)
 
     if timeout:
         timer.cancel()
@@ -35,7 +35,7 @@ def write_data(varid, data, timeval, timebnds, index, **kwargs):
         time_bnds=timebnds)
     cmor.write(
         data['ips'],
-        data['ps'],
+        data['ps'][index, :],
         time_vals=timeval,
         time_bnds=timebnds,
         store_with=varid)
@@ -68,5 +68,8 @@ def handle(infiles, tables, user_input_path, **kwargs):
         levels=LEVELS,
         logdir=kwargs.get('logdir'),
         simple=kwargs.get('simple'),
-        outpath=kwargs.get('outpath'))
+        chunk_size=kwargs.get('chunk_size'),
+        max_memory=kwargs.get('max_memory'),
+        outpath=kwargs.get('outpath'),
+        output_format=kwargs.get('output_format', 'netcdf'))
 # ------------------------------------------------------------------
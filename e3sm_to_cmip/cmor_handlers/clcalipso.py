@@ -59,5 +59,8 @@ def handle(infiles, tables, user_input_path, **kwargs):
         levels=LEVELS,
         logdir=kwargs.get('logdir'),
         simple=kwargs.get('simple'),
-        outpath=kwargs.get('outpath'))
+        chunk_size=kwargs.get('chunk_size'),
+        max_memory=kwargs.get('max_memory'),
+        outpath=kwargs.get('outpath'),
+        output_format=kwargs.get('output_format', 'netcdf'))
 # ------------------------------------------------------------------
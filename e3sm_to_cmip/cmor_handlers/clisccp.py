@@ -2,8 +2,10 @@
 FISCCP1_COSP to clisccp converter
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
-from e3sm_to_cmip.util import setup_cmor
+from e3sm_to_cmip.util import estimate_cmor_definitions
+from e3sm_to_cmip.util import setup_cmor_session
 from e3sm_to_cmip.util import print_message
+from e3sm_to_cmip.util import set_cmor_deflate
 from tqdm import tqdm
 
 import cmor
@@ -64,22 +66,12 @@ def handle(infiles, tables, user_input_path, **kwargs):
     msg = f'{VAR_NAME}: running with input files: {infiles}'
     logger.debug(msg)
 
-    # setup cmor    
-    logdir = kwargs.get('logdir')
-    if logdir:
-        logfile = logfile = os.path.join(logdir, VAR_NAME + '.log')
-    else:
-        logfile = os.path.join(os.getcwd(), 'logs')
-        if not os.path.exists(logfile):
-            os.makedirs(logfile)
-        logfile = os.path.join(logfile, VAR_NAME + '.log')
-
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-    cmor.dataset_json(user_input_path)
-    cmor.load_table(TABLE)
+    # setup cmor, reusing the CMOR session and tables of this process
+    logdir = kwargs.get('logdir') or os.path.join(os.getcwd(), 'logs')
+    num_axes, num_variables = estimate_cmor_definitions(
+        tables, TABLE, VAR_NAME, len(infiles['FISCCP1_COSP']))
+    setup_cmor_session(tables, user_input_path, TABLE, logdir,
+                       num_axes=num_axes, num_variables=num_variables)
 
     msg = f'{VAR_NAME}: CMOR setup complete'
     logger.info(msg)
@@ -148,6 +140,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
             axis_ids.append(axis_id)
 
         varid = cmor.variable(VAR_NAME, VAR_UNITS, axis_ids)
+        set_cmor_deflate(varid, VAR_NAME)
 
        # write out the data
         msg = f"{VAR_NAME}: time {data['time_bnds'][0][0]:1.1f} - {data['time_bnds'][-1][-1]:1.1f}"
@@ -169,11 +162,10 @@ def handle(infiles, tables, user_input_path, **kwargs):
         if serial:
             pbar.close()
 
-    msg = f'{VAR_NAME}: write complete, closing'
-    logger.info(msg)
+        # close the output for this input file, keeping the CMOR session open
+        cmor.close(varid)
 
-    cmor.close()
-    msg = f'{VAR_NAME}: file close complete'
+    msg = f'{VAR_NAME}: write complete'
     logger.info(msg)
 
     return VAR_NAME
@@ -6,11 +6,11 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import cmor
 import os
 import logging
-import json
 import xarray as xr
 import numpy as np
 from e3sm_to_cmip import resources
-from e3sm_to_cmip.util import print_message
+from e3sm_to_cmip.util import (print_message, get_table_info, get_encoding_profile,
+                               set_cmor_deflate, setup_cmor_session)
 from e3sm_to_cmip.lib import handle_variables
 from e3sm_to_cmip.mpas import write_netcdf
 
@@ -23,9 +23,7 @@ GRAV = 9.80616
 
 def handle_simple(infiles):
     resource_path, _ = os.path.split(os.path.abspath(resources.__file__))
-    table_path = os.path.join(resource_path, TABLE)
-    with open(table_path, 'r') as ip:
-        table_data = json.load(ip)
+    table_data = get_table_info(resource_path, TABLE)
     
     ds = xr.Dataset()
     outname = f'{VAR_NAME}_fx_.nc'
@@ -48,7 +46,8 @@ def handle_simple(infiles):
         np.dtype('float32'): 1e20,
         np.dtype('float64'): 1e20,
     }
-    write_netcdf(ds, outname, fillValues=fillVals, unlimited=['time'])
+    write_netcdf(ds, outname, fillValues=fillVals, unlimited=['time'],
+                 profiles={VAR_NAME: get_encoding_profile(VAR_NAME)})
 
 
 def handle(infiles, tables, user_input_path, **kwargs):
@@ -75,23 +74,14 @@ def handle(infiles, tables, user_input_path, **kwargs):
         handle_simple(infiles)
         return VAR_NAME
 
-    # Create the logging directory and setup cmor
+    # setup cmor, reusing the CMOR session and tables of this process
     if logdir:
         logpath = logdir
     else:
         outpath, _ = os.path.split(logger.__dict__['handlers'][0].baseFilename)
         logpath = os.path.join(outpath, 'cmor_logs')
-    os.makedirs(logpath, exist_ok=True)
 
-    logfile = os.path.join(logpath, VAR_NAME + '.log')
-
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-
-    cmor.dataset_json(str(user_input_path))
-    cmor.load_table(str(TABLE))
+    setup_cmor_session(tables, user_input_path, TABLE, logpath)
 
     msg = '{}: CMOR setup complete'.format(VAR_NAME)
     logging.info(msg)
@@ -143,6 +133,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
         axis_ids.append(axis_id)
 
     varid = cmor.variable(VAR_NAME, VAR_UNITS, axis_ids)
+    set_cmor_deflate(varid, VAR_NAME)
 
     outdata = data['PHIS'].values / GRAV
     cmor.write(
@@ -152,7 +143,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
     msg = '{}: write complete, closing'.format(VAR_NAME)
     logger.debug(msg)
 
-    cmor.close()
+    cmor.close(varid)
 
     msg = '{}: file close complete'.format(VAR_NAME)
     logger.debug(msg)
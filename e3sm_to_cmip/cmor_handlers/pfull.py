@@ -7,7 +7,8 @@ import cmor
 import logging
 import os
 from tqdm import tqdm
-from e3sm_to_cmip.util import print_message
+from e3sm_to_cmip.util import (estimate_cmor_definitions, print_message,
+                               set_cmor_deflate, setup_cmor_session)
 
 try:
     import cdms2
@@ -73,24 +74,18 @@ def handle(infiles, tables, user_input_path, **kwargs):
     if zerofiles:
         return None
 
-    # Create the logging directory and setup cmor
+    # setup cmor, reusing the CMOR session and tables of this process
     logdir = kwargs.get('logdir')
     if logdir:
         logpath = logdir
     else:
         outpath, _ = os.path.split(logger.__dict__['handlers'][0].baseFilename)
         logpath = os.path.join(outpath, 'cmor_logs')
-    os.makedirs(logpath, exist_ok=True)
 
-    logfile = os.path.join(logpath, VAR_NAME + '.log')
-
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-
-    cmor.dataset_json(str(user_input_path))
-    cmor.load_table(str(TABLE))
+    num_axes, num_variables = estimate_cmor_definitions(
+        tables, TABLE, VAR_NAME, len(infiles[RAW_VARIABLES[0]]), num_zfactors=4)
+    setup_cmor_session(tables, user_input_path, TABLE, logpath,
+                       num_axes=num_axes, num_variables=num_variables)
 
     msg = '{}: CMOR setup complete'.format(VAR_NAME)
     logging.info(msg)
@@ -214,6 +209,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
         data['ips'] = ips
 
         varid = cmor.variable(VAR_NAME, VAR_UNITS, axis_ids[:4])
+        set_cmor_deflate(varid, VAR_NAME)
 
         # write out the data
         msg = "{}: time {:1.1f} - {:1.1f}".format(
@@ -238,12 +234,10 @@ def handle(infiles, tables, user_input_path, **kwargs):
         if serial:
             pbar.close()
 
-    msg = '{}: write complete, closing'.format(VAR_NAME)
-    logger.debug(msg)
-
-    cmor.close()
+        # close the output for this input file, keeping the CMOR session open
+        cmor.close(varid)
 
-    msg = '{}: file close complete'.format(VAR_NAME)
+    msg = '{}: write complete'.format(VAR_NAME)
     logger.debug(msg)
 
     return 'pfull'
@@ -74,10 +74,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
 
     # the result above is just a mask of area fraction.  We need to multiply
     # by the area on the output grid
-    dsMap = xarray.open_dataset(mappingFileName)
-    area_b = dsMap.area_b.values
-    dst_grid_dims = dsMap.dst_grid_dims.values
-    area_b = area_b.reshape((dst_grid_dims[1], dst_grid_dims[0]))
+    area_b = mpas.get_mapping_weights(mappingFileName)['area']
     area_b = xarray.DataArray(data=area_b, dims=('lat', 'lon'),
                               coords=(ds.coords['lat'], ds.coords['lon']))
 
@@ -1,53 +1,88 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 from e3sm_to_cmip.lib import handle_variables
-import cmor
+from e3sm_to_cmip.profiling import stage
+from e3sm_to_cmip.util import get_unit_conversions
 import numpy as np
 
+def compile_unit_conversion(unit_conversion=None, fill_value=1.e20):
+    """
+    Returns a function that applies a unit conversion from resources/unit_conversions.yaml
+    to a whole window of time steps, and sets its missing values to the fill value.
+
+    Floating point windows are converted in place, with each step of the conversion a
+    single ufunc call over the window, so the window array must be private to the
+    caller. Integer windows can't hold the converted values or the fill value, so they
+    are converted into a float64 copy instead. The missing values are filled one time
+    step at a time, so the NaN mask is only ever the size of a single step.
+
+    Params:
+    -------
+        unit_conversion (str): the name of the conversion, or None to only set the missing values
+        fill_value (float): the value for missing data
+    Returns:
+    --------
+        convert (function): takes an array and returns the converted array, which is the
+            same array for writable floating point inputs, otherwise a float64 copy
+    """
+    if unit_conversion is None:
+        conversion = dict()
+    else:
+        conversions = get_unit_conversions()
+        if unit_conversion not in conversions:
+            raise ValueError(
+                f"{unit_conversion} isn't a supported unit conversion for default variables")
+        conversion = conversions[unit_conversion]
+
+    # sign * (data * scale / divisor + offset), with the sign folded into the scale and offset
+    sign = conversion.get('sign', 1)
+    steps = [(np.multiply, sign * conversion.get('scale', 1)),
+             (np.true_divide, conversion.get('divisor', 1)),
+             (np.add, sign * conversion.get('offset', 0))]
+    steps = [(ufunc, operand) for ufunc, operand in steps
+             if operand != (0 if ufunc is np.add else 1)]
+
+    def convert(values):
+        values = np.asarray(values)
+        if not np.issubdtype(values.dtype, np.floating):
+            values = values.astype(np.float64)
+        elif not values.flags.writeable:
+            values = values.copy()
+
+        for ufunc, operand in steps:
+            ufunc(values, operand, out=values)
+
+        for step in np.atleast_2d(values):
+            np.copyto(step, fill_value, where=np.isnan(step))
+        return values
+
+    return convert
+# ------------------------------------------------------------------
+
 
 def default_handler(infiles, tables, user_input_path, **kwargs):
 
     RAW_VARIABLES = kwargs['raw_variables']
-    unit_conversion = kwargs.get('unit_conversion')
+    convert = compile_unit_conversion(kwargs.get('unit_conversion'))
 
     def write_data(varid, data, timeval=None, timebnds=None, index=None, **kwargs):
+        import cmor
+
+        # the window of time steps is converted in place when its first time step is
+        # written, and marked so the rest of its time steps are only indexed
+        if not data.get('converted'):
+            with stage('convert'):
+                data[RAW_VARIABLES[0]] = convert(data[RAW_VARIABLES[0]])
+                data['converted'] = True
 
         if timeval is not None:
-            if unit_conversion is not None:
-                if unit_conversion == 'g-to-kg':
-                    outdata = data[RAW_VARIABLES[0]].values[index, :] / 1000.0
-                elif unit_conversion == '1-to-%':
-                    outdata = data[RAW_VARIABLES[0]].values[index, :] * 100.0
-                elif unit_conversion == 'm/s-to-kg/ms':
-                    outdata = data[RAW_VARIABLES[0]].values[index, :] * 1000
-                elif unit_conversion == '-1':
-                    outdata = data[RAW_VARIABLES[0]].values[index, :] * -1
-                else:
-                    raise ValueError(
-                        f"{unit_conversion} isn't a supported unit conversion for default variables")
-            else:
-                outdata = data[RAW_VARIABLES[0]].values[index, :]
+            outdata = data[RAW_VARIABLES[0]][index, :]
         else:
-            if unit_conversion is not None:
-                if unit_conversion == 'g-to-kg':
-                    outdata = data[RAW_VARIABLES[0]].values / 1000.0
-                elif unit_conversion == '1-to-%':
-                    outdata = data[RAW_VARIABLES[0]].values * 100.0
-                elif unit_conversion == 'm/s-to-kg/ms':
-                    outdata = data[RAW_VARIABLES[0]].values * 1000
-                elif unit_conversion == '-1':
-                    outdata = data[RAW_VARIABLES[0]].values * -1
-                else:
-                    raise ValueError(
-                        f"{unit_conversion} isn't a supported unit conversion for default variables")
-            else:
-                outdata = data[RAW_VARIABLES[0]].values
-
-        outdata[np.isnan(outdata)] = 1.e20 
+            outdata = data[RAW_VARIABLES[0]]
 
         if kwargs.get('simple'):
             return outdata
 
-        if timeval:
+        if timeval is not None:
             cmor.write(
                 varid,
                 outdata,
@@ -71,5 +106,8 @@ def default_handler(infiles, tables, user_input_path, **kwargs):
         positive=kwargs.get('positive'),
         logdir=kwargs.get('logdir'),
         simple=kwargs.get('simple'),
-        outpath=kwargs.get('outpath'))
+        chunk_size=kwargs.get('chunk_size'),
+        max_memory=kwargs.get('max_memory'),
+        outpath=kwargs.get('outpath'),
+        output_format=kwargs.get('output_format', 'netcdf'))
 # ------------------------------------------------------------------
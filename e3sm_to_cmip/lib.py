@@ -1,25 +1,78 @@
-import json
 import logging
+import multiprocessing.util
 import os
+from concurrent.futures import FIRST_COMPLETED, wait
 
-import cmor
 import numpy as np
-import xarray as xr
 from tqdm import tqdm
 
 from e3sm_to_cmip import resources
-from e3sm_to_cmip.mpas import write_netcdf
-from e3sm_to_cmip.util import (find_atm_files, find_mpas_files,
-                               get_levgrnd_bnds, print_debug, print_message,
+from e3sm_to_cmip.metrics import (configure_metrics, job_finished, job_queued,
+                                  job_started, report_progress)
+from e3sm_to_cmip.profiling import (add_records, configure_profiling,
+                                    run_profiled, stage)
+from e3sm_to_cmip.util import (apply_checkpoint, configure_encoding, end_cmor_session,
+                               estimate_cmor_definitions, find_atm_files,
+                               find_mpas_files, get_atm_file_years, get_directory_index,
+                               get_encoding_profile, get_levgrnd_bnds, get_node_memory,
+                               get_table_info, get_variable_dimensions,
+                               print_debug, print_message, record_checkpoint,
+                               set_cmor_deflate, set_thread_limits, setup_cmor_session,
                                terminate)
 
 logger = logging.getLogger()
 
+# reading a window of time steps holds the raw variables and their decoded
+# copy, and a handler may hold one more copy while converting the window, so
+# the per-step input size is scaled by this factor when sizing windows to fit
+# in --max-memory-per-worker. Only one window is held at a time
+WINDOW_MEMORY_FACTOR = 3
+
+# the MPAS handlers hold a chunk of the input field, the masked copy and the
+# remapped output at the same time, so the size of the chunk is scaled by
+# this factor when estimating their memory
+MPAS_MEMORY_FACTOR = 3
+
+# the time steps in a year of each frequency, to estimate the number of time
+# steps a handler writes from the years of its input files
+STEPS_PER_YEAR = {
+    'mon': 12,
+    'day': 365,
+    '6hrLev': 1460,
+    '6hrPlev': 1460,
+    '6hrPlevPt': 1460,
+    '3hr': 2920,
+    '1hr': 8760,
+}
+
+# the attributes of the CMIP6 table entry copied onto the variable in simple mode
+SIMPLE_VARIABLE_ATTRS = ['standard_name', 'long_name',
+                         'comment', 'cell_methods', 'cell_measures', 'units']
+
+# the fill values of the simple mode outputs
+SIMPLE_FILL_VALUES = {
+    np.dtype('float32'): 1e20,
+    np.dtype('float64'): 1e20,
+}
+
 
 def run_parallel(pool, handlers, input_path, tables_path, metadata_path,
-                 map_path=None, realm='atm', nproc=6, **kwargs):
+                 map_path=None, realm='atm', nproc=6, memory_budget=None,
+                 segment_years=None, checkpoint=None, **kwargs):
     """
     Run all the handlers in parallel
+
+    The handlers are submitted largest first, using the estimated memory
+    footprint of each handler as a proxy for its run time. A handler is only
+    submitted while the total estimated memory of the running handlers stays
+    under the memory budget, with the exception that a handler that is larger
+    than the whole budget is run once nothing else is running.
+
+    If segment_years is set, each atm or lnd handler is split into segments of
+    input files covering segment_years years, and each segment is run as a
+    separate job. These handlers already write one CMIP file per input file, so
+    the output is the same as running the whole variable in one job.
+
     Params:
     -------
         pool (multiprocessing.Pool): a processing pool to run the handlers in
@@ -28,85 +81,377 @@ def run_parallel(pool, handlers, input_path, tables_path, metadata_path,
         tables_path (str): path to the tables directory
         metadata_path (str): path to the cmor input metadata
         realm (str): the realm of the data, [atm, lnd, mpaso, mpassi]
+        nproc (int): the number of worker processes in the pool
+        memory_budget (int): the memory in bytes available to the pool, defaults
+            to the physical memory of the node
+        segment_years (int): the number of years of input files to run in each job
+        checkpoint (dict): the committed work of a previous run to skip, as returned by load_checkpoint
+        chunk_size (int): number of time steps to pass to each cmor.write call
+        max_memory (int): memory budget in bytes for the input data of each handler
+        output_format (str): the format of the simple mode outputs, netcdf or zarr
     Returns:
     --------
         returns 1 if an error occurs, else 0
     """
 
-    pool_res = list()
-    will_run = []
-    for idx, handler in enumerate(handlers):
-        handler_method = handler['method']
+    jobs = list()
+    for handler in handlers:
         handler_variables = handler['raw_variables']
         # find the input files this handler needs
-        if realm in ['atm', 'lnd']:
+        with stage('discover', handler=handler['name']):
+            if realm in ['atm', 'lnd']:
 
-            input_paths = {var: [os.path.join(input_path, x) for x in
-                                 find_atm_files(var, input_path)]
-                           for var in handler_variables}
-        elif realm == 'fx':
-                input_paths = {var: [os.path.join(input_path, x) for x in os.listdir(input_path) if x[-3:] == '.nc']
+                input_paths = {var: [os.path.join(input_path, x) for x in
+                                     find_atm_files(var, input_path)]
+                               for var in handler_variables}
+            elif realm == 'fx':
+                    input_paths = {var: [os.path.join(input_path, x) for x in get_directory_index(input_path)['files'] if x[-3:] == '.nc']
+                                   for var in handler_variables}
+            else:
+                input_paths = {var: find_mpas_files(var, input_path,
+                                                    map_path)
                                for var in handler_variables}
-        else:
-            input_paths = {var: find_mpas_files(var, input_path,
-                                                map_path)
-                           for var in handler_variables}
-
-        # setup the input args for the handler
-        _kwargs = {
-            'table': handler.get('table'),
-            'raw_variables': handler.get('raw_variables'),
-            'units': handler.get('units'),
-            'positive': handler.get('positive'),
-            'name': handler.get('name'),
-            'logdir': kwargs.get('logdir'),
-            'unit_conversion': handler.get('unit_conversion'),
-            'simple': kwargs.get('simple'),
-            'outpath': kwargs.get('outpath')
-        }
-        will_run.append(handler.get('name'))
 
-        pool_res.append(
-            pool.submit(
-                handler_method,
-                input_paths,
+        if checkpoint is not None:
+            input_paths = apply_checkpoint(checkpoint, handler, input_paths, realm)
+            if input_paths is None:
+                print_message(f"{handler['name']} was completed by a previous run", 'ok')
+                continue
+
+        # the atm and lnd handlers that run through handle_variables write a
+        # CMIP file per input file, so each time varying variable can be split
+        # into segments of input files that run on separate workers without
+        # changing the output. The fx handlers write a single file
+        if segment_years and realm in ['atm', 'lnd'] and not kwargs.get('simple') \
+                and handler.get('uses_handle_variables') \
+                and var_has_time(os.path.join(tables_path, handler['table']), handler['name']):
+            segments = split_input_paths(
+                input_paths, handler_variables, segment_years)
+        else:
+            segments = [(None, input_paths)]
+
+        for years, segment_paths in segments:
+
+            # setup the input args for the handler
+            _kwargs = {
+                'table': handler.get('table'),
+                'raw_variables': handler.get('raw_variables'),
+                'units': handler.get('units'),
+                'positive': handler.get('positive'),
+                'name': handler.get('name'),
+                'logdir': kwargs.get('logdir'),
+                'unit_conversion': handler.get('unit_conversion'),
+                'simple': kwargs.get('simple'),
+                'outpath': kwargs.get('outpath'),
+                'chunk_size': kwargs.get('chunk_size'),
+                'max_memory': kwargs.get('max_memory'),
+                'output_format': kwargs.get('output_format', 'netcdf')
+            }
+            label = handler['name']
+            if years is not None:
+                label = f"{handler['name']} {years[0]:04d}-{years[1]:04d}"
+                # keep the CMOR logs of each segment apart
+                if kwargs.get('logdir'):
+                    _kwargs['logdir'] = os.path.join(
+                        kwargs['logdir'], f"{years[0]:04d}-{years[1]:04d}")
+
+            memory = estimate_handler_memory(
+                handler=handler,
+                input_paths=segment_paths,
+                tables_path=tables_path,
+                realm=realm,
+                max_memory=kwargs.get('max_memory'))
+            logger.info(f"{label}: estimated memory {memory / 1024**3:.2f} GB")
+
+            jobs.append({
+                'handler': handler,
+                'label': label,
+                'input_paths': segment_paths,
+                'kwargs': _kwargs,
+                'memory': memory,
+                'segment': years is not None
+            })
+            job_queued(
+                label,
+                handler['name'],
+                expected_steps=estimate_time_steps(
+                    segment_paths, handler_variables, realm, kwargs.get('freq')))
+
+    # longest processing time first
+    jobs.sort(key=lambda job: job['memory'], reverse=True)
+
+    if memory_budget is None:
+        memory_budget = get_node_memory()
+
+    pbar = tqdm(total=len(jobs))
+    num_success = 0
+    num_finished = 0
+    num_handlers = len(jobs)
+    failed = []
+    pending = list(jobs)
+    running = dict()
+    used_memory = 0
+    while pending or running:
+
+        # admit the largest pending handlers while they fit in the remaining
+        # memory, stopping at the first that doesn't so it isn't passed over
+        # by the smaller handlers behind it
+        while pending and len(running) < nproc:
+            job = pending[0]
+            if running and memory_budget and used_memory + job['memory'] > memory_budget:
+                break
+            pending.pop(0)
+            used_memory += job['memory']
+            future = pool.submit(
+                run_profiled,
+                job['label'],
+                job['handler']['method'],
+                job['input_paths'],
                 tables_path,
                 metadata_path,
-                **_kwargs))
-
-    # wait for each result to complete
-    pbar = tqdm(total=len(pool_res))
-    num_success = 0
-    num_handlers = len(handlers)
-    finished_success = []
-    for idx, res in enumerate(pool_res):
-        try:
-            out = res.result()
-            finished_success.append(out)
-            if out:
-                num_success += 1
-                msg = f'Finished {out}, {idx + 1}/{num_handlers} jobs complete'
-            else:
-                msg = f'Error running handler {handlers[idx]["name"]}'
-                print_message(msg, 'error')
+                **job['kwargs'])
+            running[future] = job
+            job_started(job['label'])
+
+        # wait for a running handler to complete
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for res in done:
+            job = running.pop(res)
+            used_memory -= job['memory']
+            num_finished += 1
+            try:
+                # the stage timings of the handler come back with its result
+                out, records = res.result()
+                add_records(records)
+                job_finished(job['label'], success=bool(out))
+                if out:
+                    num_success += 1
+                    msg = f'Finished {job["label"]}, {num_finished}/{num_handlers} jobs complete'
+                    # segments commit their input files as they go
+                    if kwargs.get('outpath') and not job['segment']:
+                        record_checkpoint(
+                            kwargs['outpath'], job['handler']['name'], job['handler']['table'])
+                else:
+                    failed.append(job['label'])
+                    msg = f'Error running handler {job["label"]}'
+                    print_message(msg, 'error')
 
-            logger.info(msg)
-        except Exception as e:
-            print_debug(e)
-        pbar.update(1)
+                logger.info(msg)
+            except Exception as e:
+                failed.append(job['label'])
+                job_finished(job['label'], success=False)
+                print_debug(e)
+            pbar.update(1)
 
     pbar.close()
     terminate(pool)
     print_message(f"{num_success} of {num_handlers} handlers complete", 'ok')
-    failed = set(will_run) - set(finished_success)
     if failed:
-        print_message(f"{', '.join(list(failed))} failed to complete")
+        print_message(f"{', '.join(failed)} failed to complete")
+        return 1
     return 0
 # ------------------------------------------------------------------
 
 
+def split_input_paths(input_paths, raw_variables, segment_years):
+    """
+    Splits the input files of an atm or lnd handler into segments of
+    consecutive input files, starting a new segment every segment_years years.
+
+    Params:
+    -------
+        input_paths (dict): the input files for each of the handlers raw variables
+        raw_variables (list(str)): the raw variables of the handler
+        segment_years (int): the number of years in each segment
+    Returns:
+    --------
+        a list of ((start_year, end_year), input_paths) tuples, one per segment
+    """
+    sorted_paths = {var: sorted(input_paths[var]) for var in raw_variables}
+    num_files = len(sorted_paths[raw_variables[0]])
+    if num_files == 0 or any(len(paths) != num_files for paths in sorted_paths.values()):
+        # let the handler report the missing or mismatched files
+        return [(None, input_paths)]
+
+    segments = list()
+    first_year = None
+    for index, path in enumerate(sorted_paths[raw_variables[0]]):
+        start, end = get_atm_file_years(raw_variables[0], path)
+        if first_year is None:
+            first_year = start
+        key = (start - first_year) // segment_years
+        if segments and segments[-1]['key'] == key:
+            segments[-1]['indices'].append(index)
+            segments[-1]['end'] = end
+        else:
+            segments.append({
+                'key': key,
+                'start': start,
+                'end': end,
+                'indices': [index]
+            })
+
+    return [((segment['start'], segment['end']),
+             {var: [paths[index] for index in segment['indices']]
+              for var, paths in sorted_paths.items()})
+            for segment in segments]
+# ------------------------------------------------------------------
+
+
+def estimate_time_steps(input_paths, raw_variables, realm, freq='mon'):
+    """
+    Estimates the number of time steps a handler writes from the names of its input
+    files, the years of the atm and lnd time series files or the number of monthly
+    MPAS time series files, for the progress metrics
+
+    Params:
+    -------
+        input_paths (dict): the input files for each of the handlers raw variables
+        raw_variables (list(str)): the raw variables of the handler
+        realm (str): the realm of the data, [atm, lnd, mpaso, mpassi]
+        freq (str): the frequency of the atm and lnd time series
+    Returns:
+    --------
+        the estimated number of time steps, or None if it can't be estimated
+    """
+    if realm in ['mpaso', 'mpassi']:
+        timeseries = input_paths.get('MPASO') or input_paths.get('MPASSI')
+        return len(timeseries) if timeseries else None
+
+    steps_per_year = STEPS_PER_YEAR.get(freq or 'mon')
+    if realm not in ['atm', 'lnd'] or not raw_variables or steps_per_year is None:
+        return None
+    num_steps = 0
+    try:
+        for path in input_paths.get(raw_variables[0], []):
+            start, end = get_atm_file_years(raw_variables[0], path)
+            num_steps += (end - start + 1) * steps_per_year
+    except (ValueError, IndexError):
+        return None
+    return num_steps or None
+# ------------------------------------------------------------------
+
+
+def estimate_handler_memory(handler, input_paths, tables_path, realm, max_memory=None):
+    """
+    Estimates the peak memory in bytes a handler needs, from the sizes,
+    dimensions and dtypes of its input files. If the input files can't be
+    inspected, the size on disk of the first input file of each variable is
+    used instead. Only the first file of each variable is looked at, so the
+    estimate doesn't stat every input file
+
+    Params:
+    -------
+        handler (dict): the handler as returned by load_handlers
+        input_paths (dict): the input files for each of the handlers raw variables
+        tables_path (str): path to the tables directory
+        realm (str): the realm of the data, [atm, lnd, mpaso, mpassi]
+        max_memory (int): memory budget in bytes for the input data of the handler
+    Returns:
+    --------
+        the estimated memory in bytes
+    """
+    try:
+        if realm in ['mpaso', 'mpassi']:
+            return _estimate_mpas_memory(handler, input_paths, tables_path)
+        return _estimate_atm_memory(input_paths, max_memory)
+    except Exception as e:
+        logger.info(f"{handler['name']}: unable to estimate memory from the input file headers, {e}")
+
+    filesize = 0
+    for paths in input_paths.values():
+        if isinstance(paths, str):
+            paths = [paths]
+        if paths and os.path.exists(paths[0]):
+            filesize += os.path.getsize(paths[0])
+    return filesize
+
+
+def _estimate_atm_memory(input_paths, max_memory=None):
+    """
+    The atm and lnd handlers load one input file per raw variable at a time,
+    so the footprint comes from a single file for each variable. The time
+    series files of a variable all cover the same number of years, so the
+    first file stands in for the rest
+    """
+    import xarray as xr
+    memory = 0
+    for var, paths in input_paths.items():
+        if not paths:
+            continue
+        with xr.open_dataset(paths[0], decode_times=False) as ds:
+            if var in ds.data_vars:
+                memory += ds[var].size * ds[var].dtype.itemsize
+    memory *= WINDOW_MEMORY_FACTOR
+    if max_memory:
+        memory = min(memory, max_memory)
+    return memory
+
+
+def _estimate_mpas_memory(handler, input_paths, tables_path):
+    """
+    The MPAS handlers stream a single 2D or 3D field through the remapping
+    a chunk of time steps at a time, so the footprint comes from the mesh
+    size, the number of time steps in a chunk, and whether the CMIP6
+    variable has a vertical axis
+    """
+    import xarray as xr
+    from e3sm_to_cmip.mpas import TIME_CHUNK_SIZE
+    timeseries = input_paths.get('MPASO') or input_paths.get('MPASSI') or []
+    memory = 0
+    if timeseries:
+        with xr.open_dataset(timeseries[0], decode_times=False) as ds:
+            num_cells = ds.sizes.get('nCells', 0)
+            num_levels = ds.sizes.get('nVertLevels', 1)
+            num_steps = ds.sizes.get('Time', 1) * len(timeseries)
+        num_steps = min(num_steps, TIME_CHUNK_SIZE)
+
+        dims = get_variable_dimensions(tables_path, handler['table'], handler['name'])
+        if not any('lev' in dim for dim in dims):
+            num_levels = 1
+
+        memory += num_steps * num_cells * num_levels * \
+            np.dtype('float64').itemsize * MPAS_MEMORY_FACTOR
+
+    # the mesh and mapping files are read in full
+    for name in ['MPAS_mesh', 'MPAS_map']:
+        if input_paths.get(name):
+            memory += os.path.getsize(input_paths[name])
+    return memory
+# ------------------------------------------------------------------
+
+
+def init_worker(blas_threads, dask_config, encoding_config=(), profiling_config=(),
+                metrics_config=()):
+    """
+    Set up a worker process of the pool, limiting its BLAS threads and configuring
+    the dask backend of the MPAS handlers, the encoding of the outputs, the
+    timing of the handler stages and the reporting of their progress. The CMOR
+    session of the worker is closed when the worker exits
+
+    Params:
+    -------
+        blas_threads (int): the number of BLAS threads for each dask thread
+        dask_config (tuple): the arguments to mpas.configure_dask
+        encoding_config (tuple): the arguments to util.configure_encoding
+        profiling_config (tuple): the arguments to profiling.configure_profiling
+        metrics_config (tuple): the arguments to metrics.configure_metrics
+    """
+    from e3sm_to_cmip.mpas import configure_dask
+    set_thread_limits(blas_threads)
+    configure_dask(*dask_config)
+    configure_encoding(*encoding_config)
+    configure_profiling(*profiling_config)
+    configure_metrics(*metrics_config)
+    # forked workers leave through os._exit, which skips atexit, so the session
+    # is closed by a multiprocessing finalizer that runs as the worker shuts down
+    multiprocessing.util.Finalize(None, end_cmor_session, exitpriority=10)
+# ------------------------------------------------------------------
+
+
 def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
-               realm='atm', logdir=None, simple=False, outpath=None, freq="mon"):
+               realm='atm', logdir=None, simple=False, outpath=None, freq="mon",
+               chunk_size=None, max_memory=None, checkpoint=None, output_format='netcdf'):
     """
     Run each of the handlers one at a time on the main process
 
@@ -117,6 +462,10 @@ def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
         tables_path (str): path to the tables directory
         metadata_path (str): path to the cmor input metadata
         realm (str): what type of files to work with
+        chunk_size (int): number of time steps to pass to each cmor.write call
+        max_memory (int): memory budget in bytes for the input data of each handler
+        output_format (str): the format of the simple mode outputs, netcdf or zarr
+        checkpoint (dict): the committed work of a previous run to skip, as returned by load_checkpoint
     Returns:
     --------
         returns 1 if an error occurs, else 0
@@ -130,6 +479,9 @@ def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
         if realm != 'atm':
             pbar = tqdm(total=len(handlers))
 
+        for handler in handlers:
+            job_queued(handler['name'], handler['name'])
+
         for _, handler in enumerate(handlers):
 
             handler_method = handler['method']
@@ -137,21 +489,38 @@ def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
             unit_conversion = handler.get('unit_conversion')
 
             # find the input files this handler needs
-            if realm in ['atm', 'lnd']:
-
-                input_paths = {var: [os.path.join(input_path, x) for x in
-                                     find_atm_files(var, input_path)]
-                               for var in handler_variables}
-            elif realm == 'fx':
-                input_paths = {var: [os.path.join(input_path, x) for x in os.listdir(input_path) if x[-3:] == '.nc']
-                               for var in handler_variables}
-            else:
-                input_paths = {var: find_mpas_files(var, input_path,
-                                                    map_path)
-                               for var in handler_variables}
+            with stage('discover', handler=handler['name']):
+                if realm in ['atm', 'lnd']:
+
+                    input_paths = {var: [os.path.join(input_path, x) for x in
+                                         find_atm_files(var, input_path)]
+                                   for var in handler_variables}
+                elif realm == 'fx':
+                    input_paths = {var: [os.path.join(input_path, x) for x in get_directory_index(input_path)['files'] if x[-3:] == '.nc']
+                                   for var in handler_variables}
+                else:
+                    input_paths = {var: find_mpas_files(var, input_path,
+                                                        map_path)
+                                   for var in handler_variables}
+
+            if checkpoint is not None:
+                input_paths = apply_checkpoint(checkpoint, handler, input_paths, realm)
+                if input_paths is None:
+                    num_success += 1
+                    print_message(f"{handler['name']} was completed by a previous run", 'ok')
+                    job_finished(handler['name'])
+                    if realm != 'atm':
+                        pbar.update(1)
+                    continue
 
+            job_started(
+                handler['name'],
+                expected_steps=estimate_time_steps(input_paths, handler_variables, realm, freq))
+            name = None
             try:
-                name = handler_method(
+                name, _ = run_profiled(
+                    handler['name'],
+                    handler_method,
                     input_paths,
                     tables_path,
                     metadata_path,
@@ -165,13 +534,19 @@ def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
                     simple=simple,
                     outpath=outpath,
                     unit_conversion=unit_conversion,
-                    freq=freq)
+                    freq=freq,
+                    chunk_size=chunk_size,
+                    max_memory=max_memory,
+                    output_format=output_format)
             except Exception as e:
                 print_debug(e)
 
+            job_finished(handler['name'], success=name is not None)
             if name is not None:
                 num_success += 1
                 msg = f'Finished {name}, {num_success}/{num_handlers} jobs complete'
+                if outpath:
+                    record_checkpoint(outpath, handler['name'], handler['table'])
             else:
                 msg = f'Error running handler {handler["name"]}'
                 print_message(msg, status='error')
@@ -181,6 +556,7 @@ def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
                 pbar.update(1)
         if realm != 'atm':
             pbar.close()
+        end_cmor_session()
 
     except Exception as error:
         print_debug(error)
@@ -192,7 +568,9 @@ def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
 # ------------------------------------------------------------------
 
 
-def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units, serial=None, positive=None, levels=None, axis=None, logdir=None, outpath=None, table='Amon', has_time=True):
+def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units, serial=None, positive=None, levels=None, axis=None, logdir=None, outpath=None, table='Amon', has_time=True, chunk_size=None, output_format='netcdf'):
+    import xarray as xr
+    from e3sm_to_cmip.mpas import TIME_CHUNK_SIZE, write_netcdf
     from e3sm_to_cmip.util import print_message
     logger = logging.getLogger()
 
@@ -222,7 +600,19 @@ def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units,
     start_year = inputfile[len(raw_variables[0]) + 1:].split('_')[0]
     end_year = inputfile[len(raw_variables[0]) + 1:].split('_')[1]
 
-    data = {}
+    resource_path, _ = os.path.split(os.path.abspath(resources.__file__))
+    table_data = get_table_info(resource_path, table)
+    output_file_path = os.path.join(
+        outpath, f'{outvar_name}_{table[:-5]}_{start_year}-{end_year}')
+
+    # the zarr store is written one time chunk at a time, as the chunks are converted
+    if output_format == 'zarr':
+        root, ext = os.path.splitext(output_file_path)
+        output_file_path = (root if ext == '.nc' else output_file_path) + '.zarr'
+        zarr_chunk = chunk_size if chunk_size else TIME_CHUNK_SIZE
+        zarr_created = False
+        msg = f'writing out variable to zarr store {output_file_path}'
+        print_message(msg, 'ok')
 
     # assuming all year ranges are the same for every variable
     num_files_per_variable = len(infiles[raw_variables[0]])
@@ -234,6 +624,9 @@ def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units,
     for file_index in range(num_files_per_variable):
         loaded = False
 
+        # the handlers may convert the data of each file in place
+        data = {}
+
         # reload the dimensions for each time slice
         get_dims = True
 
@@ -243,18 +636,17 @@ def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units,
             # extract data from the input file
             logger.info(f'{outvar_name}: loading {var_name}')
 
-            new_data = get_dimension_data(
-                filename=infiles[var_name][file_index],
-                variable=var_name,
-                levels=levels,
-                get_dims=get_dims)
+            with stage('read'):
+                new_data = get_dimension_data(
+                    filename=infiles[var_name][file_index],
+                    variable=var_name,
+                    levels=levels,
+                    get_dims=get_dims)
             data.update(new_data)
             get_dims = False
             if not loaded:
                 loaded = True
 
-                # new data set
-                ds = xr.Dataset()
                 if has_time:
                     dims = ['time', 'lat', 'lon']
                 else:
@@ -263,10 +655,14 @@ def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units,
                 for depth_dim in ['lev', 'plev', 'levgrnd']:
                     if depth_dim in new_data.keys():
                         dims.insert(1, depth_dim)
+                coords = {d: new_data[d][:] for d in dims}
 
-                ds[outvar_name] = (tuple(dims), new_data[var_name])
-                for d in dims:
-                    ds.coords[d] = new_data[d][:]
+                # new data set, the zarr stores are only ever given the current time chunk
+                if output_format != 'zarr':
+                    ds = xr.Dataset()
+                    ds[outvar_name] = (tuple(dims), new_data[var_name])
+                    for d in dims:
+                        ds.coords[d] = coords[d]
 
         # write out the data
         msg = f"{outvar_name}: time {data['time_bnds'].values[0][0]:1.1f} - {data['time_bnds'].values[-1][-1]:1.1f}"
@@ -277,23 +673,71 @@ def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units,
             pbar = tqdm(total=len(data['time']))
             pbar.set_description(msg)
 
-        for time_index, val in enumerate(data['time']):
-
-            outdata = write_data(
-                varid=0,
-                data=data,
-                timeval=val,
-                timebnds=[data['time_bnds'].values[time_index, :]],
-                index=time_index,
-                raw_variables=raw_variables,
-                simple=True)
-            ds[outvar_name][time_index] = outdata
-            if serial:
-                pbar.update(1)
+        time_vals = data['time'].values
+        time_bnds = data['time_bnds'].values
+        num_steps = len(time_vals)
+        step = chunk_size if chunk_size else 1
+        # the raw data converted for each time step, for the progress metrics
+        step_bytes = sum(data[var].nbytes for var in raw_variables) // max(num_steps, 1)
+        # the converted time steps of the zarr chunk being built, and where it starts
+        zarr_block = list()
+        zarr_start = 0
+        # a single stage for all the time steps, the stages are too costly to record per step
+        with stage('write_data'):
+            for start in range(0, num_steps, step):
+                if chunk_size:
+                    time_index = slice(start, start + chunk_size)
+                    timebnds = time_bnds[time_index, :]
+                else:
+                    time_index = start
+                    timebnds = [time_bnds[time_index, :]]
+
+                outdata = write_data(
+                    varid=0,
+                    data=data,
+                    timeval=time_vals[time_index],
+                    timebnds=timebnds,
+                    index=time_index,
+                    raw_variables=raw_variables,
+                    simple=True)
+                written = min(step, num_steps - start)
+                report_progress(outvar_name, written, written * step_bytes)
+                if serial:
+                    pbar.update(written)
+
+                if output_format != 'zarr':
+                    ds[outvar_name][time_index] = outdata
+                    continue
+
+                zarr_block.append(np.asarray(outdata))
+                end = start + written
+                if end - zarr_start >= zarr_chunk or end == num_steps:
+                    values = np.concatenate(zarr_block) if chunk_size else np.stack(zarr_block)
+                    zarr_block = list()
+                    with stage('write'):
+                        write_simple_zarr(
+                            values=values,
+                            dims=dims,
+                            coords=coords,
+                            inputfile=infiles[raw_variables[0]][file_index],
+                            outvar_name=outvar_name,
+                            time_slice=slice(zarr_start, end),
+                            table_data=table_data,
+                            store=output_file_path,
+                            chunk_size=zarr_chunk,
+                            append=zarr_created)
+                    del values
+                    zarr_created = True
+                    zarr_start = end
 
         if serial:
             pbar.close()
 
+    if output_format == 'zarr':
+        msg = f'{outvar_name}: zarr store complete'
+        logger.debug(msg)
+        return outvar_name
+
     with xr.open_dataset(infiles[raw_variables[0]][0], decode_cf=False, decode_times=False) as inputds:
         for attr, val in inputds.attrs.items():
             ds.attrs[attr] = val
@@ -308,25 +752,14 @@ def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units,
         ds['time'] = inputds['time']
         ds['time'].attrs['bounds'] = 'time_bnds'
 
-    resource_path, _ = os.path.split(os.path.abspath(resources.__file__))
-    table_path = os.path.join(resource_path, table)
-    with open(table_path, 'r') as ip:
-        table_data = json.load(ip)
-
-    variable_attrs = ['standard_name', 'long_name',
-                      'comment', 'cell_methods', 'cell_measures', 'units']
-    for attr in variable_attrs:
+    for attr in SIMPLE_VARIABLE_ATTRS:
         ds[outvar_name].attrs[attr] = table_data['variable_entry'][outvar_name][attr]
 
-    output_file_path = os.path.join(
-        outpath, f'{outvar_name}_{table[:-5]}_{start_year}-{end_year}')
     msg = f'writing out variable to file {output_file_path}'
     print_message(msg, 'ok')
-    fillVals = {
-        np.dtype('float32'): 1e20,
-        np.dtype('float64'): 1e20,
-    }
-    write_netcdf(ds, output_file_path, fillValues=fillVals, unlimited=['time'])
+    with stage('write'):
+        write_netcdf(ds, output_file_path, fillValues=SIMPLE_FILL_VALUES, unlimited=['time'],
+                     profiles={outvar_name: get_encoding_profile(outvar_name)})
 
     msg = f'{outvar_name}: file close complete'
     logger.debug(msg)
@@ -336,13 +769,60 @@ def handle_simple(infiles, raw_variables, write_data, outvar_name, outvar_units,
 # ------------------------------------------------------------------
 
 
+def write_simple_zarr(values, dims, coords, inputfile, outvar_name, time_slice, table_data, store, chunk_size, append=False):
+    """
+    Writes a block of time steps of a simple mode variable to a zarr store.
+    The first block creates the store along with the lat/lon bounds, the global
+    attributes of the input file, the variable attributes from the CMIP6 table and
+    the encoding profile of the variable, later blocks only append the variable and
+    the time and time bounds.
+
+    Params:
+    -------
+        values (numpy.ndarray): the converted time steps of the block
+        dims (list(str)): the dimensions of the variable
+        coords (dict): the coordinates of the dimensions of the variable
+        inputfile (str): the input file the time steps were read from
+        outvar_name (str): the name of the converted variable
+        time_slice (slice): the time steps of the input file in the block
+        table_data (dict): the CMIP6 table of the variable
+        store (str): the path to the zarr store
+        chunk_size (int): the number of time steps in each chunk of the store
+        append (bool): append to an existing store instead of creating it
+    """
+    import xarray as xr
+    from e3sm_to_cmip.mpas import write_zarr
+    with xr.open_dataset(inputfile, decode_cf=False, decode_times=False) as inputds:
+        time_bounds_name = 'time_bnds' if 'time_bnds' in inputds.data_vars else 'time_bounds'
+        block = xr.Dataset({outvar_name: (tuple(dims), values)})
+        block = block.assign_coords(time=inputds['time'].isel(time=time_slice).load())
+        block['time_bnds'] = inputds[time_bounds_name].isel(time=time_slice).load()
+        block['time'].attrs['bounds'] = 'time_bnds'
+
+        if append:
+            write_zarr(block, store, appendDim='time')
+            return
+
+        block = block.assign_coords(
+            {name: coords[name] for name in dims if name != 'time'})
+        block['lat_bnds'] = inputds['lat_bnds'].load()
+        block['lon_bnds'] = inputds['lon_bnds'].load()
+        block.attrs.update(inputds.attrs)
+
+    for attr in SIMPLE_VARIABLE_ATTRS:
+        block[outvar_name].attrs[attr] = table_data['variable_entry'][outvar_name][attr]
+
+    write_zarr(block, store, fillValues=SIMPLE_FILL_VALUES, chunks={'time': chunk_size},
+               profiles={outvar_name: get_encoding_profile(outvar_name)})
+# ------------------------------------------------------------------
+
+
 def var_has_time(table_path, variable):
-    with open(table_path, 'r') as inputstream:
-        table_info = json.load(inputstream)
+    tables, table = os.path.split(table_path)
 
     if '_highfreq' in variable:
         variable = variable[:len('_highfreq') * -1]
-    axis_info = table_info['variable_entry'][variable]['dimensions'].split(' ')
+    axis_info = get_variable_dimensions(tables, table, variable)
     if 'time' in axis_info:
         return 'time'
     elif 'time1' in axis_info:
@@ -350,7 +830,21 @@ def var_has_time(table_path, variable):
     return False
 
 
-def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_units, table, tables, metadata_path, serial=None, positive=None, levels=None, axis=None, logdir=None, simple=False, outpath=None):
+def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_units, table, tables, metadata_path, serial=None, positive=None, levels=None, axis=None, logdir=None, simple=False, outpath=None, chunk_size=None, max_memory=None, output_format='netcdf'):
+    """
+    Load the raw variables for a handler and pass them to its write_data function.
+
+    If chunk_size is set, write_data is called once per block of chunk_size time
+    steps with index set to a slice, and timeval/timebnds holding the arrays of
+    time values and bounds for that block, so a single cmor.write covers the whole
+    block. Otherwise write_data is called once per time step with an integer index.
+    Only handlers whose write_data is valid for both forms should pass chunk_size.
+
+    The input files are read in windows of time steps sized to fit in max_memory
+    bytes, so the peak memory of the handler doesn't grow with the length of the
+    input files. Without max_memory each input file is read as a single window.
+    """
+    import cmor
 
     timename = var_has_time(os.path.join(tables, table), outvar_name)
     if simple:
@@ -367,7 +861,9 @@ def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_uni
             axis=axis,
             logdir=logdir,
             outpath=outpath,
-            has_time=timename)
+            has_time=timename,
+            chunk_size=chunk_size,
+            output_format=output_format)
 
     from e3sm_to_cmip.util import print_message
     logger = logging.getLogger()
@@ -385,29 +881,25 @@ def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_uni
     if zerofiles:
         return None
 
-    # Create the logging directory and setup cmor
+    # setup cmor, reusing the CMOR session and tables of this process
     if logdir:
         logpath = logdir
     else:
         outpath, _ = os.path.split(logger.__dict__['handlers'][0].baseFilename)
         logpath = os.path.join(outpath, 'cmor_logs')
-    os.makedirs(logpath, exist_ok=True)
 
-    logfile = os.path.join(logpath, outvar_name + '.log')
-
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-
-    cmor.dataset_json(str(metadata_path))
-    cmor.load_table(str(table))
+    with stage('cmor_setup'):
+        # each input file defines its own axes, variable and z-factors
+        num_zfactors = 4 if levels and levels.get('name') in [
+            'standard_hybrid_sigma', 'standard_hybrid_sigma_half'] else 0
+        num_axes, num_variables = estimate_cmor_definitions(
+            tables, table, outvar_name, len(infiles[raw_variables[0]]), num_zfactors)
+        setup_cmor_session(tables, metadata_path, table, logpath,
+                           num_axes=num_axes, num_variables=num_variables)
 
     msg = f'{outvar_name}: CMOR setup complete'
     logging.info(msg)
 
-    data = {}
-
     # assuming all year ranges are the same for every variable
     num_files_per_variable = len(infiles[raw_variables[0]])
 
@@ -415,93 +907,114 @@ def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_uni
     for var_name in raw_variables:
         infiles[var_name].sort()
 
-    for index in range(num_files_per_variable):
+    for file_index in range(num_files_per_variable):
 
-        # reload the dimensions for each time slice
-        get_dims = True
+        # extract data from the input files one window of time steps at a time
+        logger.info(f"{outvar_name}: loading {', '.join(raw_variables)}")
+        filenames = {var_name: infiles[var_name][file_index]
+                     for var_name in raw_variables}
+        windows = iter_time_windows(
+            filenames=filenames,
+            raw_variables=raw_variables,
+            levels=levels,
+            max_memory=max_memory)
 
-        # load data for each variable
-        for var_name in raw_variables:
+        # not enumerate, which would keep the previous window alive while the
+        # next one is read
+        first_window = True
+        for data in windows:
 
-            # extract data from the input file
-            logger.info(f'{outvar_name}: loading {var_name}')
+            # the axes are the same for every window of a file
+            if first_window:
+                first_window = False
+                logger.info(f'{outvar_name}: loading axes')
 
-            new_data = get_dimension_data(
-                filename=infiles[var_name][index],
-                variable=var_name,
-                levels=levels,
-                get_dims=get_dims)
-            data.update(new_data)
-            get_dims = False
-            if simple and not loaded_one:
-                loaded_one = True
+                # create the cmor variable and axis
+                axis_ids, ips = load_axis(data=data, levels=levels, has_time=timename)
 
-                # new data set
-                ds = xr.Dataset()
-                if timename:
-                    dims = (timename, 'lat', 'lon')
+                if positive:
+                    varid = cmor.variable(outvar_name, outvar_units,
+                                          axis_ids, positive=positive)
                 else:
-                    dims = ('lat', 'lon')
+                    varid = cmor.variable(outvar_name, outvar_units, axis_ids)
+                set_cmor_deflate(varid, outvar_name)
 
-                if 'lev' in new_data.keys():
-                    dims = (timename, 'lev', 'lat', 'lon')
-                elif 'plev' in new_data.keys():
-                    dims = (timename, 'plev', 'lat', 'lon')
-                ds[outvar_name] = (dims, new_data[var_name])
-                for d in dims:
-                    ds.coords[d] = new_data[d][:]
+            if ips:
+                data['ips'] = ips
 
-        logger.info(f'{outvar_name}: loading axes')
-
-        # create the cmor variable and axis
-        axis_ids, ips = load_axis(data=data, levels=levels, has_time=timename)
-
-        if ips:
-            data['ips'] = ips
-
-        if positive:
-            varid = cmor.variable(outvar_name, outvar_units,
-                                  axis_ids, positive=positive)
-        else:
-            varid = cmor.variable(outvar_name, outvar_units, axis_ids)
-
-        # write out the data
-        msg = f"{outvar_name}: time {data['time_bnds'].values[0][0]:1.1f} - {data['time_bnds'].values[-1][-1]:1.1f}"
-        logger.info(msg)
-
-        if serial:
-            pbar = tqdm(total=data['time'].shape[0])
-            pbar.set_description(msg)
+            # write out the data
+            msg = f"{outvar_name}: time {data['time_bnds'].values[0][0]:1.1f} - {data['time_bnds'].values[-1][-1]:1.1f}"
+            logger.info(msg)
 
-        if timename:
-            try:
-                for index, val in enumerate(data['time'].values):
+            if serial:
+                pbar = tqdm(total=data['time'].shape[0])
+                pbar.set_description(msg)
+
+            if timename:
+                try:
+                    time_vals = data['time'].values
+                    time_bnds = data['time_bnds'].values
+                    num_steps = len(time_vals)
+                    step = chunk_size if chunk_size else 1
+                    # the raw data converted for each time step, for the progress metrics
+                    step_bytes = sum(data[var].nbytes for var in raw_variables) // max(num_steps, 1)
+                    # a single stage for the window, the stages are too costly to record per step
+                    with stage('write_data'):
+                        for start in range(0, num_steps, step):
+                            if chunk_size:
+                                index = slice(start, start + chunk_size)
+                                timebnds = time_bnds[index, :]
+                            else:
+                                index = start
+                                timebnds = [time_bnds[index, :]]
+                            write_data(
+                                varid=varid,
+                                data=data,
+                                timeval=time_vals[index],
+                                timebnds=timebnds,
+                                index=index,
+                                raw_variables=raw_variables,
+                                simple=False)
+                            written = min(step, num_steps - start)
+                            report_progress(outvar_name, written, written * step_bytes)
+                            if serial:
+                                pbar.update(written)
+                except Exception as e:
+                    # the output of this input file is incomplete, so it's neither
+                    # journaled nor is the variable reported as complete
+                    msg = f'{outvar_name}: failed to write {filenames[raw_variables[0]]}: {e}'
+                    print_message(msg)
+                    logger.error(msg)
+                    if serial:
+                        pbar.close()
+                    windows.close()
+                    try:
+                        cmor.close(varid)
+                    except Exception:
+                        pass
+                    return None
+            else:
+                with stage('write_data'):
                     write_data(
                         varid=varid,
                         data=data,
-                        timeval=val,
-                        timebnds=[data['time_bnds'].values[index, :]],
-                        index=index,
                         raw_variables=raw_variables,
                         simple=False)
-                    if serial:
-                        pbar.update(1)
-            except Exception as e:
-                print(e)
-        else:
-            write_data(
-                varid=varid,
-                data=data,
-                raw_variables=raw_variables,
-                simple=False)
-        if serial:
-            pbar.close()
+                report_progress(outvar_name, 1, sum(data[var].nbytes for var in raw_variables))
+            if serial:
+                pbar.close()
 
-    msg = f'{outvar_name}: write complete, closing'
-    logger.debug(msg)
-    cmor.close()
+            # the windows are sized to hold one window at a time, so this one is
+            # released before the next one is read
+            del data
 
-    msg = f'{outvar_name}: file close complete'
+        # close the output for this input file so it survives an interrupted run
+        with stage('write'):
+            cmor.close(varid)
+        if outpath:
+            record_checkpoint(outpath, outvar_name, table, filenames[raw_variables[0]])
+
+    msg = f'{outvar_name}: write complete'
     logger.debug(msg)
 
     return outvar_name
@@ -531,16 +1044,111 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
         optionally for 3d:
         lev, ilev, ps, p0, hyam, hyai, hybm, hybi
     """
-    # extract data from the input file
-    data = dict()
-
+    import xarray as xr
     if not os.path.exists(filename):
         raise IOError(f"File not found: {filename}")
 
     ds = xr.open_dataset(filename, decode_times=False)
+    return _load_dimension_data(ds, variable, levels=levels, get_dims=get_dims)
+# ------------------------------------------------------------------
+
+
+def iter_time_windows(filenames, raw_variables, levels=None, max_memory=None):
+    """
+    Lazily opens the input file for each raw variable and yields the same
+    dictionary as get_dimension_data, one window of time steps at a time.
+    Only the current window of each variable is read from disk.
+
+    Params:
+    -------
+        filenames (dict(str: str)): the input file for each raw variable
+        raw_variables (list(str)): the names of the variables to load
+        levels (dict): the handlers vertical level information
+        max_memory (int): the memory budget in bytes for a single window, if
+            None the whole file is loaded as one window
+    Yields:
+    -------
+        data (dict): the variable and dimension data for each window
+    """
+    import xarray as xr
+    datasets = dict()
+    try:
+        for var_name in raw_variables:
+            filename = filenames[var_name]
+            if not os.path.exists(filename):
+                raise IOError(f"File not found: {filename}")
+            datasets[var_name] = xr.open_dataset(filename, decode_times=False)
+
+        num_steps = datasets[raw_variables[0]].sizes.get('time')
+        window_size = get_time_window_size(
+            datasets, raw_variables, levels=levels, max_memory=max_memory)
+
+        if num_steps and window_size:
+            time_slices = [slice(start, start + window_size)
+                           for start in range(0, num_steps, window_size)]
+        else:
+            time_slices = [None]
+
+        for time_slice in time_slices:
+            with stage('read'):
+                data = dict()
+                get_dims = True
+                for var_name in raw_variables:
+                    data.update(
+                        _load_dimension_data(
+                            datasets[var_name],
+                            var_name,
+                            levels=levels,
+                            get_dims=get_dims,
+                            time_slice=time_slice))
+                    get_dims = False
+            yield data
+            del data
+    finally:
+        for ds in datasets.values():
+            ds.close()
+# ------------------------------------------------------------------
+
+
+def get_time_window_size(datasets, raw_variables, levels=None, max_memory=None):
+    """
+    Returns the number of time steps that can be loaded at once while keeping
+    WINDOW_MEMORY_FACTOR copies of the raw variables inside max_memory bytes, or
+    None if there is no memory budget or the variables have no time axis
+    """
+    if not max_memory:
+        return None
+
+    step_bytes = 0
+    for var_name in raw_variables:
+        variable = datasets[var_name][var_name]
+        if 'time' in variable.dims:
+            step_bytes += variable.size * variable.dtype.itemsize // variable.sizes['time']
+
+    if levels and levels.get('name') in ['standard_hybrid_sigma', 'standard_hybrid_sigma_half']:
+        ps = datasets[raw_variables[0]]['PS']
+        step_bytes += ps.size * ps.dtype.itemsize // ps.sizes['time']
+
+    if step_bytes == 0:
+        return None
+    return max(1, int(max_memory // (WINDOW_MEMORY_FACTOR * step_bytes)))
+# ------------------------------------------------------------------
+
+
+def _load_dimension_data(ds, variable, levels=None, get_dims=False, time_slice=None):
+    """
+    Loads the variable and dimension data from an open dataset, restricted to
+    the time steps in time_slice if one is given
+    """
+    data = dict()
+
+    def _window(array):
+        if time_slice is not None and 'time' in array.dims:
+            return array.isel(time=time_slice)
+        return array
 
     # load the data for each variable
-    variable_data = ds[variable]
+    variable_data = _window(ds[variable])
 
     # load
     if 'plev' in ds.dims or 'lev' in ds.dims:
@@ -558,17 +1166,17 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
             'lon': ds['lon'],
             'lat_bnds': ds['lat_bnds'],
             'lon_bnds': ds['lon_bnds'],
-            'time': ds['time']
+            'time': _window(ds['time'])
         })
         try:
             time2 = ds['time2']
         except KeyError:
             pass
         else:
-            data['time2'] = time2
+            data['time2'] = _window(time2)
 
         if time_bounds_name in ds.data_vars:
-            time_bnds = ds[time_bounds_name]
+            time_bnds = _window(ds[time_bounds_name])
             if len(time_bnds.shape) == 1:
                 time_bnds = time_bnds.reshape(1, 2)
             data['time_bnds'] = time_bnds
@@ -580,7 +1188,7 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
                 data.update({
                     'lev': ds['lev'].values/1000,
                     'ilev': ds['ilev'].values/1000,
-                    'ps': ds['PS'].values,
+                    'ps': _window(ds['PS']).values,
                     'p0': ds['P0'].values.item(),
                     'hyam': ds['hyam'],
                     'hyai': ds['hyai'],
@@ -610,6 +1218,7 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
 
 
 def load_axis(data, levels=None, has_time=True):
+    import cmor
     time = None
     # use the special name for time if it exists
     if levels and levels.get('time_name'):
@@ -0,0 +1,389 @@
+"""
+Live progress of a run: the handlers queued, running and done, the time steps and
+bytes converted for each variable, the throughput and the estimated time remaining.
+The progress is written periodically to a json status file, and can also be served
+in the Prometheus text format from a local http endpoint
+"""
+
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the metrics state of this process, see configure_metrics and start_metrics
+_METRICS = dict(queue=None, tracking=False, status_path=None, interval=None,
+                started=None, last_progress=None, thread=None, server=None,
+                stop=None)
+
+# the handler jobs of the run, keyed by their label
+_JOBS = dict()
+
+# the time steps and bytes converted so far, keyed by variable
+_VARIABLES = dict()
+
+_LOCK = threading.Lock()
+
+# the states of a handler job
+JOB_STATES = ['queued', 'running', 'done', 'failed']
+
+
+def configure_metrics(progress_queue=None):
+    """
+    Sets the queue a worker process sends its progress to the main process through,
+    and clears the metrics the worker would otherwise inherit from the main process
+
+    Params:
+    -------
+        progress_queue (multiprocessing.Queue): the queue returned by start_metrics,
+            or None to not report progress
+    """
+    with _LOCK:
+        _METRICS.update(queue=progress_queue, tracking=False, thread=None, server=None, stop=None)
+        _JOBS.clear()
+        _VARIABLES.clear()
+# ------------------------------------------------------------------
+
+
+def start_metrics(status_path=None, interval=30, port=None, parallel=False):
+    """
+    Starts tracking the progress of the run in this process, writing the status file
+    every interval seconds and serving the metrics on the given port. Does nothing
+    unless a status path or a port is given
+
+    Params:
+    -------
+        status_path (str): the path of the json status file
+        interval (float): the seconds between updates of the status file
+        port (int): the local port to serve the metrics in the Prometheus text format on
+        parallel (bool): if the handlers run in worker processes, that report their
+            progress through a queue
+    Returns:
+    --------
+        the queue to pass to configure_metrics in the workers, or None
+    """
+    if not status_path and not port:
+        return None
+
+    with _LOCK:
+        _JOBS.clear()
+        _VARIABLES.clear()
+        _METRICS.update(
+            queue=multiprocessing.Queue() if parallel else None,
+            tracking=True,
+            status_path=status_path,
+            interval=interval,
+            started=time.time(),
+            last_progress=None,
+            stop=threading.Event())
+
+    if port:
+        server = ThreadingHTTPServer(('127.0.0.1', port), _MetricsRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        _METRICS['server'] = server
+
+    thread = threading.Thread(target=_monitor, daemon=True)
+    thread.start()
+    _METRICS['thread'] = thread
+    return _METRICS['queue']
+# ------------------------------------------------------------------
+
+
+def stop_metrics():
+    """
+    Collects the last progress of the workers, writes the final status file and stops
+    serving the metrics
+    """
+    if not _METRICS['tracking']:
+        return
+    _METRICS['stop'].set()
+    _METRICS['thread'].join()
+    if _METRICS['server'] is not None:
+        _METRICS['server'].shutdown()
+        _METRICS['server'].server_close()
+    _METRICS.update(tracking=False, queue=None, thread=None, server=None)
+# ------------------------------------------------------------------
+
+
+def _monitor():
+    """
+    Applies the progress sent by the workers and writes the status file periodically,
+    until stop_metrics is called
+    """
+    progress_queue = _METRICS['queue']
+    stop = _METRICS['stop']
+    last_write = 0.
+    while True:
+        stopping = stop.is_set()
+        if progress_queue is not None:
+            _drain(progress_queue, timeout=None if stopping else 1.)
+        else:
+            stop.wait(1.)
+        now = time.time()
+        if _METRICS['status_path'] and (stopping or now - last_write >= _METRICS['interval']):
+            write_status(_METRICS['status_path'])
+            last_write = now
+        if stopping:
+            return
+# ------------------------------------------------------------------
+
+
+def _drain(progress_queue, timeout=None):
+    """
+    Applies the progress waiting in the queue, waiting up to timeout seconds for the
+    first item, or not at all if timeout is None
+    """
+    try:
+        item = progress_queue.get(timeout=timeout) if timeout else progress_queue.get_nowait()
+        while True:
+            _add_progress(*item)
+            item = progress_queue.get_nowait()
+    except (queue.Empty, OSError, EOFError):
+        pass
+# ------------------------------------------------------------------
+
+
+def job_queued(label, variable, expected_steps=None):
+    """
+    Records a handler job waiting to run
+
+    Params:
+    -------
+        label (str): the name of the job, the variable and the years of the segment
+        variable (str): the CMIP6 variable the job converts
+        expected_steps (int): the number of time steps the job should write, if known
+    """
+    if not _METRICS['tracking']:
+        return
+    with _LOCK:
+        _JOBS[label] = dict(variable=variable, state='queued', expected_steps=expected_steps,
+                            started=None, finished=None)
+        _VARIABLES.setdefault(variable, dict(steps=0, bytes=0, started=None))
+# ------------------------------------------------------------------
+
+
+def job_started(label, expected_steps=None):
+    """
+    Records a handler job starting to run, along with the number of time steps it
+    should write if that is only known once its input files are found
+    """
+    if not _METRICS['tracking']:
+        return
+    now = time.time()
+    with _LOCK:
+        job = _JOBS[label]
+        job.update(state='running', started=now)
+        if expected_steps is not None:
+            job['expected_steps'] = expected_steps
+        variable = _VARIABLES[job['variable']]
+        if variable['started'] is None:
+            variable['started'] = now
+# ------------------------------------------------------------------
+
+
+def job_finished(label, success=True):
+    """
+    Records a handler job completing, or failing
+    """
+    if not _METRICS['tracking']:
+        return
+    with _LOCK:
+        _JOBS[label].update(state='done' if success else 'failed', finished=time.time())
+# ------------------------------------------------------------------
+
+
+def report_progress(variable, steps, nbytes=0):
+    """
+    Reports time steps of a variable written by a handler. The progress is recorded
+    directly when the handlers run in the main process, and sent to the main process
+    from the workers. Nothing is recorded unless the metrics are enabled
+
+    Params:
+    -------
+        variable (str): the CMIP6 variable written
+        steps (int): the number of time steps written
+        nbytes (int): the size in bytes of the data converted for the time steps
+    """
+    if _METRICS['tracking']:
+        _add_progress(variable, steps, nbytes)
+    elif _METRICS['queue'] is not None:
+        _METRICS['queue'].put((variable, steps, nbytes))
+# ------------------------------------------------------------------
+
+
+def _add_progress(variable, steps, nbytes):
+    with _LOCK:
+        totals = _VARIABLES.setdefault(variable, dict(steps=0, bytes=0, started=None))
+        totals['steps'] += steps
+        totals['bytes'] += nbytes
+        _METRICS['last_progress'] = time.time()
+# ------------------------------------------------------------------
+
+
+def get_status():
+    """
+    Returns the progress of the run as a dict. The time remaining is estimated from the
+    throughput and the time steps left to write, or from the jobs left to run when the
+    number of time steps of some of the jobs isn't known
+    """
+    now = time.time()
+    with _LOCK:
+        jobs = {label: dict(job) for label, job in _JOBS.items()}
+        variables = {name: dict(totals) for name, totals in _VARIABLES.items()}
+        started = _METRICS['started'] or now
+        last_progress = _METRICS['last_progress']
+
+    elapsed = now - started
+    counts = {state: 0 for state in JOB_STATES}
+    for job in jobs.values():
+        counts[job['state']] += 1
+
+    for name, totals in variables.items():
+        expected = [job['expected_steps'] for job in jobs.values() if job['variable'] == name]
+        totals['expected_steps'] = sum(expected) if expected and None not in expected else None
+        variable_started = totals.pop('started')
+        running_time = now - variable_started if variable_started else 0.
+        totals['steps_per_s'] = totals['steps'] / running_time if running_time > 0 else 0.
+
+    steps = sum(totals['steps'] for totals in variables.values())
+    nbytes = sum(totals['bytes'] for totals in variables.values())
+    steps_per_s = steps / elapsed if elapsed > 0 else 0.
+
+    unfinished = [job for job in jobs.values() if job['state'] in ['queued', 'running']]
+    finished = len(jobs) - len(unfinished)
+    eta = None
+    if not unfinished:
+        eta = 0.
+    elif all(job['expected_steps'] is not None for job in unfinished) and steps_per_s > 0:
+        remaining = 0
+        for name in set(job['variable'] for job in unfinished):
+            totals = variables[name]
+            if totals['expected_steps'] is not None:
+                remaining += max(totals['expected_steps'] - totals['steps'], 0)
+        eta = remaining / steps_per_s
+    elif finished:
+        eta = elapsed * len(unfinished) / finished
+
+    def timestamp(seconds):
+        return datetime.fromtimestamp(seconds).isoformat(timespec='seconds') if seconds else None
+
+    return {
+        'updated': timestamp(now),
+        'started': timestamp(started),
+        'elapsed': elapsed,
+        'pid': os.getpid(),
+        'handlers': dict(counts, total=len(jobs)),
+        'jobs': {label: {'variable': job['variable'],
+                         'state': job['state'],
+                         'expected_steps': job['expected_steps'],
+                         'started': timestamp(job['started']),
+                         'finished': timestamp(job['finished'])}
+                 for label, job in jobs.items()},
+        'variables': variables,
+        'steps': steps,
+        'bytes': nbytes,
+        'steps_per_s': steps_per_s,
+        'bytes_per_s': nbytes / elapsed if elapsed > 0 else 0.,
+        'eta': eta,
+        'last_progress': timestamp(last_progress),
+        'since_progress': now - last_progress if last_progress else None,
+    }
+# ------------------------------------------------------------------
+
+
+def write_status(path):
+    """
+    Writes the progress of the run to a json file, replacing the file in one step
+    so readers never see a partially written status
+
+    Params:
+    -------
+        path (str): the path of the status file
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as outstream:
+        json.dump(get_status(), outstream, indent=2)
+    os.replace(tmp_path, path)
+# ------------------------------------------------------------------
+
+
+def format_prometheus(status=None):
+    """
+    Returns the progress of the run in the Prometheus text exposition format
+
+    Params:
+    -------
+        status (dict): the progress of the run, by default from get_status
+    """
+    if status is None:
+        status = get_status()
+
+    def value(number):
+        return 'NaN' if number is None else f'{number:g}' if isinstance(number, float) else str(number)
+
+    def escape(label):
+        return label.replace('\\', '\\\\').replace('"', '\\"')
+
+    metrics = [
+        ('handlers', 'gauge', 'Handler jobs in each state',
+         [(f'state="{state}"', status['handlers'][state]) for state in JOB_STATES]),
+        ('steps_written_total', 'counter', 'Time steps written for each variable',
+         [(f'variable="{escape(name)}"', totals['steps']) for name, totals in status['variables'].items()]),
+        ('steps_expected', 'gauge', 'Time steps expected for each variable',
+         [(f'variable="{escape(name)}"', totals['expected_steps']) for name, totals in status['variables'].items()]),
+        ('bytes_processed_total', 'counter', 'Bytes of data converted for each variable',
+         [(f'variable="{escape(name)}"', totals['bytes']) for name, totals in status['variables'].items()]),
+        ('steps_per_second', 'gauge', 'Time steps written per second since the start of the run',
+         [('', status['steps_per_s'])]),
+        ('bytes_per_second', 'gauge', 'Bytes converted per second since the start of the run',
+         [('', status['bytes_per_s'])]),
+        ('eta_seconds', 'gauge', 'Estimated seconds until the run completes',
+         [('', status['eta'])]),
+        ('elapsed_seconds', 'gauge', 'Seconds since the start of the run',
+         [('', status['elapsed'])]),
+        ('seconds_since_progress', 'gauge', 'Seconds since a time step was last written',
+         [('', status['since_progress'])]),
+    ]
+
+    lines = list()
+    for name, kind, description, samples in metrics:
+        name = f'e3sm_to_cmip_{name}'
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, number in samples:
+            labels = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}{labels} {value(number)}')
+    return '\n'.join(lines) + '\n'
+# ------------------------------------------------------------------
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics in the Prometheus text format on /metrics, and the json
+    status on /status
+    """
+
+    def do_GET(self):
+        if self.path.startswith('/status'):
+            body = json.dumps(get_status(), indent=2)
+            content_type = 'application/json'
+        elif self.path == '/' or self.path.startswith('/metrics'):
+            body = format_prometheus()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # don't write a line to stderr for every scrape
+        pass
+# ------------------------------------------------------------------
@@ -5,62 +5,126 @@ Utilities related to converting MPAS-Ocean and MPAS-Seaice files to CMOR
 from __future__ import absolute_import, division, print_function
 
 import re
+import hashlib
+import uuid
 import numpy as np
+import scipy.sparse
 import netCDF4
 from datetime import datetime
 import sys
 import xarray
 import os
-import cmor
-import subprocess
-import tempfile
 import logging
 import argparse
 from dask.diagnostics import ProgressBar
 import dask
+import dask.array
 import multiprocessing
 from multiprocessing.pool import ThreadPool
 
+from e3sm_to_cmip.metrics import report_progress
+from e3sm_to_cmip.profiling import stage
+from e3sm_to_cmip.util import get_cache_dir, set_cmor_deflate, setup_cmor_session
 
-def remap(ds, mappingFileName, threshold=0.05):
-    '''Use ncreamp to remap the xarray Dataset to a new target grid'''
+# the number of time steps that are remapped and written to CMOR at a time
+TIME_CHUNK_SIZE = 12
 
-    # write the dataset to a temp file
-    inFileName = _get_temp_path()
-    outFileName = _get_temp_path()
+# parsed mapping files, keyed by the path, size and mtime of the file
+_MAPPING_WEIGHTS = dict()
+
+# the dask schedulers that configure_dask accepts
+DASK_SCHEDULERS = ['threads', 'processes', 'distributed']
+
+# the chunks to open MPAS time series with when there's no memory to size
+# them from
+DEFAULT_DASK_CHUNKS = {'nCells': 32768, 'Time': 6}
+
+# each dask thread holds its input chunk and a few intermediate copies, so
+# the memory per thread is divided by this factor when sizing the chunks
+DASK_CHUNK_MEMORY_FACTOR = 4
+
+# the smallest chunk of cells to open MPAS time series with
+MIN_DASK_CHUNK_CELLS = 4096
+
+# the dask execution backend of the MPAS handlers, see configure_dask
+_DASK_CONFIG = dict()
+
+# quantities derived from mesh files, keyed by the path, size and mtime of
+# the file and then by the name of the quantity
+_MESH_DATA = dict()
+
+
+def remap(ds, mappingFileName, threshold=0.05,
+          timeChunkSize=TIME_CHUNK_SIZE):
+    '''
+    Remap the xarray Dataset to the target grid of a SCRIP or ESMF mapping
+    file with the sparse weight matrix.
+
+    Variables with a time dimension are remapped lazily, in chunks of
+    timeChunkSize time steps, and are only computed a chunk at a time as
+    write_cmor writes them out
+    '''
 
     if 'depth' in ds.dims:
         ds = ds.transpose('time', 'depth', 'nCells', 'nbnd')
 
-    write_netcdf(ds, inFileName)
+    with stage('mapping'):
+        weights = get_mapping_weights(mappingFileName)
+    matrix = weights['matrix']
+    nLat, nLon = weights['dst_grid_dims']
+
+    dsOut = xarray.Dataset(attrs=ds.attrs)
+    dsOut.coords['lat'] = ('lat', weights['lat'],
+                           {'units': 'degrees_north', 'bounds': 'lat_bnds'})
+    dsOut.coords['lon'] = ('lon', weights['lon'],
+                           {'units': 'degrees_east', 'bounds': 'lon_bnds'})
+    dsOut['lat_bnds'] = (('lat', 'nbnd'), weights['lat_bnds'])
+    dsOut['lon_bnds'] = (('lon', 'nbnd'), weights['lon_bnds'])
 
-    # set an environment variable to make sure we're not using czender's
-    # local version of NCO instead of one we have intentionally loaded
-    env = os.environ.copy()
-    env['NCO_PATH_OVERRIDE'] = 'no'
+    for coordName in ds.coords:
+        if 'nCells' not in ds.coords[coordName].dims:
+            dsOut.coords[coordName] = ds.coords[coordName]
 
-    args = ['ncremap', '-7', '--dfl_lvl=1', '--no_stdin',
-            '--no_cll_msr', '--no_frm_trm', '--no_stg_grd', '--msk_src=none',
-            '--mask_dst=none', '--map={}'.format(mappingFileName), inFileName,
-            outFileName]
+    for varName in ds.data_vars:
+        var = ds[varName]
+        if 'nCells' not in var.dims:
+            dsOut[varName] = var
+            continue
 
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE, env=env)
-    (out, err) = proc.communicate()
-    logging.info(out)
-    if(proc.returncode):
-        print("Error running ncremap command: {}".format(" ".join(args)))
-        print(err.decode('utf-8'))
-        raise subprocess.CalledProcessError(
-            'ncremap returned {}'.format(proc.returncode))
+        # move nCells to the last axis so each time chunk is a 2D block of
+        # (columns, nCells) that can be multiplied by the weight matrix
+        otherDims = [dim for dim in var.dims if dim != 'nCells']
+        var = var.transpose(*(otherDims + ['nCells']))
+        otherShape = [var.sizes[dim] for dim in otherDims]
+
+        dtype = var.dtype if np.issubdtype(var.dtype, np.floating) \
+            else np.float64
+
+        if 'time' in otherDims:
+            # remap lazily in chunks of time steps, so that each chunk is only
+            # read, masked and remapped as it is written out
+            data = var.data
+            if not isinstance(data, dask.array.Array):
+                data = dask.array.from_array(data, chunks=-1)
+            chunks = [-1]*data.ndim
+            chunks[otherDims.index('time')] = timeChunkSize
+            data = data.rechunk(tuple(chunks))
+            # the name is given explicitly so dask doesn't hash the weights
+            remapped = data.map_blocks(
+                _apply_weights, matrix, dtype,
+                chunks=data.chunks[:-1] + ((matrix.shape[0],),),
+                dtype=dtype, name='remap-{}-{}'.format(varName, uuid.uuid4()))
+        else:
+            remapped = _apply_weights(var.values, matrix, dtype)
 
-    ds = xarray.open_dataset(outFileName, decode_times=False)
+        dsOut[varName] = (otherDims + ['lat', 'lon'],
+                          remapped.reshape(tuple(otherShape) + (nLat, nLon)),
+                          var.attrs)
 
+    ds = dsOut
     if 'depth' in ds.dims:
         ds = ds.transpose('time', 'depth', 'lat', 'lon', 'nbnd')
 
-    ds.load()
-
     if 'cellMask' in ds:
         mask = ds['cellMask'] > threshold
         norm = 1./ds['cellMask'].where(mask)
@@ -71,13 +135,130 @@ def remap(ds, mappingFileName, threshold=0.05):
             if all([dim in var.dims for dim in mask.dims]):
                 ds[varName] = ds[varName].where(mask)*norm
 
-    # remove the temporary files
-    os.remove(inFileName)
-    os.remove(outFileName)
-
     return ds
 
 
+def _apply_weights(block, matrix, dtype):
+    '''Apply the remapping weights to the last axis of a block of data'''
+    shape = block.shape
+    block = block.reshape((-1, shape[-1]))
+    # missing values don't contribute to the destination cells, as when the
+    # weights are applied by ncremap
+    block = np.where(np.isfinite(block), block, 0.)
+    remapped = matrix.dot(block.T).T
+    return remapped.reshape(shape[:-1] + (matrix.shape[0],)).astype(dtype)
+
+
+def get_mapping_weights(mappingFileName, cacheDir=None):
+    '''
+    Get the weights of a SCRIP or ESMF mapping file as a sparse matrix,
+    along with the coordinates, bounds and cell areas of the destination
+    lat/lon grid.
+
+    The weights are parsed once per process, and are also saved to a .npz
+    file in cacheDir (by default the user cache directory, see
+    util.get_cache_dir) keyed by the path, size and modification time of the
+    mapping file, so the other workers and later runs load the compact arrays
+    instead of reading the mapping file again.
+    '''
+
+    key = _get_file_key(mappingFileName)
+
+    weights = _MAPPING_WEIGHTS.get(key)
+    if weights is not None:
+        return weights
+
+    if cacheDir is None:
+        cacheDir = get_cache_dir()
+    cachePath = os.path.join(cacheDir, 'mapping_weights_{}.npz'.format(key))
+
+    arrays = None
+    if os.path.exists(cachePath):
+        try:
+            with np.load(cachePath) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except (OSError, ValueError, KeyError):
+            logging.warning(
+                'Unable to load cached mapping weights {}'.format(cachePath))
+
+    if arrays is None:
+        arrays = _read_mapping_file(mappingFileName)
+        # write to a temporary name first, so a worker never loads a
+        # partially written cache from another worker
+        tmpPath = '{}.{}.npz'.format(cachePath[:-4], os.getpid())
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            np.savez(tmpPath, **arrays)
+            os.replace(tmpPath, cachePath)
+        except OSError:
+            logging.warning(
+                'Unable to cache mapping weights to {}'.format(cachePath))
+
+    nLat, nLon = [int(dim) for dim in arrays['dst_grid_dims']]
+    matrix = scipy.sparse.csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']),
+        shape=tuple(arrays['shape']))
+
+    weights = dict(matrix=matrix, dst_grid_dims=(nLat, nLon),
+                   lat=arrays['lat'], lon=arrays['lon'],
+                   lat_bnds=arrays['lat_bnds'], lon_bnds=arrays['lon_bnds'],
+                   area=arrays['area'].reshape((nLat, nLon)))
+    _MAPPING_WEIGHTS[key] = weights
+    return weights
+
+
+def _read_mapping_file(mappingFileName):
+    '''
+    Read the weights and destination grid of a SCRIP or ESMF mapping file
+    into the arrays cached by get_mapping_weights
+    '''
+
+    with netCDF4.Dataset(mappingFileName, 'r') as dsMap:
+        nA = len(dsMap.dimensions['n_a'])
+        nB = len(dsMap.dimensions['n_b'])
+
+        # row and col are one-based indices into the destination and
+        # source cells
+        S = dsMap.variables['S'][:].filled(0.)
+        row = dsMap.variables['row'][:].filled(1) - 1
+        col = dsMap.variables['col'][:].filled(1) - 1
+
+        # dst_grid_dims is in Fortran order, (nLon, nLat)
+        nLon, nLat = [int(dim) for dim in dsMap.variables['dst_grid_dims'][:]]
+
+        latCenter = _read_degrees(dsMap.variables['yc_b'])
+        lonCenter = _read_degrees(dsMap.variables['xc_b'])
+        latCorner = _read_degrees(dsMap.variables['yv_b'])
+        lonCorner = _read_degrees(dsMap.variables['xv_b'])
+        area = dsMap.variables['area_b'][:].filled(0.)
+
+    matrix = scipy.sparse.csr_matrix((S, (row, col)), shape=(nB, nA))
+
+    latCenter = latCenter.reshape((nLat, nLon))
+    lonCenter = lonCenter.reshape((nLat, nLon))
+    latCorner = latCorner.reshape((nLat, nLon, -1))
+    lonCorner = lonCorner.reshape((nLat, nLon, -1))
+
+    lat_bnds = np.zeros((nLat, 2))
+    lat_bnds[:, 0] = latCorner[:, 0, :].min(axis=-1)
+    lat_bnds[:, 1] = latCorner[:, 0, :].max(axis=-1)
+
+    # the corners are taken within 180 degrees of the cell center, so a cell
+    # straddling the 0/360 seam gets bounds like (-0.5, 0.5), not (0.5, 359.5)
+    lonCorner = lonCorner[0, :, :]
+    lonCenterRow = lonCenter[0, :, np.newaxis]
+    lonCorner = lonCenterRow + np.mod(lonCorner - lonCenterRow + 180., 360.) - 180.
+    lon_bnds = np.zeros((nLon, 2))
+    lon_bnds[:, 0] = lonCorner.min(axis=-1)
+    lon_bnds[:, 1] = lonCorner.max(axis=-1)
+
+    return dict(data=matrix.data, indices=matrix.indices,
+                indptr=matrix.indptr, shape=np.array(matrix.shape),
+                dst_grid_dims=np.array([nLat, nLon]),
+                lat=latCenter[:, 0], lon=lonCenter[0, :],
+                lat_bnds=lat_bnds, lon_bnds=lon_bnds, area=area)
+
+
 def avg_to_mid_level(ds):
     dsNew = xarray.Dataset()
     for varName in ds.data_vars:
@@ -134,8 +315,11 @@ def add_depth(ds, dsCoord):
     if 'nVertLevels' in ds.dims:
         ds = ds.rename({'nVertLevels': 'depth'})
 
-        dsCoord = dsCoord.rename({'nVertLevels': 'depth'})
-        depth, depth_bnds = _compute_depth(dsCoord.refBottomDepth)
+        depth = get_mesh_array(
+            dsCoord, 'depth', lambda: _compute_depth(dsCoord.refBottomDepth)[0])
+        depth_bnds = get_mesh_array(
+            dsCoord, 'depth_bnds',
+            lambda: _compute_depth(dsCoord.refBottomDepth)[1])
         ds.coords['depth'] = ('depth', depth)
         ds.depth.attrs['long_name'] = 'reference depth of the center of ' \
                                       'each vertical level'
@@ -197,15 +381,20 @@ def add_si_mask(ds, mask, siconc, threshold=0.05):
 def get_cell_masks(dsMesh):
     '''Get 2D and 3D masks of valid MPAS cells from the mesh Dataset'''
 
-    cellMask2D = dsMesh.maxLevelCell > 0
-
+    maxLevelCell = dsMesh.maxLevelCell
     nVertLevels = dsMesh.sizes['nVertLevels']
 
-    vertIndex = \
-        xarray.DataArray.from_dict({'dims': ('nVertLevels',),
-                                    'data': np.arange(nVertLevels)})
+    cellMask2D = get_mesh_array(
+        dsMesh, 'cellMask2D', lambda: maxLevelCell.values > 0)
+
+    cellMask3D = get_mesh_array(
+        dsMesh, 'cellMask3D',
+        lambda: np.arange(nVertLevels)[:, np.newaxis] <
+        maxLevelCell.values[np.newaxis, :])
 
-    cellMask3D = vertIndex < dsMesh.maxLevelCell
+    cellMask2D = xarray.DataArray(cellMask2D, dims=maxLevelCell.dims)
+    cellMask3D = xarray.DataArray(
+        cellMask3D, dims=('nVertLevels',) + maxLevelCell.dims)
 
     return cellMask2D, cellMask3D
 
@@ -214,11 +403,14 @@ def get_sea_floor_values(ds, dsMesh):
     '''Sample fields in the data set at the sea floor'''
 
     ds = ds.copy()
-    cellMask2D = dsMesh.maxLevelCell > 0
+    cellMask2D, _ = get_cell_masks(dsMesh)
     nVertLevels = dsMesh.sizes['nVertLevels']
 
     # zero-based indexing in python
-    maxLevelCell = dsMesh.maxLevelCell - 1
+    maxLevelCell = get_mesh_array(
+        dsMesh, 'seaFloorIndex', lambda: dsMesh.maxLevelCell.values - 1)
+    maxLevelCell = xarray.DataArray(maxLevelCell,
+                                    dims=dsMesh.maxLevelCell.dims)
 
     vertIndex = \
         xarray.DataArray.from_dict({'dims': ('nVertLevels',),
@@ -240,17 +432,166 @@ def get_sea_floor_values(ds, dsMesh):
     return ds
 
 
-def open_mfdataset(fileNames, variableList=None,
-                   chunks={'nCells': 32768, 'Time': 6}, daskThreads=6):
+def get_mesh_array(dsMesh, name, compute, cacheDir=None):
+    '''
+    Get a quantity derived from an MPAS mesh, computing it only once for all
+    the handlers of a run.
+
+    The result of compute() is kept in the process and saved as a .npy file
+    in cacheDir (by default the user cache directory, see util.get_cache_dir)
+    keyed by the path, size and modification time of the mesh file. Other workers memory-map the saved
+    file instead of computing the quantity again. Mesh datasets that weren't
+    opened from a file are not cached.
+    '''
+
+    meshFileName = dsMesh.encoding.get('source')
+    if meshFileName is None or not os.path.exists(meshFileName):
+        return compute()
+
+    key = _get_file_key(meshFileName)
+    meshData = _MESH_DATA.setdefault(key, dict())
+    if name in meshData:
+        return meshData[name]
+
+    if cacheDir is None:
+        cacheDir = get_cache_dir()
+    cachePath = os.path.join(cacheDir, 'mesh_{}_{}.npy'.format(key, name))
+
+    value = None
+    if os.path.exists(cachePath):
+        try:
+            value = np.load(cachePath, mmap_mode='r')
+        except (OSError, ValueError):
+            logging.warning(
+                'Unable to load cached mesh data {}'.format(cachePath))
+
+    if value is None:
+        value = np.asarray(compute())
+        # write to a temporary name first, so a worker never loads a
+        # partially written cache from another worker
+        tmpPath = '{}.{}.npy'.format(cachePath[:-4], os.getpid())
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            np.save(tmpPath, value)
+            os.replace(tmpPath, cachePath)
+        except OSError:
+            logging.warning(
+                'Unable to cache mesh data to {}'.format(cachePath))
+
+    meshData[name] = value
+    return value
+
+
+def configure_dask(scheduler='threads', threads=6, chunks=None, memory=None):
+    '''
+    Set the dask execution backend used by the MPAS handlers in this process.
+
+    Params:
+    -------
+        scheduler (str): 'threads', 'processes' or 'distributed' for a local
+            in-process distributed cluster
+        threads (int): the number of dask threads or processes per worker
+        chunks (dict): the chunk shape to open the MPAS time series with, by
+            default the chunks are sized from the mesh and the memory
+        memory (int): the memory in bytes available to this worker, used to
+            size the chunks
+    '''
+    if scheduler not in DASK_SCHEDULERS:
+        raise ValueError('Unexpected dask scheduler {}'.format(scheduler))
+
+    client = _DASK_CONFIG.get('client')
+    if client is not None:
+        client.close()
+    pool = _DASK_CONFIG.get('pool')
+    if pool is not None:
+        pool.close()
+        dask.config.set(pool=None)
+
+    _DASK_CONFIG.clear()
+    _DASK_CONFIG.update(scheduler=scheduler, threads=threads, chunks=chunks,
+                        memory=memory)
+
+
+def get_dask_chunks(fileNames, threads=None, memory=None):
+    '''
+    Get the chunk shape to open MPAS time series files with, sizing the
+    chunks of cells so each dask thread holds a few chunks within the memory
+    of the worker
+    '''
+    if threads is None:
+        threads = _DASK_CONFIG['threads']
+    if memory is None:
+        memory = _DASK_CONFIG['memory']
+    if not memory or not fileNames:
+        return dict(DEFAULT_DASK_CHUNKS)
+
+    try:
+        with netCDF4.Dataset(fileNames[0], 'r') as nc:
+            dims = {name: len(dim) for name, dim in nc.dimensions.items()}
+    except OSError:
+        return dict(DEFAULT_DASK_CHUNKS)
+    if 'nCells' not in dims:
+        return dict(DEFAULT_DASK_CHUNKS)
+    nCells = dims['nCells']
+    nLevels = max(1, dims.get('nVertLevels', 1), dims.get('nVertLevelsP1', 1))
+
+    chunkBytes = memory // (threads * DASK_CHUNK_MEMORY_FACTOR)
+    cells = chunkBytes // (TIME_CHUNK_SIZE * nLevels *
+                           np.dtype('float64').itemsize)
+    cells = int(min(nCells, max(MIN_DASK_CHUNK_CELLS, cells)))
+
+    return {'nCells': cells, 'Time': TIME_CHUNK_SIZE}
+
+
+def _set_dask_scheduler(daskThreads=None):
+    '''Set up the configured dask scheduler for this process'''
+    if not _DASK_CONFIG:
+        configure_dask()
+    scheduler = _DASK_CONFIG['scheduler']
+    threads = min(multiprocessing.cpu_count(),
+                  daskThreads or _DASK_CONFIG['threads'])
+
+    if scheduler == 'threads':
+        # reuse the pool, so opening several datasets doesn't leak threads
+        pool = _DASK_CONFIG.get('pool')
+        if pool is None or _DASK_CONFIG.get('poolThreads') != threads:
+            if pool is not None:
+                pool.close()
+            pool = ThreadPool(threads)
+            _DASK_CONFIG.update(pool=pool, poolThreads=threads)
+        dask.config.set(scheduler='threads', pool=pool)
+    elif scheduler == 'processes':
+        dask.config.set(scheduler='processes', num_workers=threads, pool=None)
+    elif _DASK_CONFIG.get('client') is None:
+        try:
+            from distributed import Client, LocalCluster
+        except ImportError:
+            raise ValueError('The distributed dask scheduler requires the '
+                             'distributed package')
+        cluster = LocalCluster(n_workers=1, threads_per_worker=threads,
+                               processes=False, dashboard_address=None)
+        # the client registers itself as the default dask scheduler
+        _DASK_CONFIG['client'] = Client(cluster)
+
+
+def open_mfdataset(fileNames, variableList=None, chunks=None,
+                   daskThreads=None):
     '''Open a multi-file xarray Dataset, retaining only the listed variables'''
 
-    dask.config.set(schedular='threads',
-                    pool=ThreadPool(min(multiprocessing.cpu_count(),
-                                        daskThreads)))
+    _set_dask_scheduler(daskThreads)
 
-    ds = xarray.open_mfdataset(fileNames, combine='nested', decode_cf=False,
-                               decode_times=False, concat_dim='Time',
-                               mask_and_scale=False, chunks=chunks)
+    if chunks is None:
+        chunks = _DASK_CONFIG['chunks']
+    if chunks is None:
+        if isinstance(fileNames, str):
+            fileNames = [fileNames]
+        chunks = get_dask_chunks(fileNames, threads=daskThreads)
+
+    with stage('open'):
+        ds = xarray.open_mfdataset(fileNames, combine='nested',
+                                   decode_cf=False, decode_times=False,
+                                   concat_dim='Time', mask_and_scale=False,
+                                   chunks=chunks)
 
     if variableList is not None:
         allvars = ds.data_vars.keys()
@@ -274,8 +615,14 @@ def open_mfdataset(fileNames, variableList=None,
     return ds
 
 
-def write_netcdf(ds, fileName, fillValues=netCDF4.default_fillvals, unlimited=None):
-    '''Write an xarray Dataset with NetCDF4 fill values where needed'''
+def write_netcdf(ds, fileName, fillValues=netCDF4.default_fillvals, unlimited=None,
+                 profiles=None):
+    '''
+    Write an xarray Dataset with NetCDF4 fill values where needed.  profiles
+    maps variable names to the encoding profile (deflate level, shuffle,
+    chunks and least significant digit) to write each variable with, see
+    util.get_encoding_profile
+    '''
     encodingDict = {}
     variableNames = list(ds.data_vars.keys()) + list(ds.coords.keys())
     for variableName in variableNames:
@@ -290,6 +637,12 @@ def write_netcdf(ds, fileName, fillValues=netCDF4.default_fillvals, unlimited=No
         else:
             encodingDict[variableName] = {'_FillValue': None}
 
+    if profiles:
+        for variableName, profile in profiles.items():
+            if variableName in ds:
+                encodingDict.setdefault(variableName, {}).update(
+                    get_netcdf_encoding(ds[variableName], profile))
+
     update_history(ds)
 
     if unlimited:
@@ -298,6 +651,107 @@ def write_netcdf(ds, fileName, fillValues=netCDF4.default_fillvals, unlimited=No
         ds.to_netcdf(fileName, encoding=encodingDict)
 
 
+def get_netcdf_encoding(var, profile):
+    '''
+    Get the NetCDF4 encoding of an xarray DataArray for an encoding profile.
+    Chunk sizes are capped to the size of each dimension, and dimensions
+    missing from the profile are stored in a single chunk
+    '''
+    encoding = {}
+    if profile.get('deflate_level'):
+        encoding['zlib'] = True
+        encoding['complevel'] = profile['deflate_level']
+    if 'shuffle' in profile:
+        encoding['shuffle'] = profile['shuffle']
+    chunks = profile.get('chunks')
+    if chunks and var.ndim > 0:
+        encoding['chunksizes'] = tuple(
+            max(1, min(chunks.get(dim, size), size))
+            for dim, size in zip(var.dims, var.shape))
+    digits = profile.get('least_significant_digit')
+    if digits is not None and np.issubdtype(var.dtype, np.floating):
+        encoding['least_significant_digit'] = digits
+    return encoding
+
+
+def write_zarr(ds, storeName, fillValues=netCDF4.default_fillvals,
+               appendDim=None, chunks=None, profiles=None):
+    '''
+    Write an xarray Dataset to a zarr store with consolidated metadata.  The
+    first call creates the store, later calls with appendDim append the
+    variables along that dimension.  chunks sets the chunk size of each
+    dimension when the store is created (the full size by default), and
+    takes precedence over the chunks of the profiles.  profiles maps variable
+    names to the encoding profile to write each variable with, as in
+    write_netcdf
+    '''
+    if appendDim is not None:
+        # appending replaces the global attributes, so keep those of the store
+        with xarray.open_zarr(storeName, consolidated=True) as dsStore:
+            attrs = dict(dsStore.attrs)
+        ds = ds.copy(deep=False)
+        ds.attrs = attrs
+        ds.to_zarr(storeName, mode='a', append_dim=appendDim,
+                   consolidated=True)
+        return
+
+    if chunks is None:
+        chunks = {}
+    if profiles is None:
+        profiles = {}
+    encodingDict = {}
+    variableNames = list(ds.data_vars.keys()) + list(ds.coords.keys())
+    for variableName in variableNames:
+        var = ds[variableName]
+        profile = profiles.get(variableName, {})
+        # the chunks of the profile are capped to the size of each dimension,
+        # as they are for netcdf
+        varChunks = {dim: max(1, min(size, var.sizes[dim])) for dim, size in
+                     (profile.get('chunks') or {}).items() if dim in var.dims}
+        varChunks.update(chunks)
+        encodingDict[variableName] = {
+            'chunks': tuple(varChunks.get(dim, size)
+                            for dim, size in zip(var.dims, var.shape))}
+        isNumeric = np.issubdtype(var.dtype, np.number)
+        if isNumeric:
+            for fillType in fillValues:
+                if var.dtype == np.dtype(fillType):
+                    encodingDict[variableName]['_FillValue'] = \
+                        fillValues[fillType]
+                    break
+        else:
+            encodingDict[variableName]['_FillValue'] = None
+        encodingDict[variableName].update(get_zarr_encoding(var, profile))
+
+    update_history(ds)
+
+    ds.to_zarr(storeName, mode='w', encoding=encodingDict, consolidated=True)
+
+
+def get_zarr_encoding(var, profile):
+    '''
+    Get the zarr compressor and filters of an xarray DataArray for an
+    encoding profile, matching the NetCDF4 encoding of get_netcdf_encoding:
+    zlib compression at the deflate level (none for level 0), a byte shuffle
+    filter and quantization to the least significant digit.  Without a
+    deflate level the default compressor of zarr is kept
+    '''
+    import numcodecs
+    encoding = {}
+    if profile.get('deflate_level') is not None:
+        level = profile['deflate_level']
+        encoding['compressor'] = numcodecs.Zlib(level=level) if level else None
+    filters = []
+    digits = profile.get('least_significant_digit')
+    if digits is not None and np.issubdtype(var.dtype, np.floating):
+        filters.append(numcodecs.Quantize(digits=digits, dtype=var.dtype))
+    if profile.get('shuffle'):
+        filters.append(numcodecs.Shuffle(elementsize=var.dtype.itemsize))
+    if filters:
+        encoding['filters'] = filters
+    return encoding
+
+
 def update_history(ds):
     '''Add or append history to attributes of a data set'''
 
@@ -324,16 +778,10 @@ def convert_namelist_to_dict(fileName):
 
 
 def setup_cmor(varname, tables, user_input_path, component='ocean', table=None):
-    '''Set up CMOR for MPAS-Ocean or MPAS-Seaice'''
-    logfile = os.path.join(os.getcwd(), 'cmor_logs')
-    if not os.path.exists(logfile):
-        os.makedirs(logfile)
-    logfile = os.path.join(logfile, varname + '.log')
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-    cmor.dataset_json(str(user_input_path))
+    '''
+    Set up CMOR for MPAS-Ocean or MPAS-Seaice, reusing the CMOR session and
+    tables of this process
+    '''
     if table is None:
         if component == 'ocean':
             table = 'CMIP6_Omon.json'
@@ -341,44 +789,70 @@ def setup_cmor(varname, tables, user_input_path, component='ocean', table=None):
             table = 'CMIP6_SImon.json'
         else:
             raise ValueError('Unexpected component {}'.format(component))
-    try:
-        cmor.load_table(table)
-    except Exception:
-        raise ValueError('Unable to load table from {}'.format(varname))
+    with stage('cmor_setup'):
+        try:
+            setup_cmor_session(tables, user_input_path, table,
+                               os.path.join(os.getcwd(), 'cmor_logs'))
+        except Exception:
+            raise ValueError('Unable to load table from {}'.format(varname))
 
 
-def write_cmor(axes, ds, varname, varunits, d2f=True, **kwargs):
-    '''Write a time series of a variable in the format expected by CMOR'''
+def write_cmor(axes, ds, varname, varunits, d2f=True,
+               timeChunkSize=TIME_CHUNK_SIZE, **kwargs):
+    '''
+    Write a time series of a variable in the format expected by CMOR,
+    computing and appending timeChunkSize time steps at a time
+    '''
+    import cmor
     axis_ids = list()
     for axis in axes:
         axis_id = cmor.axis(**axis)
         axis_ids.append(axis_id)
 
-    if d2f and ds[varname].dtype == np.float64:
-        print('Converting {} to float32'.format(varname))
-        ds[varname] = ds[varname].astype(np.float32)
-
     fillValue = netCDF4.default_fillvals['f4']
-    if np.any(np.isnan(ds[varname])):
-        mask = np.isfinite(ds[varname])
-        ds[varname] = ds[varname].where(mask, fillValue)
 
     # create the cmor variable
     varid = cmor.variable(str(varname), str(varunits), axis_ids,
                           missing_value=fillValue, **kwargs)
+    set_cmor_deflate(varid, varname)
+
+    if d2f and ds[varname].dtype == np.float64:
+        print('Converting {} to float32'.format(varname))
+
+    def get_values(var):
+        values = var.values
+        if d2f and values.dtype == np.float64:
+            values = values.astype(np.float32)
+        if np.any(np.isnan(values)):
+            values = np.where(np.isfinite(values), values,
+                              fillValue).astype(values.dtype)
+        return values
 
     # write out the data
     try:
         if 'time' not in ds.dims:
-            cmor.write(
-                varid,
-                ds[varname].values)
+            with stage('compute'):
+                values = get_values(ds[varname])
+            with stage('cmor_write'):
+                cmor.write(varid, values)
+            report_progress(varname, 1, values.nbytes)
         else:
-            cmor.write(
-                varid,
-                ds[varname].values,
-                time_vals=ds.time.values,
-                time_bnds=ds.time_bnds.values)
+            nTime = ds.sizes['time']
+            for start in range(0, nTime, timeChunkSize):
+                timeSlice = slice(start, min(start + timeChunkSize, nTime))
+                dsChunk = ds.isel(time=timeSlice)
+                # reading, masking and remapping the chunk happen here
+                with stage('compute'):
+                    values = get_values(dsChunk[varname])
+                    timeVals = dsChunk.time.values
+                    timeBnds = dsChunk.time_bnds.values
+                with stage('cmor_write'):
+                    cmor.write(
+                        varid,
+                        values,
+                        time_vals=timeVals,
+                        time_bnds=timeBnds)
+                report_progress(varname, len(timeVals), values.nbytes)
     except Exception as error:
         logging.exception('Error in cmor.write for {}'.format(varname))
         raise
@@ -482,41 +956,118 @@ def compute_moc_streamfunction(dsIn=None, dsMesh=None, dsMasks=None,
         return dsOut
 
 
-def interp_vertex_to_cell(varOnVertices, dsMesh):
-    """ Interpolate a 2D field on vertices to MPAS cell centers """
-    nCells = dsMesh.sizes['nCells']
-    vertexDegree = dsMesh.sizes['vertexDegree']
-    maxEdges = dsMesh.sizes['maxEdges']
+def interp_vertex_to_cell(varOnVertices, dsMesh, timeChunkSize=TIME_CHUNK_SIZE):
+    """
+    Interpolate a 2D field on vertices to MPAS cell centers.  Fields with
+    a time dimension are interpolated lazily, in chunks of timeChunkSize
+    time steps, and keep the dtype of the input
+    """
+
+    operator = get_vertex_to_cell_operator(dsMesh)
+
+    # move nVertices to the last axis so each chunk of time steps is a 2D
+    # block of (times, nVertices) that can be multiplied by the operator
+    otherDims = [dim for dim in varOnVertices.dims if dim != 'nVertices']
+    varOnVertices = varOnVertices.transpose(*(otherDims + ['nVertices']))
+    nCells = operator.shape[0]
+
+    dtype = varOnVertices.dtype \
+        if np.issubdtype(varOnVertices.dtype, np.floating) else np.float64
+
+    if otherDims:
+        data = varOnVertices.data
+        if not isinstance(data, dask.array.Array):
+            data = dask.array.from_array(data, chunks=-1)
+        chunks = [-1]*data.ndim
+        chunks[0] = timeChunkSize
+        data = data.rechunk(tuple(chunks))
+        # the name is given explicitly so dask doesn't hash the operator
+        varOnCells = data.map_blocks(
+            _apply_vertex_to_cell, operator, dtype,
+            chunks=data.chunks[:-1] + ((nCells,),), dtype=dtype,
+            name='vertex-to-cell-{}'.format(uuid.uuid4()))
+    else:
+        varOnCells = _apply_vertex_to_cell(varOnVertices.values, operator,
+                                           dtype)
+
+    coords = {name: coord for name, coord in varOnVertices.coords.items()
+              if 'nVertices' not in coord.dims}
+
+    return xarray.DataArray(varOnCells, dims=otherDims + ['nCells'],
+                            coords=coords)
+
+
+def _apply_vertex_to_cell(block, operator, dtype):
+    '''Apply the vertex to cell operator to the last axis of a block of data'''
+    shape = block.shape
+    block = block.reshape((-1, shape[-1]))
+    varOnCells = operator.dot(block.T).T
+    return varOnCells.reshape(shape[:-1] + (operator.shape[0],)).astype(
+        dtype, copy=False)
+
+
+def get_vertex_to_cell_operator(dsMesh):
+    '''
+    Get a sparse matrix of shape (nCells, nVertices) that interpolates a field
+    on MPAS vertices to cell centers, weighting each vertex of a cell by its
+    kite area
+    '''
+
+    arrays = dict()
+
+    def compute_operator():
+        if arrays:
+            return arrays
+        nCells = dsMesh.sizes['nCells']
+        maxEdges = dsMesh.sizes['maxEdges']
 
-    kiteAreas = dsMesh.kiteAreasOnVertex.values
-    verticesOnCell = dsMesh.verticesOnCell.values-1
-    cellsOnVertex = dsMesh.cellsOnVertex.values-1
+        kiteAreas = dsMesh.kiteAreasOnVertex.values
+        verticesOnCell = dsMesh.verticesOnCell.values-1
+        cellsOnVertex = dsMesh.cellsOnVertex.values-1
+        areaCell = dsMesh.areaCell.values
 
-    cellIndices = np.arange(nCells)
+        cells = np.repeat(np.arange(nCells), maxEdges)
+        vertices = verticesOnCell.ravel()
+        valid = vertices >= 0
+        cells = cells[valid]
+        vertices = vertices[valid]
 
-    weights = np.zeros((nCells, maxEdges))
-    for iVertex in range(maxEdges):
-        vertices = verticesOnCell[:, iVertex]
-        mask1 = vertices > 0
-        for iCell in range(vertexDegree):
-            mask2 = np.equal(cellsOnVertex[vertices, iCell], cellIndices)
-            mask = np.logical_and(mask1, mask2)
-            weights[:, iVertex] += mask * kiteAreas[vertices, iCell]
+        # the kite area of each vertex that belongs to the cell
+        mask = cellsOnVertex[vertices, :] == cells[:, np.newaxis]
+        weights = (mask*kiteAreas[vertices, :]).sum(axis=1)/areaCell[cells]
 
-    weights =  \
-        xarray.DataArray.from_dict({'dims': ('nCells', 'maxEdges'),
-                                    'data': weights})
+        operator = scipy.sparse.csr_matrix(
+            (weights, (cells, vertices)),
+            shape=(nCells, dsMesh.sizes['nVertices']))
+        arrays.update(data=operator.data, indices=operator.indices,
+                      indptr=operator.indptr,
+                      shape=np.array(operator.shape))
+        return arrays
 
-    weights /= dsMesh.areaCell
+    data, indices, indptr, shape = [
+        get_mesh_array(dsMesh, 'vertexToCell_{}'.format(name),
+                       lambda name=name: compute_operator()[name])
+        for name in ['data', 'indices', 'indptr', 'shape']]
 
-    varOnVertices = varOnVertices.chunk(chunks={'nVertices': None, 'Time': 36})
+    return scipy.sparse.csr_matrix((data, indices, indptr),
+                                   shape=tuple(shape))
 
-    varOnCells = (varOnVertices[:, dsMesh.verticesOnCell-1]*weights).sum(
-        dim='maxEdges')
 
-    varOnCells.compute()
+def _get_file_key(fileName):
+    '''Get a key for caching data derived from a file'''
+    stat = os.stat(fileName)
+    return hashlib.sha1('{}:{}:{}'.format(
+        os.path.abspath(fileName), stat.st_size,
+        stat.st_mtime_ns).encode('utf-8')).hexdigest()
 
-    return varOnCells
+
+def _read_degrees(var):
+    '''Read a coordinate from a mapping file in degrees'''
+    values = np.asarray(var[:], dtype=float)
+    units = getattr(var, 'units', 'degrees')
+    if units.lower().startswith('rad'):
+        values = np.rad2deg(values)
+    return values
 
 
 def _string_to_days_since_date(dateStrings, referenceDate='0001-01-01'):
@@ -634,12 +1185,12 @@ def _compute_depth(refBottomDepth):
 
 def _compute_moc_time_series(normalVelocity, vertVelocityTop,
                              layerThicknessEdge, dsMesh, dsMasks,
-                             showProgress):
+                             showProgress, timeChunkSize=12):
     '''compute MOC time series as a post-process'''
 
     dvEdge = dsMesh.dvEdge
-    areaCell = dsMesh.areaCell
-    latCell = np.rad2deg(dsMesh.latCell)
+    areaCell = dsMesh.areaCell.values
+    latCell = np.rad2deg(dsMesh.latCell.values)
     nTime = normalVelocity.sizes['Time']
     nCells = dsMesh.sizes['nCells']
     nVertLevels = dsMesh.sizes['nVertLevels']
@@ -656,22 +1207,15 @@ def _compute_moc_time_series(normalVelocity, vertVelocityTop,
     lat_bnds[:, 0] = lat[0:-1]
     lat_bnds[:, 1] = lat[1:]
     lat = 0.5*(lat_bnds[:, 0] + lat_bnds[:, 1])
-
-    lat_bnds = xarray.DataArray(lat_bnds, dims=('lat', 'nbnd'))
-    lat = xarray.DataArray(lat, dims=('lat',))
+    nLat = len(lat)
 
     depth, depth_bnds = _compute_depth(dsMesh.refBottomDepth)
 
-    depth_bnds = xarray.DataArray(depth_bnds, dims=('depth', 'nbnd'))
-    depth = xarray.DataArray(depth, dims=('depth',))
+    # the southern boundary transport of each region, zero for the globe
+    transport = np.zeros((nRegions, nTime, nVertLevels))
 
-    transport = {}
-    transport['Global'] = xarray.DataArray(np.zeros((nTime, nVertLevels)),
-                                           dims=('Time', 'nVertLevels',))
-
-    cellMasks = {}
-    cellMasks['Global'] = xarray.DataArray(np.ones(nCells),
-                                           dims=('nCells',))
+    cellMasks = np.zeros((nRegions, nCells), dtype=bool)
+    cellMasks[0, :] = True
 
     for regionIndex in range(1, nRegions):
         regionName = regionNames[regionIndex]
@@ -683,52 +1227,69 @@ def _compute_moc_time_series(normalVelocity, vertVelocityTop,
         v = normalVelocity[:, edgeIndices, :]
         h = layerThicknessEdge[:, edgeIndices, :]
         dv = dvEdge[edgeIndices]
-        transport[regionName] = (v*h*dv*edgeSigns).sum(
-            dim='maxEdgesInTransect')
-
-        _compute_dask(transport[regionName], showProgress,
-                      'Computing transport through southern boundary of '
-                      '{}'.format(regionName))
-
-        cellMasks[regionName] = dsMask.regionCellMasks
-        cellMasks[regionName].compute()
-
-    mocs = {}
-
-    for regionName in regionNames:
-        mocSlice = np.zeros((nTime, nVertLevels+1))
-        mocSlice[:, 1:] = transport[regionName].cumsum(
-            dim='nVertLevels').values
-
-        mocSlice = xarray.DataArray(mocSlice,
-                                    dims=('Time', 'nVertLevelsP1'))
-        mocSlices = [mocSlice]
-        binCounts = []
-        for iLat in range(lat_bnds.sizes['lat']):
-            mask = np.logical_and(np.logical_and(
-                cellMasks[regionName] == 1, latCell >= lat_bnds[iLat, 0]),
-                latCell < lat_bnds[iLat, 1])
-            binCounts.append(np.count_nonzero(mask))
-            mocTop = mocSlices[iLat] + (vertVelocityTop[:, mask, :] *
-                                        areaCell[mask]).sum(dim='nCells')
-            mocSlices.append(mocTop)
-
-        moc = xarray.concat(mocSlices, dim='lat')
-        moc = moc.transpose('Time', 'nVertLevelsP1', 'lat')
-        # average to bin and level centers
-        moc = 0.25*(moc[:, 0:-1, 0:-1] + moc[:, 0:-1, 1:] +
-                    moc[:, 1:, 0:-1] + moc[:, 1:, 1:])
-        moc = moc.rename({'nVertLevelsP1': 'depth'})
-        binCounts = xarray.DataArray(binCounts, dims=('lat'))
-        moc = moc.where(binCounts > 0)
-
-        _compute_dask(moc, showProgress, 'Computing {} MOC'.format(regionName))
-
-        mocs[regionName] = moc
-
-    mocs = xarray.concat(mocs.values(), dim='basin')
-    mocs = mocs.transpose('Time', 'basin', 'depth', 'lat')
+        regionTransport = (v*h*dv*edgeSigns).sum(dim='maxEdgesInTransect')
+
+        regionTransport = _compute_dask(
+            regionTransport, showProgress,
+            'Computing transport through southern boundary of '
+            '{}'.format(regionName))
+        transport[regionIndex] = regionTransport.values
+
+        cellMasks[regionIndex, :] = dsMask.regionCellMasks.values == 1
+
+    # assign each cell to its latitude bin once; cells outside all bins
+    # (exactly at the north pole) don't contribute
+    binIndices = np.floor((latCell - lat_bnds[0, 0])/latBinSize).astype(int)
+    inBin = np.logical_and(latCell >= lat_bnds[0, 0],
+                           latCell < lat_bnds[-1, 1])
+    inBin = np.logical_and(inBin, binIndices < nLat)
+
+    # a sparse matrix summing the area-weighted vertical velocity of the
+    # cells in each region and latitude bin
+    regionIndices, cellIndices = np.nonzero(
+        np.logical_and(cellMasks, inBin[np.newaxis, :]))
+    rows = regionIndices*nLat + binIndices[cellIndices]
+    binMatrix = scipy.sparse.csr_matrix(
+        (areaCell[cellIndices], (rows, cellIndices)),
+        shape=(nRegions*nLat, nCells))
+    binCounts = np.bincount(rows, minlength=nRegions*nLat).reshape(
+        (nRegions, nLat))
 
+    if showProgress:
+        print('Computing MOC for {}'.format(', '.join(regionNames)))
+
+    nVertLevelsP1 = vertVelocityTop.sizes['nVertLevelsP1']
+    vertVelocityTop = vertVelocityTop.transpose('Time', 'nCells',
+                                                'nVertLevelsP1')
+    binnedTransport = np.zeros((nRegions, nLat, nTime, nVertLevelsP1))
+    for start in range(0, nTime, timeChunkSize):
+        timeSlice = slice(start, min(start + timeChunkSize, nTime))
+        block = vertVelocityTop.isel(Time=timeSlice).values
+        nBlock = block.shape[0]
+        block = block.transpose(1, 0, 2).reshape((nCells, -1))
+        binnedTransport[:, :, timeSlice, :] = binMatrix.dot(block).reshape(
+            (nRegions, nLat, nBlock, nVertLevelsP1))
+
+    # the streamfunction at the southern edge of each bin is the transport
+    # through the southern boundary plus the cumulative transport of the
+    # bins to the south
+    moc = np.zeros((nRegions, nLat+1, nTime, nVertLevelsP1))
+    moc[:, :, :, 1:] = np.cumsum(transport, axis=2)[:, np.newaxis, :, :]
+    moc[:, 1:, :, :] += np.cumsum(binnedTransport, axis=1)
+
+    # average to bin and level centers
+    moc = 0.25*(moc[:, 0:-1, :, 0:-1] + moc[:, 1:, :, 0:-1] +
+                moc[:, 0:-1, :, 1:] + moc[:, 1:, :, 1:])
+    moc = np.where((binCounts > 0)[:, :, np.newaxis, np.newaxis], moc,
+                   np.nan)
+
+    mocs = xarray.DataArray(moc.transpose(2, 0, 3, 1),
+                            dims=('Time', 'basin', 'depth', 'lat'))
+
+    lat_bnds = xarray.DataArray(lat_bnds, dims=('lat', 'nbnd'))
+    lat = xarray.DataArray(lat, dims=('lat',))
+    depth_bnds = xarray.DataArray(depth_bnds, dims=('depth', 'nbnd'))
+    depth = xarray.DataArray(depth, dims=('depth',))
     regionNames = xarray.DataArray(regionNames, dims=('basin',))
 
     coords = dict(lat=lat, lat_bnds=lat_bnds, depth=depth,
@@ -742,16 +1303,7 @@ def _compute_dask(ds, showProgress, message):
     if showProgress:
         print(message)
         with ProgressBar():
-            ds.compute()
+            return ds.compute()
     else:
-        ds.compute()
-
-
-def _get_temp_path():
-    '''Returns the name of a temporary NetCDF file'''
-    tmpdir = tempfile.gettempdir()
-    tmpfile = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False)
-    tmpname = tmpfile.name
-    tmpfile.close()
+        return ds.compute()
 
-    return tmpname
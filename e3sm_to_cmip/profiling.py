@@ -0,0 +1,255 @@
+"""
+Per-stage timing of the handlers: wall time, CPU time, bytes read and written,
+and the resident memory of each stage of each handler
+"""
+
+import cProfile
+import contextlib
+import csv
+import json
+import os
+import re
+import resource
+import sys
+import time
+
+# the columns of the timing report. rss is the resident memory of the process
+# as the stage ends and rss_growth how much it grew during the stage, the
+# largest of each over the calls of the stage. process_peak_rss is the high
+# water mark of the whole process up to the end of the stage, which includes
+# the handlers the process ran before
+REPORT_FIELDS = ['handler', 'stage', 'calls', 'wall', 'cpu', 'bytes_read',
+                 'bytes_written', 'rss', 'rss_growth', 'process_peak_rss', 'pid']
+
+# the profiling state of this process, see configure_profiling
+_PROFILE = dict(enabled=False, profile_dir=None, handler=None)
+
+# the stage records of this process, keyed by handler and stage name
+_RECORDS = dict()
+
+
+def configure_profiling(enabled=False, profile_dir=None):
+    """
+    Turns the stage timing of this process on or off, and clears the records of
+    the process, which forked workers would otherwise inherit from the main process
+
+    Params:
+    -------
+        enabled (bool): record the timing of the stages
+        profile_dir (str): if set, each handler is also run under cProfile and
+            its statistics are dumped to a file in this directory
+    """
+    _PROFILE.update(enabled=enabled, profile_dir=profile_dir)
+    _RECORDS.clear()
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+# ------------------------------------------------------------------
+
+
+def _read_io_bytes():
+    """
+    Returns the bytes read and written by this process so far, from
+    /proc/self/io, or zeros if it isn't available
+    """
+    counters = dict()
+    try:
+        with open('/proc/self/io', 'r') as instream:
+            for line in instream:
+                name, _, value = line.partition(':')
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+# ------------------------------------------------------------------
+
+
+def _get_peak_rss():
+    """
+    Returns the peak resident memory of this process in bytes, over its whole lifetime
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+# ------------------------------------------------------------------
+
+
+def _get_rss():
+    """
+    Returns the current resident memory of this process in bytes, from
+    /proc/self/statm, or the peak resident memory if it isn't available
+    """
+    try:
+        with open('/proc/self/statm', 'r') as instream:
+            return int(instream.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return _get_peak_rss()
+# ------------------------------------------------------------------
+
+
+@contextlib.contextmanager
+def stage(name, handler=None):
+    """
+    Records the wall time, CPU time, bytes read and written and the resident
+    memory of the code run in the context, as a stage of the current handler. Repeated
+    stages of a handler are summed, nested stages are also counted in the
+    enclosing stage. Nothing is recorded unless profiling is enabled
+
+    Params:
+    -------
+        name (str): the name of the stage
+        handler (str): the handler to record the stage for, by default the
+            handler being run by run_profiled
+    """
+    handler = handler or _PROFILE['handler']
+    if not _PROFILE['enabled'] or handler is None:
+        yield
+        return
+
+    read_start, written_start = _read_io_bytes()
+    rss_start = _get_rss()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        read_end, written_end = _read_io_bytes()
+        rss_end = _get_rss()
+        add_records([{
+            'handler': handler,
+            'stage': name,
+            'calls': 1,
+            'wall': wall,
+            'cpu': cpu,
+            'bytes_read': read_end - read_start,
+            'bytes_written': written_end - written_start,
+            'rss': rss_end,
+            'rss_growth': max(rss_end - rss_start, 0),
+            'process_peak_rss': _get_peak_rss(),
+            'pid': os.getpid()
+        }])
+# ------------------------------------------------------------------
+
+
+def add_records(records):
+    """
+    Adds stage records to the records of this process, summing the records
+    of the same stage of a handler
+
+    Params:
+    -------
+        records (list(dict)): the stage records, as returned by get_records
+    """
+    for record in records:
+        key = (record['handler'], record['stage'])
+        total = _RECORDS.get(key)
+        if total is None:
+            _RECORDS[key] = dict(record)
+            continue
+        for field in ['calls', 'wall', 'cpu', 'bytes_read', 'bytes_written']:
+            total[field] += record[field]
+        for field in ['rss', 'rss_growth', 'process_peak_rss']:
+            total[field] = max(total[field], record[field])
+# ------------------------------------------------------------------
+
+
+def get_records():
+    """
+    Returns the stage records of this process
+    """
+    return [dict(record) for record in _RECORDS.values()]
+# ------------------------------------------------------------------
+
+
+def run_profiled(label, method, *args, **kwargs):
+    """
+    Runs a handler method with its stages recorded under the given label, if
+    profiling is enabled. The runners call the handlers through this, and it
+    returns the records of the handler along with its result so the records of
+    the workers can be collected in the main process. Each label should only be
+    run once per process
+
+    Params:
+    -------
+        label (str): the name to record the stages of the handler under
+        method (function): the handler method
+        args, kwargs: the arguments to the handler method
+    Returns:
+    --------
+        (result, records): the return value of the handler, and its stage records
+    """
+    _PROFILE['handler'] = label
+
+    profiler = None
+    if _PROFILE['enabled'] and _PROFILE['profile_dir']:
+        profiler = cProfile.Profile()
+    try:
+        with stage('total'):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    finally:
+        _PROFILE['handler'] = None
+        if profiler is not None:
+            name = re.sub(r'[^\w.-]', '_', label)
+            profiler.dump_stats(os.path.join(
+                _PROFILE['profile_dir'], f'{name}_{os.getpid()}.prof'))
+
+    if not _PROFILE['enabled']:
+        return result, []
+    return result, [record for record in get_records() if record['handler'] == label]
+# ------------------------------------------------------------------
+
+
+def write_report(path, records=None):
+    """
+    Writes the stage records to a json file, or a csv file if the path ends with .csv
+
+    Params:
+    -------
+        path (str): the path to the report
+        records (list(dict)): the stage records, by default the records of this process
+    """
+    if records is None:
+        records = get_records()
+    records = sorted(records, key=lambda record: (record['handler'], record['stage']))
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as outstream:
+            writer = csv.DictWriter(outstream, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path, 'w') as outstream:
+            json.dump(records, outstream, indent=2)
+# ------------------------------------------------------------------
+
+
+def format_summary(records=None):
+    """
+    Returns a table of the stage records, with the times in seconds and the
+    bytes and memory in MB. The memory is the resident memory at the end of the
+    stage and its growth during the stage
+
+    Params:
+    -------
+        records (list(dict)): the stage records, by default the records of this process
+    """
+    if records is None:
+        records = get_records()
+    records = sorted(records, key=lambda record: (record['handler'], record['stage']))
+    width = max([len('handler')] + [len(record['handler']) for record in records])
+    lines = [f"{'handler':<{width}}  {'stage':<12} {'calls':>6} {'wall':>9} {'cpu':>9} "
+             f"{'read MB':>10} {'write MB':>10} {'rss MB':>9} {'growth MB':>10}"]
+    for record in records:
+        lines.append(
+            f"{record['handler']:<{width}}  {record['stage']:<12} {record['calls']:>6} "
+            f"{record['wall']:>9.2f} {record['cpu']:>9.2f} "
+            f"{record['bytes_read'] / 1024**2:>10.1f} {record['bytes_written'] / 1024**2:>10.1f} "
+            f"{record['rss'] / 1024**2:>9.1f} {record['rss_growth'] / 1024**2:>10.1f}")
+    return '\n'.join(lines)
+# ------------------------------------------------------------------
@@ -1,16 +1,20 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import sys
+import ast
+import functools
+import hashlib
+import pickle
 import traceback
-import cmor
+import importlib
 import os
 import re
 import argparse
 import imp
 import yaml
 import json
-import xarray as xr
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from pprint import pprint
 from tqdm import tqdm
@@ -27,6 +31,53 @@ LAND_TABLES = ['CMIP6_Lmon.json', 'CMIP6_LImon.json']
 OCEAN_TABLES = ['CMIP6_Omon.json', 'CMIP6_Ofx.json']
 SEAICE_TABLES = ['CMIP6_SImon.json']
 
+# time series files are named VAR_YYYYMM_YYYYMM.nc
+ATM_FILE_PATTERN = r'(?P<var>.+)\_(?P<start>\d{6})\_(?P<end>\d{6})\.nc'
+
+# journal of the variables and input files committed to the output directory
+CHECKPOINT_NAME = 'checkpoint.jsonl'
+
+# the environment variables that limit the threads of the BLAS and OpenMP
+# libraries used by numpy and scipy
+THREAD_LIMIT_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                     'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# directory listings shared by all the file lookups in this process, see get_directory_index
+_DIRECTORY_INDEX = dict()
+
+# the module attributes recorded for each handler by get_handler_registry
+HANDLER_ATTRIBUTES = ['VAR_NAME', 'VAR_UNITS', 'RAW_VARIABLES', 'TABLE', 'LEVELS', 'POSITIVE']
+
+# the layout of the cached handler registries, cached registries with another
+# layout are rebuilt
+REGISTRY_FORMAT = 2
+
+# handler registries loaded by this process, see get_handler_registry
+_HANDLER_REGISTRY = dict()
+
+# the settings an output encoding profile can hold, see load_encoding_profiles
+ENCODING_KEYS = ['deflate_level', 'shuffle', 'chunks', 'least_significant_digit']
+
+# the encoding profiles of the outputs written by this process, see configure_encoding
+_ENCODING_PROFILES = dict()
+
+# the settings a unit conversion can hold, see get_unit_conversions
+UNIT_CONVERSION_KEYS = ['scale', 'divisor', 'offset', 'sign']
+
+# the unit conversions of the default handlers, parsed once per process
+_UNIT_CONVERSIONS = dict()
+
+# CMOR holds at most 1500 axes and 500 variables (including z-factors) until it
+# is set up again, so a session is only reused while the estimated axes and
+# variables of its handlers stay under these budgets
+CMOR_SESSION_MAX_AXES = 1200
+CMOR_SESSION_MAX_VARIABLES = 400
+
+# the CMOR session of this process, the tables path it was set up with, the ids
+# of the tables it has loaded and the estimated axes and variables defined in
+# it, see setup_cmor_session
+_CMOR_SESSION = dict(inpath=None, logfile=None, tables=dict(), axes=0, variables=0)
+
 def print_debug(e):
     _, _, tb = sys.exc_info()
     traceback.print_tb(tb)
@@ -68,23 +119,105 @@ def setup_cmor(var_name, table_path, table_name, user_input_path):
     """
     Sets up cmor and logging for a single handler
     """
-    var_name = str(var_name)
-    table_path = str(table_path)
-    table_name = str(table_name)
-    user_input_path = str(user_input_path)
+    setup_cmor_session(
+        tables_path=table_path,
+        metadata_path=user_input_path,
+        table=table_name,
+        logdir=os.path.join(os.getcwd(), 'logs'))
+# ------------------------------------------------------------------
+
+
+def setup_cmor_session(tables_path, metadata_path, table, logdir, num_axes=8, num_variables=6):
+    """
+    Sets up CMOR for a handler, reusing the CMOR session of this process. CMOR is
+    only set up again for a new tables path, or once the axes and variables the
+    handlers define would run past the CMOR_SESSION budgets, and logs to a
+    cmor_PID.log file in the log directory of the handler that set it up. Each
+    table is only loaded once per session, and made the current table again with
+    set_table for later handlers. The dataset metadata is reloaded for each handler.
+    The handlers close their variables with cmor.close(varid), which keeps the
+    session open
+
+    Params:
+    -------
+        tables_path (str): path to the CMIP6 tables
+        metadata_path (str): path to the cmor input metadata
+        table (str): the name of the table of the handler, e.g. CMIP6_Amon.json
+        logdir (str): the directory for the CMOR log of the process
+        num_axes (int): the most axes the handler defines, the default fits a
+            handler writing a single output file, see estimate_cmor_definitions
+        num_variables (int): the most variables and z-factors the handler defines
+    Returns:
+    --------
+        the CMOR id of the table
+    """
+    import cmor
+    tables_path = str(tables_path)
+    table = str(table)
+
+    # a handler that defines more than a session holds gets a new session to itself
+    num_axes = min(num_axes, CMOR_SESSION_MAX_AXES)
+    num_variables = min(num_variables, CMOR_SESSION_MAX_VARIABLES)
+
+    if _CMOR_SESSION['inpath'] != tables_path \
+            or _CMOR_SESSION['axes'] + num_axes > CMOR_SESSION_MAX_AXES \
+            or _CMOR_SESSION['variables'] + num_variables > CMOR_SESSION_MAX_VARIABLES:
+        end_cmor_session()
+        os.makedirs(logdir, exist_ok=True)
+        logfile = os.path.join(logdir, f'cmor_{os.getpid()}.log')
+        cmor.setup(
+            inpath=tables_path,
+            netcdf_file_action=cmor.CMOR_REPLACE,
+            logfile=logfile)
+        _CMOR_SESSION.update(inpath=tables_path, logfile=logfile, tables=dict())
+    _CMOR_SESSION['axes'] += num_axes
+    _CMOR_SESSION['variables'] += num_variables
+
+    cmor.dataset_json(str(metadata_path))
+
+    table_id = _CMOR_SESSION['tables'].get(table)
+    if table_id is None:
+        table_id = cmor.load_table(table)
+        _CMOR_SESSION['tables'][table] = table_id
+    else:
+        cmor.set_table(table_id)
+    return table_id
+# ------------------------------------------------------------------
+
+
+def estimate_cmor_definitions(tables_path, table, variable, num_files, num_zfactors=0):
+    """
+    Returns the number of axes and variables a handler defines in the CMOR session, for
+    setup_cmor_session. Each input file defines the axes of the variable in its table,
+    the variable itself and its z-factors
 
-    logfile = os.path.join(os.getcwd(), 'logs')
-    if not os.path.exists(logfile):
-        os.makedirs(logfile)
+    Params:
+    -------
+        tables_path (str): path to the CMIP6 tables
+        table (str): the name of the table of the handler, e.g. CMIP6_Amon.json
+        variable (str): the name of the CMIP6 variable
+        num_files (int): the number of input files per raw variable
+        num_zfactors (int): the number of z-factors defined for each file
+    Returns:
+    --------
+        (num_axes, num_variables)
+    """
+    if '_highfreq' in variable:
+        variable = variable[:len('_highfreq') * -1]
+    dimensions = get_variable_dimensions(str(tables_path), str(table), variable)
+    return len(dimensions) * num_files, (1 + num_zfactors) * num_files
+# ------------------------------------------------------------------
 
-    logfile = os.path.join(logfile, var_name + '.log')
-    cmor.setup(
-        inpath=table_path,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
 
-    cmor.dataset_json(user_input_path)
-    cmor.load_table(table_name)
+def end_cmor_session():
+    """
+    Closes the CMOR session of this process, if there is one
+    """
+    import cmor
+    if _CMOR_SESSION['inpath'] is None:
+        return
+    cmor.close()
+    _CMOR_SESSION.update(inpath=None, logfile=None, tables=dict(), axes=0, variables=0)
 # ------------------------------------------------------------------
 
 
@@ -111,6 +244,12 @@ def parse_arguments():
         '--simple',
         help='Perform a simple translation of the E3SM output to CMIP format, but without the CMIP6 metadata checks',
         action='store_true')
+    parser.add_argument(
+        '--output-format',
+        default='netcdf',
+        choices=['netcdf', 'zarr'],
+        help='optional: the format of the --simple output, netcdf for a single netcdf file per variable, zarr for a '
+             'chunked and compressed zarr store per variable, written one time chunk at a time, default = netcdf')
     parser.add_argument(
         '-f','--freq',
         help='The frequency of that data, default is monthly. Accepted values are mon, day, 6hr, 3hr, 1hr',
@@ -133,14 +272,119 @@ def parse_arguments():
         default=6,
         type=int,
         help='optional: number of processes, default = 6')
+    parser.add_argument(
+        '--chunk-size',
+        metavar='<chunk_size>',
+        default=None,
+        type=int,
+        help='optional: number of time steps to write with each cmor.write call, e.g. 120 for ten years of monthly data. '
+             'By default each time step is written separately')
+    parser.add_argument(
+        '--max-memory-per-worker',
+        metavar='<GB>',
+        default=None,
+        type=float,
+        help='optional: memory budget in GB for the input data of each worker. Input files are read in windows of time '
+             'steps that fit in this budget instead of all at once. By default each input file is read whole')
+    parser.add_argument(
+        '--memory-budget',
+        metavar='<GB>',
+        default=None,
+        type=float,
+        help='optional: total memory in GB available to the parallel workers. Handlers are only started while their '
+             'estimated memory fits in this budget, default = the physical memory of the node')
+    parser.add_argument(
+        '--segment-years',
+        metavar='<years>',
+        default=None,
+        type=int,
+        help='optional: split each atm or lnd variable into segments of input files covering this many years, and '
+             'convert each segment on a separate worker. Use 1 for one segment per input file')
+    parser.add_argument(
+        '--index-cache',
+        metavar='<index_cache_path>',
+        default=None,
+        help='optional: path to a json file to cache the listing of the input directory in. The cache is reused by '
+             'later runs until the input directory is modified')
+    parser.add_argument(
+        '--dask-scheduler',
+        metavar='<scheduler>',
+        default='threads',
+        choices=['threads', 'processes', 'distributed'],
+        help='optional: the dask execution backend used by the MPAS handlers in each worker, threads, processes, or '
+             'distributed for a local dask.distributed cluster, default = threads')
+    parser.add_argument(
+        '--dask-threads',
+        metavar='<threads>',
+        default=None,
+        type=int,
+        help='optional: number of dask threads (or processes) used by the MPAS handlers in each worker, default = the '
+             'cores of the --cpu-budget divided between the workers')
+    parser.add_argument(
+        '--cpu-budget',
+        metavar='<cores>',
+        default=None,
+        type=int,
+        help='optional: number of cores to divide between the worker processes, their dask threads and the BLAS '
+             'threads of numpy, default = the cores available to this process')
+    parser.add_argument(
+        '--dask-chunks',
+        metavar='<dim=size,...>',
+        default=None,
+        help='optional: chunk shape to open the MPAS time series with, e.g. nCells=32768,Time=12. By default the chunks '
+             'are sized from the mesh and the memory available to each worker')
     parser.add_argument(
         '-H', '--handlers',
         metavar='<handler_path>',
         default=None,
         help='Path to cmor handlers directory, default = e3sm_to_cmip/cmor_handlers')
+    parser.add_argument(
+        '--encoding',
+        metavar='<encoding_path>',
+        default=None,
+        help='optional: path to a yaml or json file with the deflate level, shuffle, chunk shape and '
+             'least_significant_digit of the outputs, for all variables, each realm or each variable')
+    parser.add_argument(
+        '--deflate-level',
+        metavar='<level>',
+        default=None,
+        type=int,
+        help='optional: the deflate level from 0 to 9 of all the outputs, overrides the --encoding profiles')
+    parser.add_argument(
+        '--timing-report',
+        metavar='<report_path>',
+        default=None,
+        help='optional: record the wall time, CPU time, bytes read and written and resident memory of each stage of each '
+             'handler, print a summary table at the end of the run and write the timings to this path, as csv if '
+             'it ends with .csv, otherwise as json')
+    parser.add_argument(
+        '--profile-dir',
+        metavar='<profile_dir>',
+        default=None,
+        help='optional: run each handler under cProfile and dump its statistics to a .prof file in this directory, '
+             'also records the stage timings')
+    parser.add_argument(
+        '--status-file',
+        metavar='<status_path>',
+        default=None,
+        help='optional: periodically write the progress of the run to this json file, the handlers queued, running and '
+             'done, the time steps and bytes written for each variable, the throughput and the estimated time remaining')
+    parser.add_argument(
+        '--status-interval',
+        metavar='<seconds>',
+        default=30,
+        type=float,
+        help='optional: the seconds between updates of the --status-file, default = 30')
+    parser.add_argument(
+        '--metrics-port',
+        metavar='<port>',
+        default=None,
+        type=int,
+        help='optional: serve the progress of the run in the Prometheus text format on http://127.0.0.1:<port>/metrics, '
+             'and as json on /status')
     parser.add_argument(
         '--custom-metadata',
-        help='the path to a json file with additional custom metadata to add to the output files')
+        help='the path to a json or yaml file with additional custom metadata to add to the global attributes of the output files')
     parser.add_argument(
         '-s', '--serial',
         help='Run in serial mode, usefull for debugging purposes',
@@ -165,6 +409,14 @@ def parse_arguments():
         '--precheck',
         type=str,
         help="Check for each variable if its already in the output CMIP6 directory, only run variables that dont have CMIP6 output")
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help="Resume an interrupted run into the same output path, skipping the variables and input files that the checkpoint journal in the output path records as committed")
+    parser.add_argument(
+        '--precheck-manifest',
+        type=str,
+        help="optional: path to a json manifest of the --precheck output tree. Only directories modified since the manifest was written are listed again")
     parser.add_argument(
         '--info',
         action="store_true",
@@ -201,6 +453,38 @@ variables are present in the E3SM output.""")
         if not _args.simple and not _args.user_metadata and not _args.info:
             raise ValueError(
                 "Running without the --simple flag requires CMIP6 metadata json file")
+        if _args.chunk_size is not None and _args.chunk_size < 1:
+            raise ValueError("--chunk-size must be a positive number of time steps")
+        if _args.max_memory_per_worker is not None and _args.max_memory_per_worker <= 0:
+            raise ValueError("--max-memory-per-worker must be a positive number of GB")
+        if _args.memory_budget is not None and _args.memory_budget <= 0:
+            raise ValueError("--memory-budget must be a positive number of GB")
+        if _args.segment_years is not None and _args.segment_years < 1:
+            raise ValueError("--segment-years must be a positive number of years")
+        if _args.cpu_budget is not None and _args.cpu_budget < 1:
+            raise ValueError("--cpu-budget must be a positive number of cores")
+        if _args.dask_threads is not None and _args.dask_threads < 1:
+            raise ValueError("--dask-threads must be a positive number of threads")
+        if _args.dask_scheduler == 'distributed':
+            try:
+                import distributed
+            except ImportError:
+                raise ValueError("--dask-scheduler distributed requires the dask distributed package")
+        if _args.output_format == 'zarr':
+            if not _args.simple:
+                raise ValueError("--output-format zarr is only supported with the --simple flag")
+            try:
+                import zarr
+            except ImportError:
+                raise ValueError("--output-format zarr requires the zarr package")
+        if _args.dask_chunks:
+            _args.dask_chunks = parse_dask_chunks(_args.dask_chunks)
+        if _args.deflate_level is not None and not 0 <= _args.deflate_level <= 9:
+            raise ValueError("--deflate-level must be between 0 and 9")
+        if _args.status_interval <= 0:
+            raise ValueError("--status-interval must be positive")
+        if _args.encoding:
+            _args.encoding = load_encoding_profiles(_args.encoding)
         allowed_freqs = ['mon', 'day', '6hrLev', '6hrPlev', '6hrPlevPt', '3hr', '1hr']
         if _args.freq and _args.freq not in allowed_freqs:
             raise ValueError(f"Frequency set to {_args.freq} which is not in the set of allowed frequencies: {', '.join(allowed_freqs)}")
@@ -251,15 +535,10 @@ def print_var_info(handlers, freq=None, inpath=None, tables=None, outpath=None):
                 messages.append(msg)
     
     elif freq and tables and inpath:
+        import xarray as xr
         file_path = next(Path(inpath).glob('*.nc'))
         
-        resource_path, _ = os.path.split(os.path.abspath(resources.__file__))
-        defaults_path = os.path.join(
-            resource_path,
-            'default_handler_info.yaml')
-        
-        with open(defaults_path, 'r') as infile:
-            default_info = yaml.load(infile, Loader=yaml.SafeLoader)
+        default_info = get_default_handler_info()
         
         
 
@@ -336,12 +615,69 @@ def get_table(table, variable, freq, tables):
     else:
         return table_path.name, True
 
+def get_cache_dir():
+    """
+    Returns the user cache directory of e3sm_to_cmip, ~/.cache/e3sm_to_cmip or
+    $XDG_CACHE_HOME/e3sm_to_cmip, which holds the caches shared between runs. The
+    directory isn't created
+    """
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+        'e3sm_to_cmip')
+# ------------------------------------------------------------------
+
+
 def get_table_info(tables, table):
+    """
+    Returns the parsed contents of a CMIP6 table. Each table is parsed once per process, and the parsed
+    tables are also pickled in the user cache directory so later runs and spawned workers skip the json
+    parsing. The returned dict is shared between callers and must not be modified
+    """
     table = Path(tables, table)
     if not table.exists():
         raise ValueError(f"CMIP6 table doesnt exist: {table}")
-    with open(table, 'r') as instream:
-        return json.load(instream)
+    stat = table.stat()
+    return _load_table(str(table.resolve()), stat.st_mtime_ns, stat.st_size)
+# ------------------------------------------------------------------
+
+
+def get_variable_dimensions(tables, table, variable):
+    """
+    Returns the list of dimension names of a variable in a CMIP6 table
+    """
+    return get_table_info(tables, table)['variable_entry'][variable]['dimensions'].split()
+# ------------------------------------------------------------------
+
+
+@functools.lru_cache(maxsize=64)
+def _load_table(table_path, mtime, size):
+    """
+    Parse a CMIP6 table, using the pickled copy in the user cache directory if it matches the
+    modification time and size of the table
+    """
+    key = hashlib.sha1(table_path.encode('utf-8')).hexdigest()
+    cache_path = os.path.join(get_cache_dir(), f'table_{key}.pickle')
+    try:
+        with open(cache_path, 'rb') as instream:
+            cached = pickle.load(instream)
+        if cached['mtime'] == mtime and cached['size'] == size:
+            return cached['table']
+    except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+        pass
+
+    with open(table_path, 'r') as instream:
+        table_info = json.load(instream)
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}'
+        with open(tmp_path, 'wb') as outstream:
+            pickle.dump({'mtime': mtime, 'size': size, 'table': table_info}, outstream,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return table_info
 
 def get_table_freq(table, freq):
     if table == "CMIP6_Amon.json":
@@ -355,6 +691,204 @@ def get_table_freq(table, freq):
 
 
 
+def get_default_handler_info():
+    """
+    Returns the entries of resources/default_handler_info.yaml, parsed once per process and cached next to
+    the handler registry between runs
+    """
+    resource_path, _ = os.path.split(os.path.abspath(resources.__file__))
+    defaults_path = os.path.join(resource_path, 'default_handler_info.yaml')
+    return get_handler_registry(None, defaults_path)['defaults']['entries']
+# ------------------------------------------------------------------
+
+
+def get_unit_conversions():
+    """
+    Returns the unit conversions of the default handlers from resources/unit_conversions.yaml,
+    parsed and checked once per process
+
+    Returns:
+    --------
+        conversions (dict): the scale, divisor, offset and sign of each unit_conversion name
+    """
+    if _UNIT_CONVERSIONS:
+        return _UNIT_CONVERSIONS
+
+    resource_path, _ = os.path.split(os.path.abspath(resources.__file__))
+    conversions_path = os.path.join(resource_path, 'unit_conversions.yaml')
+    with open(conversions_path, 'r') as instream:
+        document = yaml.load(instream, Loader=yaml.SafeLoader)
+    if not isinstance(document, dict):
+        raise ValueError(f"{conversions_path} is not a mapping of unit conversions")
+
+    conversions = dict()
+    for name, conversion in document.items():
+        conversion = conversion or dict()
+        if not isinstance(conversion, dict):
+            raise ValueError(f"the {name} unit conversion is not a mapping")
+        unknown = set(conversion) - set(UNIT_CONVERSION_KEYS)
+        if unknown:
+            raise ValueError(f"unknown settings in the {name} unit conversion: {', '.join(sorted(unknown))}")
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                   for value in conversion.values()):
+            raise ValueError(f"the settings of the {name} unit conversion must be numbers")
+        if conversion.get('divisor') == 0:
+            raise ValueError(f"the divisor of the {name} unit conversion can't be zero")
+        if conversion.get('sign', 1) not in [1, -1]:
+            raise ValueError(f"the sign of the {name} unit conversion must be 1 or -1")
+        conversions[str(name)] = conversion
+
+    _UNIT_CONVERSIONS.update(conversions)
+    return _UNIT_CONVERSIONS
+# ------------------------------------------------------------------
+
+
+def get_handler_registry(handlers_path=None, defaults_path=None):
+    """
+    Returns a registry of the handler modules in handlers_path, and of the default handlers in defaults_path,
+    without importing the handler modules. The VAR_NAME, VAR_UNITS, RAW_VARIABLES, TABLE, LEVELS and POSITIVE
+    of each module are read from its source, and only modules that compute them at import time are imported.
+    The registry is cached in memory and in a json file in the user cache directory, and only the modules
+    modified since the cache was written are read again.
+
+    Params:
+    -------
+        handlers_path (str): the directory of handler modules
+        defaults_path (str): the path to the default_handler_info.yaml file
+    Returns:
+    --------
+        a dict with 'modules', mapping module names to their info and path, and 'defaults' with the
+        parsed default handler entries
+    """
+    if defaults_path is None:
+        resource_path, _ = os.path.split(os.path.abspath(resources.__file__))
+        defaults_path = os.path.join(resource_path, 'default_handler_info.yaml')
+
+    key = hashlib.sha1(f"{handlers_path}:{defaults_path}".encode('utf-8')).hexdigest()
+    registry = _HANDLER_REGISTRY.get(key)
+    cache_path = os.path.join(get_cache_dir(), f'handlers_{key}.json')
+    if registry is None:
+        try:
+            with open(cache_path, 'r') as instream:
+                registry = json.load(instream)
+        except (OSError, ValueError):
+            registry = None
+    if not isinstance(registry, dict) or registry.get('version') != __version__ \
+            or registry.get('format') != REGISTRY_FORMAT:
+        registry = {'version': __version__, 'format': REGISTRY_FORMAT, 'modules': {}, 'defaults': {}}
+    modified = False
+
+    stat = os.stat(defaults_path)
+    if registry['defaults'].get('mtime') != stat.st_mtime or registry['defaults'].get('size') != stat.st_size:
+        with open(defaults_path, 'r') as infile:
+            entries = yaml.load(infile, Loader=yaml.SafeLoader)
+        registry['defaults'] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'entries': entries}
+        modified = True
+
+    if handlers_path is not None:
+        modules = dict()
+        for entry in os.scandir(handlers_path):
+            if not entry.name.endswith('.py') or entry.name == "__init__.py":
+                continue
+            module_name, _ = entry.name.rsplit('.', 1)
+            stat = entry.stat()
+            cached = registry['modules'].get(module_name)
+            if cached and cached['path'] == entry.path \
+                    and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+                modules[module_name] = cached
+                continue
+            modules[module_name] = {
+                'path': entry.path,
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'info': _read_handler_info(module_name, entry.path)}
+            modified = True
+        if set(modules) != set(registry['modules']):
+            modified = True
+        registry['modules'] = modules
+
+    if modified:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}'
+            with open(tmp_path, 'w') as outstream:
+                json.dump(registry, outstream)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+
+    _HANDLER_REGISTRY[key] = registry
+    return registry
+# ------------------------------------------------------------------
+
+
+def _read_handler_info(module_name, module_path):
+    """
+    Read the handler attributes of a module from its source, falling back to importing it if they
+    aren't literals. USES_HANDLE_VARIABLES records whether the handle method returns the result
+    of lib.handle_variables, which writes one output file per input file
+    """
+    class StripStr(ast.NodeTransformer):
+        # str('value') is used throughout the handlers, and is a literal for our purpose
+        def visit_Call(self, node):
+            self.generic_visit(node)
+            if isinstance(node.func, ast.Name) and node.func.id == 'str' \
+                    and len(node.args) == 1 and not node.keywords:
+                return node.args[0]
+            return node
+
+    info = dict()
+    uses_handle_variables = False
+    try:
+        with open(module_path, 'r') as instream:
+            tree = ast.parse(instream.read(), filename=module_path)
+        handle = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == 'handle']
+        has_handle = bool(handle)
+        if handle:
+            uses_handle_variables = any(
+                isinstance(node, ast.Return) and isinstance(node.value, ast.Call)
+                and isinstance(node.value.func, ast.Name) and node.value.func.id == 'handle_variables'
+                for node in ast.walk(handle[0]))
+        for node in tree.body:
+            if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+                continue
+            target = node.targets[0]
+            if isinstance(target, ast.Name) and target.id in HANDLER_ATTRIBUTES:
+                info[target.id] = ast.literal_eval(StripStr().visit(node.value))
+    except (SyntaxError, ValueError, OSError):
+        has_handle = False
+
+    if has_handle and all(name in info for name in ['VAR_NAME', 'VAR_UNITS', 'RAW_VARIABLES', 'TABLE']):
+        info['USES_HANDLE_VARIABLES'] = uses_handle_variables
+        return info
+
+    module = imp.load_source(module_name, module_path)
+    info = {name: getattr(module, name) for name in HANDLER_ATTRIBUTES if hasattr(module, name)}
+    info['USES_HANDLE_VARIABLES'] = uses_handle_variables
+    return info
+# ------------------------------------------------------------------
+
+
+def run_handler_module(module_name, module_path, *args, **kwargs):
+    """
+    Import a handler module, on the process that runs it, and call its handle method
+    """
+    module = sys.modules.get(module_name)
+    if module is None or getattr(module, '__file__', None) != module_path:
+        module = imp.load_source(module_name, module_path)
+    return module.handle(*args, **kwargs)
+# ------------------------------------------------------------------
+
+
+def run_package_handler(module_name, function_name, *args, **kwargs):
+    """
+    Import a handler function of the e3sm_to_cmip package, on the process that runs it, and call it
+    """
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)(*args, **kwargs)
+# ------------------------------------------------------------------
+
+
 def load_handlers(handlers_path, var_list, tables, freq="mon", realm='atm', simple=False, debug=None):
     """
     load the cmor handler modules
@@ -369,70 +903,59 @@ def load_handlers(handlers_path, var_list, tables, freq="mon", realm='atm', simp
         (which are the cmip6 output variable name), to a tuple of (function pointer,
         list of required input variables)
     """
-    from e3sm_to_cmip.default import default_handler
-
     handlers = list()
 
     if debug:
         print_message(f"looking for handlers for: {' '.join(var_list)}")
 
-    # load default handlers if they're in the variable list
-    resource_path, _ = os.path.split(os.path.abspath(resources.__file__))
-    defaults_path = os.path.join(
-        resource_path,
-        'default_handler_info.yaml')
-    
-    with open(defaults_path, 'r') as infile:
+    # the handler attributes are read from the registry, the modules are only imported by the
+    # process that runs them
+    registry = get_handler_registry(handlers_path)
 
-        defaults = yaml.load(infile, Loader=yaml.SafeLoader)
-        for default in defaults:
-
-            if default.get('cmip_name') not in var_list and 'all' not in var_list:
-                continue
-            
-            if simple or freq == "mon":
-                table = default['table']
-            else:
-                table, var_included = get_table(
-                    table=default['table'],
-                    variable=default.get('cmip_name'),
-                    freq=freq,
-                    tables=tables)
-                if not table:
-                    print_message(f"No table exists for {default['cmip_name']} at freq {freq}")
-                    continue
-                if not var_included:
-                    print_message(f"Variable {default['cmip_name']} is not included in table {table}")
-                    continue
+    # load default handlers if they're in the variable list
+    defaults = registry['defaults']['entries']
+    for default in defaults:
 
-            if realm == 'atm' and table not in ATMOS_TABLES:
-                continue
-            elif realm == 'lnd' and table not in LAND_TABLES:
-                continue
-            elif realm == 'mpaso' and table not in OCEAN_TABLES:
+        if default.get('cmip_name') not in var_list and 'all' not in var_list:
+            continue
+        
+        if simple or freq == "mon":
+            table = default['table']
+        else:
+            table, var_included = get_table(
+                table=default['table'],
+                variable=default.get('cmip_name'),
+                freq=freq,
+                tables=tables)
+            if not table:
+                print_message(f"No table exists for {default['cmip_name']} at freq {freq}")
                 continue
-            elif realm == 'mpassi' and table not in SEAICE_TABLES:
+            if not var_included:
+                print_message(f"Variable {default['cmip_name']} is not included in table {table}")
                 continue
 
-            handlers.append({
-                'name': default.get('cmip_name'),
-                'method': default_handler,
-                'raw_variables': [default.get('e3sm_name')],
-                'units': default.get('units'),
-                'table': table,
-                'positive': default.get('positive'),
-                'unit_conversion': default.get('unit_conversion')
-            })
-
-    # load the more complex handlers
-    for handler in os.listdir(handlers_path):
-        
-        if not handler.endswith('.py'):
+        if realm == 'atm' and table not in ATMOS_TABLES:
             continue
-        if handler == "__init__.py":
+        elif realm == 'lnd' and table not in LAND_TABLES:
+            continue
+        elif realm == 'mpaso' and table not in OCEAN_TABLES:
+            continue
+        elif realm == 'mpassi' and table not in SEAICE_TABLES:
             continue
 
-        module_name, _ = handler.rsplit('.', 1)
+        handlers.append({
+            'name': default.get('cmip_name'),
+            'method': functools.partial(run_package_handler, 'e3sm_to_cmip.default', 'default_handler'),
+            'raw_variables': [default.get('e3sm_name')],
+            'units': default.get('units'),
+            'table': table,
+            'positive': default.get('positive'),
+            'unit_conversion': default.get('unit_conversion'),
+            'uses_handle_variables': True
+        })
+
+    # load the more complex handlers
+    for module_name, module_entry in registry['modules'].items():
 
         if module_name not in var_list and 'all' not in var_list:
             continue
@@ -445,25 +968,22 @@ def load_handlers(handlers_path, var_list, tables, freq="mon", realm='atm', simp
         if dup:
             continue
 
-        module_path = os.path.join(handlers_path, handler)
-
-        # load the module, and extract the "handle" method and required variables
-        module = imp.load_source(module_name, module_path)
+        module_info = module_entry['info']
 
         # pull the table name out from the format CMIP6_Amon.json
         if simple or freq == "mon":
-            table = module.TABLE
+            table = module_info['TABLE']
         else:
             table, var_included = get_table(
-                table=module.TABLE,
-                variable=module.VAR_NAME,
+                table=module_info['TABLE'],
+                variable=module_info['VAR_NAME'],
                 freq=freq,
                 tables=tables)
             if not table:
-                print_message(f"No table exists for {module.VAR_NAME} at freq {freq}")
+                print_message(f"No table exists for {module_info['VAR_NAME']} at freq {freq}")
                 continue
             if not var_included:
-                print_message(f"Variable {module.VAR_NAME} is not included in table {table}")
+                print_message(f"Variable {module_info['VAR_NAME']} is not included in table {table}")
                 continue
 
         if realm == 'atm' and table not in ATMOS_TABLES:
@@ -477,13 +997,14 @@ def load_handlers(handlers_path, var_list, tables, freq="mon", realm='atm', simp
         
         if module_name in var_list or 'all' in var_list:
             handlers.append({
-                'name': module.VAR_NAME,
-                'method': module.handle,
-                'raw_variables': module.RAW_VARIABLES,
-                'units': module.VAR_UNITS,
+                'name': module_info['VAR_NAME'],
+                'method': functools.partial(run_handler_module, module_name, module_entry['path']),
+                'raw_variables': module_info['RAW_VARIABLES'],
+                'units': module_info['VAR_UNITS'],
                 'table': table,
-                'positive': module.POSITIVE if hasattr(module, 'POSITIVE') else None,
-                'levels': module.LEVELS if hasattr(module, 'LEVELS') else None
+                'positive': module_info.get('POSITIVE'),
+                'levels': module_info.get('LEVELS'),
+                'uses_handle_variables': module_info.get('USES_HANDLE_VARIABLES', False)
             })
         elif debug:
             print_message(f"{module_name} not loaded")
@@ -533,15 +1054,19 @@ def copy_user_metadata(input_path, output_path):
 # ------------------------------------------------------------------
 
 
-def add_metadata(file_path, var_list, metadata_path):
+def add_metadata(file_path, var_list, metadata_path, nproc=1):
     """
     Recurses down a file tree, adding metadata to any netcdf files in the tree
-    that are on the variable list.
+    that are on the variable list. The attributes are written in place into the
+    file header, the data section of the files isn't read or rewritten, and the
+    files are updated in parallel by nproc processes.
 
-    Parameters
-    ----------
+    Params:
+    -------
         file_path (str): the root directory to search for files under
         var_list (list(str)): a list of cmip6 variable names
+        metadata_path (str): the path to a json or yaml file with the global attributes to add
+        nproc (int): the number of files to update at the same time
     """
 
     def filter_variables(file_path, var_list):
@@ -552,7 +1077,7 @@ def add_metadata(file_path, var_list, metadata_path):
                 index = name.find('_')
                 if index != -1 and name[:index] in var_list or 'all' in var_list:
                     yield os.path.join(root, name)
-    
+
     with open(metadata_path, 'r') as instream:
         if metadata_path.endswith('json'):
             metadata = json.load(instream)
@@ -561,11 +1086,249 @@ def add_metadata(file_path, var_list, metadata_path):
         else:
             raise ValueError(f"custom metadata file {metadata_path} is not a json or yaml document")
 
-    for filepath in tqdm(filter_variables(file_path, var_list), desc='Adding additional metadata to output files'):
-        ds = xr.open_dataset(filepath, decode_times=False)
-        for key, value in metadata.items():
-            ds.attrs[key] = value
-        ds.to_netcdf(filepath)        
+    # netcdf attributes can only hold strings, numbers and lists of numbers
+    attributes = dict()
+    for key, value in metadata.items():
+        if isinstance(value, (dict, list, tuple)) and not _is_numeric_list(value):
+            value = json.dumps(value)
+        elif isinstance(value, bool) or value is None:
+            value = str(value)
+        attributes[key] = value
+
+    filepaths = list(filter_variables(file_path, var_list))
+    desc = 'Adding additional metadata to output files'
+    if nproc > 1 and len(filepaths) > 1:
+        with ProcessPoolExecutor(max_workers=min(nproc, len(filepaths))) as pool:
+            futures = [pool.submit(set_global_attributes, filepath, attributes)
+                       for filepath in filepaths]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                future.result()
+    else:
+        for filepath in tqdm(filepaths, desc=desc):
+            set_global_attributes(filepath, attributes)
+# ------------------------------------------------------------------
+
+
+def _is_numeric_list(value):
+    return isinstance(value, (list, tuple)) and len(value) > 0 and all(
+        isinstance(x, (int, float)) and not isinstance(x, bool) for x in value)
+# ------------------------------------------------------------------
+
+
+def set_global_attributes(filepath, attributes):
+    """
+    Sets global attributes of a netcdf file in place, only the file header
+    is modified.
+
+    Params:
+    -------
+        filepath (str): the path to the netcdf file
+        attributes (dict): the attribute names and values
+    """
+    import netCDF4
+    with netCDF4.Dataset(filepath, 'a') as dataset:
+        dataset.setncatts(attributes)
+# ------------------------------------------------------------------
+
+
+def load_encoding_profiles(path):
+    """
+    Reads the output encoding profiles from a yaml or json file. The file has
+    an optional default profile, and optional profiles for each realm and each
+    CMIP6 variable that override it, e.g.
+
+        default:
+            deflate_level: 1
+            shuffle: true
+        realms:
+            mpaso:
+                deflate_level: 4
+        variables:
+            tas:
+                least_significant_digit: 2
+                chunks: {time: 12}
+
+    Params:
+    -------
+        path (str): the path to the yaml or json file
+    Returns:
+    --------
+        profiles (dict): the default, realms and variables profiles
+    """
+    with open(path, 'r') as instream:
+        if path.endswith('json'):
+            document = json.load(instream)
+        elif path.endswith('yaml') or path.endswith('yml'):
+            document = yaml.load(instream, Loader=yaml.SafeLoader)
+        else:
+            raise ValueError(f"encoding file {path} is not a json or yaml document")
+
+    if not isinstance(document, dict) or set(document) - {'default', 'realms', 'variables'}:
+        raise ValueError(f"encoding file {path} may only hold default, realms and variables profiles")
+
+    profiles = {
+        'default': _check_encoding_profile(document.get('default') or dict(), 'default'),
+        'realms': dict(),
+        'variables': dict()
+    }
+    for section in ['realms', 'variables']:
+        for name, profile in (document.get(section) or dict()).items():
+            profiles[section][name] = _check_encoding_profile(profile, name)
+    return profiles
+# ------------------------------------------------------------------
+
+
+def _check_encoding_profile(profile, name):
+    if not isinstance(profile, dict):
+        raise ValueError(f"the {name} encoding profile is not a mapping")
+    unknown = set(profile) - set(ENCODING_KEYS)
+    if unknown:
+        raise ValueError(f"unknown settings in the {name} encoding profile: {', '.join(sorted(unknown))}")
+    level = profile.get('deflate_level')
+    if level is not None and (not isinstance(level, int) or not 0 <= level <= 9):
+        raise ValueError(f"the deflate_level of the {name} encoding profile must be between 0 and 9")
+    if 'shuffle' in profile and not isinstance(profile['shuffle'], bool):
+        raise ValueError(f"the shuffle of the {name} encoding profile must be true or false")
+    chunks = profile.get('chunks')
+    if chunks is not None and (not isinstance(chunks, dict) or not all(
+            isinstance(size, int) and size > 0 for size in chunks.values())):
+        raise ValueError(f"the chunks of the {name} encoding profile must map dimension names to positive sizes")
+    digits = profile.get('least_significant_digit')
+    if digits is not None and not isinstance(digits, int):
+        raise ValueError(f"the least_significant_digit of the {name} encoding profile must be an integer")
+    return profile
+# ------------------------------------------------------------------
+
+
+def configure_encoding(profiles=None, realm=None, deflate_level=None):
+    """
+    Sets the encoding profiles of the outputs written by this process
+
+    Params:
+    -------
+        profiles (dict): the profiles returned by load_encoding_profiles
+        realm (str): the realm being converted, selects the realm profile
+        deflate_level (int): the deflate level from the command line, overrides the profiles
+    """
+    if profiles is None:
+        profiles = {'default': dict(), 'realms': dict(), 'variables': dict()}
+    default = dict(profiles['default'])
+    default.update(profiles['realms'].get(realm, dict()))
+
+    _ENCODING_PROFILES.clear()
+    _ENCODING_PROFILES.update(
+        default=default,
+        variables=profiles['variables'],
+        deflate_level=deflate_level)
+# ------------------------------------------------------------------
+
+
+def get_encoding_profile(variable):
+    """
+    Returns the encoding profile of a CMIP6 variable, the default and realm
+    profiles updated with the profile of the variable. The profile is empty
+    if no encoding was configured
+
+    Params:
+    -------
+        variable (str): the name of the CMIP6 variable
+    """
+    if not _ENCODING_PROFILES:
+        return dict()
+    profile = dict(_ENCODING_PROFILES['default'])
+    profile.update(_ENCODING_PROFILES['variables'].get(variable, dict()))
+    if _ENCODING_PROFILES['deflate_level'] is not None:
+        profile['deflate_level'] = _ENCODING_PROFILES['deflate_level']
+    return profile
+# ------------------------------------------------------------------
+
+
+def set_cmor_deflate(varid, variable):
+    """
+    Applies the deflate level and shuffle of the encoding profile of a variable
+    to a CMOR variable, CMOR's defaults are kept if the profile sets neither
+
+    Params:
+    -------
+        varid (int): the CMOR variable id
+        variable (str): the name of the CMIP6 variable
+    """
+    import cmor
+    profile = get_encoding_profile(variable)
+    if 'deflate_level' not in profile and 'shuffle' not in profile:
+        return
+    level = profile.get('deflate_level', 1)
+    shuffle = profile.get('shuffle', True)
+    cmor.set_deflate(varid, int(shuffle), int(level > 0), level)
+# ------------------------------------------------------------------
+
+
+def get_directory_index(path, cache_path=None):
+    """
+    Lists the given directory once and indexes the time series files in it by
+    variable name and year range. The index is kept in memory and shared by every
+    later lookup in the same directory, and is rebuilt if the modification time of
+    the directory changes. If a cache_path is given, the directory listing is also
+    stored in that json file, and reused by later runs while the modification
+    time of the directory is unchanged.
+
+    Params:
+    -------
+        path (str): the path of the directory to index
+        cache_path (str): optional path to a json file to persist the listing in
+    Returns:
+    --------
+        index (dict): {
+            mtime: the modification time of the directory in ns,
+            files: the sorted names of all the files in the directory,
+            variables: {variable name: {(start, end): file name}} for all files
+                that match VAR_YYYYMM_YYYYMM.nc
+        }
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+
+    index = _DIRECTORY_INDEX.get(path)
+    if index is not None and index['mtime'] == mtime:
+        return index
+
+    files = None
+    cache = dict()
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as instream:
+                cache = json.load(instream)
+        except (IOError, ValueError):
+            cache = dict()
+        cached = cache.get(path)
+        if cached and cached.get('mtime') == mtime:
+            files = cached['files']
+
+    if files is None:
+        files = sorted(os.listdir(path))
+        if cache_path:
+            cache[path] = {'mtime': mtime, 'files': files}
+            # write to a temporary name first, so an interrupted run or another
+            # worker never leaves a truncated cache behind
+            tmp_path = f'{cache_path}.{os.getpid()}'
+            with open(tmp_path, 'w') as outstream:
+                json.dump(cache, outstream)
+            os.replace(tmp_path, cache_path)
+
+    variables = dict()
+    for name in files:
+        match = re.match(ATM_FILE_PATTERN, name)
+        if match:
+            years = (match.group('start'), match.group('end'))
+            variables.setdefault(match.group('var'), dict())[years] = name
+
+    index = {
+        'mtime': mtime,
+        'files': files,
+        'variables': variables
+    }
+    _DIRECTORY_INDEX[path] = index
+    return index
 # ------------------------------------------------------------------
 
 
@@ -579,12 +1342,30 @@ def find_atm_files(var, path):
         path (str): the path of the directory to look in
     Returns:
     --------
-        files (list(str)): A list of paths to the matching files
+        files (list(str)): A list of paths to the matching files, ordered by year
+    """
+    files = get_directory_index(path)['variables'].get(var, dict())
+    for years in sorted(files):
+        yield files[years]
+# ------------------------------------------------------------------
+
+
+def get_atm_file_years(var, path):
+    """
+    Returns the start and end year of a time series file named VAR_YYYYMM_YYYYMM.nc
+
+    Params:
+    -------
+        var (str): the name of the variable in the file
+        path (str): the path to the file
+    Returns:
+    --------
+        (start, end) the start and end years as ints
     """
-    pattern = var + r'\_\d{6}\_\d{6}\.nc'
-    for item in os.listdir(path):
-        if re.match(pattern, item):
-            yield item
+    _, name = os.path.split(path)
+    # counting from the end of the variable name, since it might have a _ in it
+    start, end = name[len(var) + 1:].split('_')[:2]
+    return int(start[:4]), int(end[:4])
 # ------------------------------------------------------------------
 
 
@@ -600,7 +1381,7 @@ def find_mpas_files(component, path, map_path=None):
     # save original in case it's an atm var
     var = str(component)
     component = component.lower()
-    contents = os.listdir(path)
+    contents = get_directory_index(path)['files']
 
     if component == 'mpaso':
 
@@ -693,6 +1474,198 @@ def terminate(pool, debug=False):
 # ------------------------------------------------------------------
 
 
+def load_checkpoint(output_path):
+    """
+    Reads the checkpoint journal of a previous run from the output directory
+
+    Params:
+    -------
+        output_path (str): the output directory of the run
+    Returns:
+    --------
+        checkpoint (dict): {
+            complete: set((name, table)) of the variables that finished,
+            files: {(name, table): set(input file names)} of the input files
+                whose output has been written and closed
+        }
+    """
+    checkpoint = {'complete': set(), 'files': dict()}
+    journal_path = os.path.join(output_path, CHECKPOINT_NAME)
+    if not os.path.exists(journal_path):
+        return checkpoint
+
+    with open(journal_path, 'r') as instream:
+        for line in instream:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be incomplete if the run was killed mid-write
+                continue
+            key = (entry['name'], entry['table'])
+            if entry.get('file'):
+                checkpoint['files'].setdefault(key, set()).add(entry['file'])
+            else:
+                checkpoint['complete'].add(key)
+    return checkpoint
+# ------------------------------------------------------------------
+
+
+def record_checkpoint(output_path, name, table, filename=None):
+    """
+    Appends an entry to the checkpoint journal in the output directory, marking
+    either a single input file or, if no filename is given, the whole variable
+    as committed. Each entry is a single append so workers can share the journal.
+
+    Params:
+    -------
+        output_path (str): the output directory of the run
+        name (str): the CMIP6 name of the variable
+        table (str): the CMIP6 table of the variable
+        filename (str): the name of the input file whose output was closed
+    """
+    entry = {'name': name, 'table': table}
+    if filename:
+        entry['file'] = os.path.basename(filename)
+    line = json.dumps(entry) + '\n'
+
+    journal_path = os.path.join(output_path, CHECKPOINT_NAME)
+    fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+# ------------------------------------------------------------------
+
+
+def apply_checkpoint(checkpoint, handler, input_paths, realm):
+    """
+    Removes the input files that were committed by a previous run from the input
+    paths of an atm or lnd handler
+
+    Params:
+    -------
+        checkpoint (dict): the checkpoint as returned by load_checkpoint
+        handler (dict): the handler as returned by load_handlers
+        input_paths (dict): the input files for each of the handlers raw variables
+        realm (str): the realm of the data, [atm, lnd, mpaso, mpassi]
+    Returns:
+    --------
+        the remaining input paths, or None if the handler has nothing left to do
+    """
+    key = (handler['name'], handler['table'])
+    if key in checkpoint['complete']:
+        return None
+
+    committed = checkpoint['files'].get(key)
+    if not committed or realm not in ['atm', 'lnd']:
+        return input_paths
+
+    raw_variables = handler['raw_variables']
+    sorted_paths = {var: sorted(input_paths[var]) for var in raw_variables}
+    num_files = len(sorted_paths[raw_variables[0]])
+    if any(len(paths) != num_files for paths in sorted_paths.values()):
+        return input_paths
+
+    # the journal records the input file of the first raw variable
+    remaining = [index for index, path in enumerate(sorted_paths[raw_variables[0]])
+                 if os.path.basename(path) not in committed]
+    if num_files and not remaining:
+        return None
+    return {var: [paths[index] for index in remaining]
+            for var, paths in sorted_paths.items()}
+# ------------------------------------------------------------------
+
+
+def parse_dask_chunks(chunks):
+    """
+    Parse a chunk shape from the command line, e.g. nCells=32768,Time=12, into a dict of dimension name to size
+    """
+    shape = dict()
+    for item in chunks.split(','):
+        name, _, size = item.partition('=')
+        try:
+            size = int(size)
+        except ValueError:
+            size = 0
+        if not name.strip() or size < 1:
+            raise ValueError(f"--dask-chunks expects dim=size pairs separated by commas, got {chunks}")
+        shape[name.strip()] = size
+    return shape
+# ------------------------------------------------------------------
+
+
+def get_cpu_count():
+    """
+    Returns the number of cores this process is allowed to run on
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+# ------------------------------------------------------------------
+
+
+def get_cpu_layout(nproc, cpu_budget=None, dask_threads=None, serial=False):
+    """
+    Divide a budget of cores between the worker processes, the dask threads of each worker, and the
+    BLAS threads used by numpy within each dask thread, so the node isn't oversubscribed
+
+    Params:
+    -------
+        nproc (int): the requested number of worker processes, capped at the cpu_budget if one is given
+        cpu_budget (int): the number of cores to divide, by default the cores available to this process
+        dask_threads (int): the number of dask threads per worker, by default the cores of each worker
+        serial (bool): if the handlers are run on the main process
+    Returns:
+    --------
+        a dict with the number of cores, processes, dask_threads and blas_threads
+    """
+    cores = cpu_budget or get_cpu_count()
+    if serial:
+        processes = 1
+    elif cpu_budget:
+        processes = max(1, min(nproc, cpu_budget))
+    else:
+        processes = max(1, nproc)
+    worker_cores = max(1, cores // processes)
+    if not dask_threads:
+        dask_threads = worker_cores
+    blas_threads = max(1, worker_cores // dask_threads)
+    return {
+        'cores': cores,
+        'processes': processes,
+        'dask_threads': dask_threads,
+        'blas_threads': blas_threads}
+# ------------------------------------------------------------------
+
+
+def set_thread_limits(threads):
+    """
+    Limit the number of threads used by the BLAS and OpenMP libraries of numpy and scipy. The environment is
+    inherited by the worker processes started afterwards, and libraries that are already loaded are limited
+    through threadpoolctl if it's installed
+    """
+    for name in THREAD_LIMIT_VARS:
+        os.environ[name] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=threads)
+# ------------------------------------------------------------------
+
+
+def get_node_memory():
+    """
+    Returns the physical memory of the node in bytes, or None if it can't be determined
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+# ------------------------------------------------------------------
+
+
 def get_levgrnd_bnds():
     return [0, 0.01751106046140194, 0.045087261125445366, 0.09055273048579693, 0.16551261954009533, 0.28910057805478573, 0.4928626772016287, 0.8288095649331808, 1.3826923426240683, 2.2958906944841146, 3.801500206813216, 6.28383076749742, 10.376501685008407, 17.124175196513534, 28.249208575114608, 42.098968505859375]
 # ------------------------------------------------------------------
@@ -709,7 +1682,7 @@ def get_years_from_raw(path, realm, var):
     start = 0
     end = 0
     if realm in ['atm', 'lnd']:
-        contents = sorted([f for f in os.listdir(path)
+        contents = sorted([f for f in get_directory_index(path)['files']
                            if f.endswith("nc") and
                            var in f])
         p = var + r'\d{6}_\d{6}.nc'
@@ -745,7 +1718,90 @@ def get_year_from_cmip(filename):
     return start, end
 
 
-def precheck(inpath, precheck_path, variables, realm):
+def get_output_index(precheck_path, manifest_path=None):
+    """
+    Walks a CMIP6 output tree once and indexes the output files by variable.
+
+    If a manifest_path is given, the contents of every directory in the tree are
+    stored in that json file along with the directory modification time. Later
+    calls only list the directories that have been modified since, so new outputs
+    are picked up incrementally without re-listing the whole tree.
+
+    Parameters:
+    -----------
+        precheck_path (str): the root of the CMIP6 output tree
+        manifest_path (str): optional path to a json manifest of the tree
+    Returns:
+    --------
+        index (dict): {variable name: set((table, start year, end year))}
+    """
+    root = os.path.abspath(precheck_path)
+
+    cached_dirs = dict()
+    if manifest_path and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as instream:
+                manifest = json.load(instream)
+        except (IOError, ValueError):
+            manifest = dict()
+        if manifest.get('root') == root:
+            cached_dirs = manifest.get('dirs', dict())
+
+    dirs = dict()
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        relpath = os.path.relpath(path, root)
+        mtime = os.stat(path).st_mtime_ns
+
+        entry = cached_dirs.get(relpath)
+        if entry is None or entry['mtime'] != mtime:
+            subdirs = list()
+            outputs = list()
+            with os.scandir(path) as contents:
+                for item in contents:
+                    if item.is_dir():
+                        subdirs.append(item.name)
+                    elif item.name.endswith('.nc'):
+                        outputs.append(_parse_cmip_name(item.name))
+            entry = {
+                'mtime': mtime,
+                'dirs': sorted(subdirs),
+                'outputs': outputs
+            }
+        dirs[relpath] = entry
+        stack.extend(os.path.join(path, name) for name in entry['dirs'])
+
+    if manifest_path:
+        # write to a temporary name first, so an interrupted run never leaves a
+        # truncated manifest behind
+        tmp_path = f'{manifest_path}.{os.getpid()}'
+        with open(tmp_path, 'w') as outstream:
+            json.dump({'root': root, 'dirs': dirs}, outstream)
+        os.replace(tmp_path, manifest_path)
+
+    index = dict()
+    for entry in dirs.values():
+        for var, table, start, end in entry['outputs']:
+            index.setdefault(var, set()).add((table, start, end))
+    return index
+
+
+def _parse_cmip_name(filename):
+    """
+    Returns the variable, table, start year and end year of a CMIP6 file name,
+    the years are None for files without a time range
+    """
+    parts = filename.split('_')
+    table = parts[1] if len(parts) > 1 else None
+    try:
+        start, end = get_year_from_cmip(filename)
+    except ValueError:
+        start, end = None, None
+    return [parts[0], table, start, end]
+
+
+def precheck(inpath, precheck_path, variables, realm, manifest_path=None):
     """
     Check if the data has already been produced and skip
 
@@ -754,24 +1810,10 @@ def precheck(inpath, precheck_path, variables, realm):
 
     # First check the inpath for the start and end years
     start, end = get_years_from_raw(inpath, realm, variables[0])
-    var_map = [{'found': False, 'name': var} for var in variables]
 
     # then check the output tree for files with the correct variables for those years
-    for val in var_map:
-        for _, _, files in os.walk(precheck_path, topdown=False):
-            if files:
-                prefix = val['name'] + "_"
-                if files[0][:len(prefix)] != prefix:
-                    # this directory doesnt have the variable we're looking for
-                    continue
-
-                files = [x for x in sorted(files) if x.endswith('.nc')]
-                for f in files:
-                    cmip_start, cmip_end = get_year_from_cmip(f)
-                    if cmip_start == start and cmip_end == end:
-                        val['found'] = True
-                        break
-                if val['found'] == True:
-                    break
+    outputs = get_output_index(precheck_path, manifest_path)
 
-    return [x['name'] for x in var_map if not x['found']]
+    return [var for var in variables
+            if not any(cmip_start == start and cmip_end == end
+                       for _, cmip_start, cmip_end in outputs.get(var, ()))]
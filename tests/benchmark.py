@@ -0,0 +1,535 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from shutil import rmtree
+
+import numpy as np
+
+DESC = '''Benchmark e3sm_to_cmip on synthetic E3SM-like inputs. The inputs are generated
+once per size into the work directory and reused by later runs, so the benchmark
+runs offline and the results of different commits can be compared.
+Each case is converted with each of the worker counts, and its wall time, throughput
+and peak memory are appended as one json line per run to the results file.'''
+
+# the size presets of the synthetic inputs, the atm and lnd variables are on a
+# nlat x nlon grid with one file per year, the MPAS variables on a mesh of
+# ncells_lat x ncells_lon quadrilateral cells with one file per month
+SIZES = {
+    'small': dict(nlat=24, nlon=48, nlev=16, ncells_lat=30, ncells_lon=60, nvertlevels=10, years=2),
+    'medium': dict(nlat=90, nlon=180, nlev=32, ncells_lat=90, ncells_lon=180, nvertlevels=30, years=5),
+    'large': dict(nlat=180, nlon=360, nlev=72, ncells_lat=180, ncells_lon=360, nvertlevels=60, years=10),
+}
+
+# the benchmark cases, the e3sm_to_cmip variable and realm to convert, the raw
+# variables that are generated for it, and the frequency of the input
+CASES = {
+    'tas': dict(var='tas', realm='atm', raw=['TREFHT'], freq='mon'),
+    'cl': dict(var='cl', realm='atm', raw=['CLOUD'], freq='mon'),
+    'mrso': dict(var='mrso', realm='lnd', raw=['SOILICE', 'SOILLIQ'], freq='mon'),
+    'pr_highfreq': dict(var='pr_highfreq', realm='atm', raw=['PRECT'], freq='day'),
+    'thetao': dict(var='thetao', realm='mpaso', raw=['mpaso'], freq='mon'),
+    'msftmz': dict(var='msftmz', realm='mpaso', raw=['mpaso'], freq='mon'),
+    'siu': dict(var='siu', realm='mpassi', raw=['mpassi'], freq='mon'),
+}
+
+EARTH_RADIUS = 6371229.
+DAYS_IN_MONTH = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+ATM_START_YEAR = 1850
+MPAS_START_YEAR = 1
+NLEVGRND = 15
+
+# no fill values on the coordinates, like the E3SM time series
+NO_FILL = {'_FillValue': None}
+
+
+def _write(ds, path):
+    encoding = dict()
+    for name in ds.variables:
+        if ds[name].dtype.kind == 'f':
+            encoding[name] = NO_FILL
+        elif ds[name].dtype.kind == 'S':
+            # MPAS strings are char arrays of length StrLen
+            encoding[name] = {'char_dim_name': 'StrLen'}
+    ds.to_netcdf(path, encoding=encoding)
+
+
+def _bounds(edges):
+    return np.stack([edges[:-1], edges[1:]], axis=-1)
+
+
+def _time_axis(year, freq):
+    """
+    Returns the time and time bounds of one year in days since the start year on
+    the noleap calendar
+    """
+    start = 365. * (year - ATM_START_YEAR)
+    if freq == 'day':
+        edges = start + np.arange(366, dtype=float)
+    else:
+        edges = start + np.concatenate([[0], np.cumsum(DAYS_IN_MONTH)]).astype(float)
+    bnds = _bounds(edges)
+    # E3SM stamps the time at the end of the averaging interval
+    return bnds[:, 1], bnds
+
+
+def generate_atm_files(raw_variable, path, size, freq='mon', realm='atm'):
+    """
+    Generates the yearly time series files VAR_YYYYMM_YYYYMM.nc of a raw atm or lnd variable
+    """
+    import xarray as xr
+
+    nlat, nlon, nlev = size['nlat'], size['nlon'], size['nlev']
+    rng = np.random.default_rng(0)
+
+    lat_edges = np.linspace(-90., 90., nlat + 1)
+    lon_edges = np.linspace(0., 360., nlon + 1)
+    lat = 0.5 * (lat_edges[:-1] + lat_edges[1:])
+    lon = 0.5 * (lon_edges[:-1] + lon_edges[1:])
+
+    # hybrid sigma-pressure coefficients, sigma at the bottom and pressure at the top
+    ilev_frac = np.linspace(0., 1., nlev + 1)
+    hybi = ilev_frac ** 2
+    hyai = ilev_frac - hybi
+    hybm = 0.5 * (hybi[:-1] + hybi[1:])
+    hyam = 0.5 * (hyai[:-1] + hyai[1:])
+
+    paths = list()
+    for year in range(ATM_START_YEAR, ATM_START_YEAR + size['years']):
+        filepath = Path(path, f'{raw_variable}_{year:04d}01_{year:04d}12.nc')
+        paths.append(filepath)
+        if filepath.exists():
+            continue
+
+        time, time_bnds = _time_axis(year, freq)
+        ntime = len(time)
+        bounds_name = 'time_bounds' if realm == 'lnd' else 'time_bnds'
+        ds = xr.Dataset(
+            coords={
+                'lat': ('lat', lat, {'units': 'degrees_north', 'long_name': 'latitude'}),
+                'lon': ('lon', lon, {'units': 'degrees_east', 'long_name': 'longitude'}),
+                'time': ('time', time, {'units': f'days since {ATM_START_YEAR}-01-01 00:00:00',
+                                        'calendar': 'noleap', 'bounds': bounds_name}),
+            })
+        ds['lat_bnds'] = (('lat', 'nbnd'), _bounds(lat_edges))
+        ds['lon_bnds'] = (('lon', 'nbnd'), _bounds(lon_edges))
+        ds[bounds_name] = (('time', 'nbnd'), time_bnds)
+
+        if raw_variable == 'CLOUD':
+            ds.coords['lev'] = ('lev', 1000. * (hyam + hybm), {'units': 'hPa'})
+            ds.coords['ilev'] = ('ilev', 1000. * (hyai + hybi), {'units': 'hPa'})
+            ds['hyam'] = ('lev', hyam)
+            ds['hybm'] = ('lev', hybm)
+            ds['hyai'] = ('ilev', hyai)
+            ds['hybi'] = ('ilev', hybi)
+            ds['P0'] = ((), 100000., {'units': 'Pa'})
+            ds['PS'] = (('time', 'lat', 'lon'),
+                        (98000. + 4000. * rng.random((ntime, nlat, nlon))).astype('float32'),
+                        {'units': 'Pa'})
+            data = rng.random((ntime, nlev, nlat, nlon), dtype='float32')
+            ds[raw_variable] = (('time', 'lev', 'lat', 'lon'), data, {'units': '1'})
+        elif raw_variable in ['SOILICE', 'SOILLIQ']:
+            ds.coords['levgrnd'] = ('levgrnd', np.linspace(0.007, 35.2, NLEVGRND), {'units': 'm'})
+            data = 100. * rng.random((ntime, NLEVGRND, nlat, nlon), dtype='float32')
+            ds[raw_variable] = (('time', 'levgrnd', 'lat', 'lon'), data, {'units': 'kg/m2'})
+        elif raw_variable == 'PRECT':
+            data = 1e-7 * rng.random((ntime, nlat, nlon), dtype='float32')
+            ds[raw_variable] = (('time', 'lat', 'lon'), data, {'units': 'm/s'})
+        else:
+            data = 250. + 50. * rng.random((ntime, nlat, nlon), dtype='float32')
+            ds[raw_variable] = (('time', 'lat', 'lon'), data, {'units': 'K'})
+
+        _write(ds, filepath)
+    return paths
+
+
+def _mesh_indices(size):
+    """
+    Returns the zero based cells, vertices and edges of a quadrilateral mesh of
+    the sphere, with the cells ordered by latitude then longitude
+    """
+    nlat, nlon = size['ncells_lat'], size['ncells_lon']
+    j, i = np.meshgrid(np.arange(nlat), np.arange(nlon), indexing='ij')
+    cell = j * nlon + i
+
+    def vertex(row, col):
+        return row * nlon + col % nlon
+
+    # the corners of each cell, counterclockwise from the south-west
+    vertices_on_cell = np.stack([vertex(j, i), vertex(j, i + 1),
+                                 vertex(j + 1, i + 1), vertex(j + 1, i)], axis=-1)
+
+    # the cells around each vertex, -1 beyond the poles
+    row, col = np.meshgrid(np.arange(nlat + 1), np.arange(nlon), indexing='ij')
+    cells_on_vertex = list()
+    for drow, dcol in [(-1, -1), (-1, 0), (0, 0), (0, -1)]:
+        r = row + drow
+        c = (col + dcol) % nlon
+        cells_on_vertex.append(np.where((r >= 0) & (r < nlat), r * nlon + c, -1))
+    cells_on_vertex = np.stack(cells_on_vertex, axis=-1)
+
+    # the zonal edges between a cell and its eastern neighbor, then the
+    # meridional edges between a cell and its northern neighbor
+    east = np.stack([cell, j * nlon + (i + 1) % nlon], axis=-1).reshape((-1, 2))
+    north = np.stack([cell[:-1], cell[1:]], axis=-1).reshape((-1, 2))
+    cells_on_edge = np.concatenate([east, north])
+
+    return cell.ravel(), vertices_on_cell.reshape((-1, 4)), cells_on_vertex.reshape((-1, 4)), cells_on_edge
+
+
+def _string_array(strings, strlen=64):
+    return np.array([s.ljust(strlen) for s in strings], dtype=f'S{strlen}')
+
+
+def generate_mpas_files(path, size):
+    """
+    Generates an MPAS mesh, namelists, MOC region masks and a mapping file to a lat/lon
+    grid, along with one year of monthly MPAS-Ocean and MPAS-Seaice time series files per
+    year of the size
+    """
+    import xarray as xr
+
+    nlat, nlon, nlev = size['ncells_lat'], size['ncells_lon'], size['nvertlevels']
+    rng = np.random.default_rng(0)
+
+    lat_edges = np.linspace(-90., 90., nlat + 1)
+    lon_edges = np.linspace(0., 360., nlon + 1)
+    lat = 0.5 * (lat_edges[:-1] + lat_edges[1:])
+    lon = 0.5 * (lon_edges[:-1] + lon_edges[1:])
+    lat_cell = np.repeat(lat, nlon)
+    lon_cell = np.tile(lon, nlat)
+    dlon = np.deg2rad(360. / nlon)
+    area = EARTH_RADIUS ** 2 * dlon * np.diff(np.sin(np.deg2rad(lat_edges)))
+    area_cell = np.repeat(area, nlon)
+
+    _, vertices_on_cell, cells_on_vertex, cells_on_edge = _mesh_indices(size)
+    ncells = nlat * nlon
+    nvertices = (nlat + 1) * nlon
+    neast = ncells
+    nedges = len(cells_on_edge)
+
+    # zonal edges run north-south across a cell row, meridional edges east-west
+    # along the boundary between two cell rows
+    dv_edge = np.concatenate([
+        np.full(neast, EARTH_RADIUS * np.deg2rad(180. / nlat)),
+        EARTH_RADIUS * dlon * np.cos(np.deg2rad(np.repeat(lat_edges[1:-1], nlon)))])
+
+    ref_bottom_depth = np.cumsum(np.linspace(10., 200., nlev))
+    # shallower cells around the poles
+    max_level_cell = np.where(np.abs(lat_cell) > 80., nlev // 2, nlev).astype('int32')
+
+    kite_areas = np.where(cells_on_vertex >= 0, 0.25 * area_cell[cells_on_vertex], 0.)
+
+    mesh_path = Path(path, f'mpaso.rst.{MPAS_START_YEAR:04d}-01-01_00000.nc')
+    if not mesh_path.exists():
+        ds = xr.Dataset()
+        ds['xtime'] = ('Time', _string_array([f'{MPAS_START_YEAR:04d}-01-01_00:00:00']))
+        ds['latCell'] = ('nCells', np.deg2rad(lat_cell))
+        ds['lonCell'] = ('nCells', np.deg2rad(lon_cell))
+        ds['areaCell'] = ('nCells', area_cell)
+        ds['maxLevelCell'] = ('nCells', max_level_cell)
+        ds['refBottomDepth'] = ('nVertLevels', ref_bottom_depth)
+        ds['cellsOnEdge'] = (('nEdges', 'TWO'), (cells_on_edge + 1).astype('int32'))
+        ds['dvEdge'] = ('nEdges', dv_edge)
+        ds['verticesOnCell'] = (('nCells', 'maxEdges'), (vertices_on_cell + 1).astype('int32'))
+        ds['cellsOnVertex'] = (('nVertices', 'vertexDegree'), (cells_on_vertex + 1).astype('int32'))
+        ds['kiteAreasOnVertex'] = (('nVertices', 'vertexDegree'), kite_areas)
+        _write(ds, mesh_path)
+
+    for name in ['mpaso_in', 'mpassi_in']:
+        namelist_path = Path(path, name)
+        if not namelist_path.exists():
+            namelist_path.write_text("&ocean\n    config_density0 = 1026.0\n/\n")
+
+    # the Atlantic north of 34S, closed by the meridional edges along its southern boundary
+    regions_path = Path(path, 'synthetic_mocBasinsAndTransects_region_00000000.nc')
+    if not regions_path.exists():
+        in_atlantic = (lon_cell >= 280.) & (lat_cell > -34.)
+        row = int(np.searchsorted(lat_edges, -34.))
+        cols = np.nonzero(lon >= 280.)[0]
+        transect = neast + (row - 1) * nlon + cols
+        signs = np.zeros(nedges, dtype='int32')
+        signs[transect] = 1
+        ds = xr.Dataset()
+        ds['regionNames'] = ('nRegions', np.array(['Atlantic_MOC'], dtype=object))
+        ds['regionCellMasks'] = (('nCells', 'nRegions'), in_atlantic.astype('int32')[:, np.newaxis])
+        ds['transectEdgeGlobalIDs'] = (('nTransects', 'maxEdgesInTransect'),
+                                       (transect + 1).astype('int32')[np.newaxis, :])
+        ds['transectEdgeMaskSigns'] = (('nEdges', 'nTransects'), signs[:, np.newaxis])
+        _write(ds, regions_path)
+
+    # a one to one map of the cells to the lat/lon grid they are laid out on
+    map_path = Path(path, 'map_synthetic_to_latlon_aave.nc')
+    if not map_path.exists():
+        lat_corners = np.stack([np.repeat(lat_edges[:-1], nlon), np.repeat(lat_edges[:-1], nlon),
+                                np.repeat(lat_edges[1:], nlon), np.repeat(lat_edges[1:], nlon)], axis=-1)
+        lon_corners = np.stack([np.tile(lon_edges[:-1], nlat), np.tile(lon_edges[1:], nlat),
+                                np.tile(lon_edges[1:], nlat), np.tile(lon_edges[:-1], nlat)], axis=-1)
+        ds = xr.Dataset()
+        ds['S'] = ('n_s', np.ones(ncells))
+        ds['row'] = ('n_s', np.arange(1, ncells + 1, dtype='int32'))
+        ds['col'] = ('n_s', np.arange(1, ncells + 1, dtype='int32'))
+        ds['dst_grid_dims'] = ('dst_grid_rank', np.array([nlon, nlat], dtype='int32'))
+        ds['yc_b'] = ('n_b', lat_cell, {'units': 'degrees'})
+        ds['xc_b'] = ('n_b', lon_cell, {'units': 'degrees'})
+        ds['yv_b'] = (('n_b', 'nv_b'), lat_corners, {'units': 'degrees'})
+        ds['xv_b'] = (('n_b', 'nv_b'), lon_corners, {'units': 'degrees'})
+        ds['area_b'] = ('n_b', area_cell / EARTH_RADIUS ** 2)
+        ds['area_a'] = ('n_a', area_cell / EARTH_RADIUS ** 2)
+        _write(ds, map_path)
+
+    paths = dict(mpaso=list(), mpassi=list())
+    for year in range(MPAS_START_YEAR, MPAS_START_YEAR + size['years']):
+        for month in range(1, 13):
+            end_year, end_month = (year, month + 1) if month < 12 else (year + 1, 1)
+            xtime = dict(
+                xtime_startMonthly=('Time', _string_array([f'{year:04d}-{month:02d}-01_00:00:00'])),
+                xtime_endMonthly=('Time', _string_array([f'{end_year:04d}-{end_month:02d}-01_00:00:00'])))
+            date = f'{year:04d}-{month:02d}-01'
+
+            filepath = Path(path, f'mpaso.hist.am.timeSeriesStatsMonthly.{date}.nc')
+            paths['mpaso'].append(filepath)
+            if not filepath.exists():
+                ds = xr.Dataset(xtime)
+                ds['timeMonthly_avg_activeTracers_temperature'] = (
+                    ('Time', 'nCells', 'nVertLevels'), 20. * rng.random((1, ncells, nlev), dtype='float32'))
+                ds['timeMonthly_avg_layerThickness'] = (
+                    ('Time', 'nCells', 'nVertLevels'), np.tile(np.diff(ref_bottom_depth, prepend=0.),
+                                                               (1, ncells, 1)).astype('float32'))
+                for name in ['timeMonthly_avg_normalVelocity', 'timeMonthly_avg_normalGMBolusVelocity']:
+                    ds[name] = (('Time', 'nEdges', 'nVertLevels'),
+                                0.1 * rng.standard_normal((1, nedges, nlev), dtype='float32'))
+                for name in ['timeMonthly_avg_vertVelocityTop', 'timeMonthly_avg_vertGMBolusVelocityTop']:
+                    ds[name] = (('Time', 'nCells', 'nVertLevelsP1'),
+                                1e-5 * rng.standard_normal((1, ncells, nlev + 1), dtype='float32'))
+                _write(ds, filepath)
+
+            filepath = Path(path, f'mpassi.hist.am.timeSeriesStatsMonthly.{date}.nc')
+            paths['mpassi'].append(filepath)
+            if not filepath.exists():
+                ds = xr.Dataset(xtime)
+                ds['timeMonthly_avg_iceAreaCell'] = (
+                    ('Time', 'nCells'), np.where(np.abs(lat_cell) > 60., 1., 0.)[np.newaxis, :].astype('float32'))
+                ds['timeMonthly_avg_uVelocityGeo'] = (
+                    ('Time', 'nVertices'), 0.1 * rng.standard_normal((1, nvertices), dtype='float32'))
+                _write(ds, filepath)
+
+    return paths, map_path
+
+
+def generate_inputs(case, size_name, work_path):
+    """
+    Generates the inputs of a case, and returns the input directory, the input
+    files the case reads, and the mapping file for the MPAS cases
+    """
+    size = SIZES[size_name]
+    info = CASES[case]
+    if info['realm'] in ['mpaso', 'mpassi']:
+        input_path = Path(work_path, 'inputs', size_name, 'mpas')
+        input_path.mkdir(parents=True, exist_ok=True)
+        paths, map_path = generate_mpas_files(input_path, size)
+        return input_path, paths[info['realm']], map_path
+
+    # the atm and lnd cases each get their own directory, so the other raw
+    # variables aren't in the listing of the input directory
+    input_path = Path(work_path, 'inputs', size_name, f"{info['realm']}_{info['freq']}")
+    input_path.mkdir(parents=True, exist_ok=True)
+    paths = list()
+    for raw_variable in info['raw']:
+        paths.extend(generate_atm_files(raw_variable, input_path, size,
+                                        freq=info['freq'], realm=info['realm']))
+    return input_path, paths, None
+
+
+def count_steps(case, size_name):
+    info = CASES[case]
+    steps_per_year = 365 if info['freq'] == 'day' else 12
+    return steps_per_year * SIZES[size_name]['years']
+
+
+def get_commit():
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent)
+    except OSError:
+        return None
+    return output.stdout.strip() or None
+
+
+def run_case(case, size_name, nproc, work_path, tables_path, metadata_path, simple=False, timeout=None):
+    """
+    Converts the inputs of a case with e3sm_to_cmip, and returns the result record of the run
+    """
+    info = CASES[case]
+    input_path, input_files, map_path = generate_inputs(case, size_name, work_path)
+
+    run_name = f'{case}_{size_name}_{nproc}'
+    output_path = Path(work_path, 'output', run_name)
+    if output_path.exists():
+        rmtree(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    report_path = Path(work_path, 'reports', f'{run_name}.json')
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    if report_path.exists():
+        report_path.unlink()
+
+    cmd = [sys.executable, '-m', 'e3sm_to_cmip', '-v', info['var'], '-i', str(input_path),
+           '-o', str(output_path), '--realm', info['realm'], '-f', info['freq'],
+           '--timing-report', str(report_path), '--logdir', str(Path(work_path, 'logs', run_name))]
+    if simple:
+        cmd.append('--simple')
+    else:
+        cmd.extend(['-t', str(tables_path), '-u', str(metadata_path)])
+    if map_path is not None:
+        # the MPAS handlers run one variable per worker, so the workers are
+        # given to dask instead
+        cmd.extend(['--map', str(map_path), '--serial', '--dask-threads', str(nproc)])
+    elif nproc > 1:
+        # one segment per yearly input file, so the workers share the variable
+        cmd.extend(['-n', str(nproc), '--segment-years', '1'])
+    else:
+        cmd.append('--serial')
+
+    print(f'Running {run_name}: {" ".join(cmd)}')
+    start = time.perf_counter()
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=work_path, timeout=timeout)
+        returncode, output = proc.returncode, proc.stdout + proc.stderr
+    except subprocess.TimeoutExpired:
+        returncode, output = None, 'timed out'
+    wall = time.perf_counter() - start
+
+    records = list()
+    if report_path.exists():
+        with open(report_path, 'r') as instream:
+            records = json.load(instream)
+    outputs = [path for path in output_path.rglob('*') if path.is_file() and path.suffix == '.nc']
+
+    stages = dict()
+    for record in records:
+        stages[record['stage']] = stages.get(record['stage'], 0.) + record['wall']
+
+    input_bytes = sum(os.path.getsize(path) for path in input_files)
+    steps = count_steps(case, size_name)
+    success = returncode == 0 and len(outputs) > 0
+    if not success:
+        print(f'Error running {run_name}:\n{output[-2000:]}')
+
+    return {
+        'case': case,
+        'size': size_name,
+        'nproc': nproc,
+        'simple': simple,
+        'success': success,
+        'wall': wall,
+        'input_bytes': input_bytes,
+        'output_bytes': sum(os.path.getsize(path) for path in outputs),
+        'steps': steps,
+        'gb_per_s': input_bytes / wall / 1e9,
+        'steps_per_s': steps / wall,
+        'peak_rss': max([record['process_peak_rss'] for record in records], default=None),
+        'stages': stages,
+    }
+
+
+def compare(results, baseline_path):
+    """
+    Prints the speedup of each run over the latest matching run of the baseline results
+    """
+    baseline = dict()
+    with open(baseline_path, 'r') as instream:
+        for line in instream:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result['success']:
+                baseline[(result['case'], result['size'], result['nproc'], result['simple'])] = result
+
+    print(f"{'case':<12} {'size':<7} {'nproc':>5} {'wall':>9} {'baseline':>9} {'speedup':>8}")
+    for result in results:
+        base = baseline.get((result['case'], result['size'], result['nproc'], result['simple']))
+        if base is None or not result['success']:
+            continue
+        print(f"{result['case']:<12} {result['size']:<7} {result['nproc']:>5} {result['wall']:>9.2f} "
+              f"{base['wall']:>9.2f} {base['wall'] / result['wall']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=DESC)
+    parser.add_argument('-w', '--work-path', default='benchmark',
+                        help='directory for the generated inputs and the outputs of the runs, default = ./benchmark')
+    parser.add_argument('-t', '--tables-path',
+                        help='path to the CMIP6 tables, required unless --simple is set, and for the MPAS cases')
+    parser.add_argument('-r', '--results', default='benchmark_results.jsonl',
+                        help='file to append the results to, default = benchmark_results.jsonl')
+    parser.add_argument('-c', '--cases', nargs='+', default=list(CASES.keys()), choices=list(CASES.keys()),
+                        help='the cases to run, default = all')
+    parser.add_argument('-s', '--sizes', nargs='+', default=['small'], choices=list(SIZES.keys()),
+                        help='the input sizes to run, default = small')
+    parser.add_argument('-n', '--num-proc', nargs='+', type=int, default=[1, 4],
+                        help='the worker counts to run, default = 1 4')
+    parser.add_argument('--simple', action='store_true',
+                        help='run the atm and lnd cases in --simple mode, which does not need CMOR or the tables. '
+                             'The MPAS cases are skipped unless --tables-path is given')
+    parser.add_argument('--generate-only', action='store_true',
+                        help='only generate the inputs')
+    parser.add_argument('--baseline',
+                        help='a results file from another commit to compare the wall times with')
+    parser.add_argument('--timeout', type=int, default=None,
+                        help='seconds to wait for each run before giving up')
+    args = parser.parse_args()
+
+    work_path = Path(args.work_path).absolute()
+    work_path.mkdir(parents=True, exist_ok=True)
+    tables_path = Path(args.tables_path).absolute() if args.tables_path else None
+    metadata_path = Path(Path(__file__).parent.parent, 'e3sm_to_cmip', 'resources', 'default_metadata.json').absolute()
+
+    if tables_path is None and not args.simple:
+        print('Error: --tables-path is required unless --simple is set')
+        return 1
+
+    if args.generate_only:
+        for size_name in args.sizes:
+            for case in args.cases:
+                print(f'Generating the {size_name} inputs of {case}')
+                generate_inputs(case, size_name, work_path)
+        return 0
+
+    commit = get_commit()
+    header = {
+        'commit': commit,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+    }
+
+    results = list()
+    for size_name in args.sizes:
+        for case in args.cases:
+            is_mpas = CASES[case]['realm'] in ['mpaso', 'mpassi']
+            if is_mpas and tables_path is None:
+                print(f'Skipping {case}, the MPAS handlers need --tables-path')
+                continue
+            for nproc in args.num_proc:
+                result = run_case(case, size_name, nproc, work_path, tables_path, metadata_path,
+                                  simple=args.simple and not is_mpas, timeout=args.timeout)
+                result = {**header, **result}
+                results.append(result)
+                print(f"{case} {size_name} nproc={nproc}: {result['wall']:.2f}s, "
+                      f"{result['gb_per_s']:.3f} GB/s, {result['steps_per_s']:.1f} steps/s")
+                with open(args.results, 'a') as outstream:
+                    outstream.write(json.dumps(result) + '\n')
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+    return 0 if all(result['success'] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from e3sm_to_cmip.default import compile_unit_conversion
+
+
+def test_convert_floating_window_in_place():
+    values = np.array([[1., np.nan], [4., 8.]], dtype=np.float32)
+    converted = compile_unit_conversion('g-to-kg')(values)
+
+    assert converted is values
+    assert converted.dtype == np.float32
+    np.testing.assert_array_equal(
+        converted, np.array([[0.001, 1.e20], [0.004, 0.008]], dtype=np.float32))
+
+
+def test_convert_matches_conversion_formula():
+    values = np.random.default_rng(0).normal(size=(3, 4, 5))
+    values[1, 2, 3] = np.nan
+    expected = values * -1
+    expected[np.isnan(expected)] = 1.e20
+
+    converted = compile_unit_conversion('-1')(values.copy())
+    np.testing.assert_array_equal(converted, expected)
+
+
+def test_convert_integer_window_into_float64_copy():
+    values = np.array([[1, 2], [3, 4]], dtype=np.int32)
+    converted = compile_unit_conversion('1-to-%')(values)
+
+    assert converted is not values
+    assert converted.dtype == np.float64
+    np.testing.assert_array_equal(converted, [[100., 200.], [300., 400.]])
+    np.testing.assert_array_equal(values, [[1, 2], [3, 4]])
+
+
+def test_convert_read_only_window_into_copy():
+    values = np.array([1., np.nan])
+    values.flags.writeable = False
+    converted = compile_unit_conversion()(values)
+
+    assert converted is not values
+    np.testing.assert_array_equal(converted, [1., 1.e20])
+
+
+def test_unknown_conversion():
+    with pytest.raises(ValueError):
+        compile_unit_conversion('furlongs-to-m')
@@ -0,0 +1,131 @@
+import logging
+import sys
+import tracemalloc
+import types
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from e3sm_to_cmip import resources
+from e3sm_to_cmip.default import default_handler
+from e3sm_to_cmip.lib import handle_variables
+from e3sm_to_cmip.util import end_cmor_session
+
+TABLES_PATH = resources.__path__[0]
+
+
+@pytest.fixture
+def fake_cmor(monkeypatch):
+    """
+    A stand in for the cmor module that records the time steps passed to cmor.write
+    """
+    module = types.ModuleType('cmor')
+    module.written = []
+
+    def write(varid, data, time_vals=None, time_bnds=None):
+        module.written.append(np.size(time_vals))
+
+    for name in ['setup', 'dataset_json', 'load_table', 'set_table', 'axis',
+                 'variable', 'zfactor', 'set_deflate', 'close']:
+        setattr(module, name, lambda *args, **kwargs: 0)
+    module.write = write
+    module.CMOR_REPLACE = 0
+    module.CMOR_NORMAL = 0
+    monkeypatch.setitem(sys.modules, 'cmor', module)
+    yield module
+    end_cmor_session()
+
+
+def write_input(path, variable, num_steps, num_lat, num_lon, plev=None):
+    """
+    Writes an E3SM-like monthly file of a variable with num_steps time steps,
+    on the given pressure levels if plev is set
+    """
+    lat_edges = np.linspace(-90, 90, num_lat + 1)
+    lon_edges = np.linspace(0, 360, num_lon + 1)
+    time_bnds = np.stack([np.arange(num_steps), np.arange(1, num_steps + 1)], axis=1) * 30.
+    dims = ('time', 'lat', 'lon') if plev is None else ('time', 'plev', 'lat', 'lon')
+    shape = (num_steps, num_lat, num_lon) if plev is None else (num_steps, len(plev), num_lat, num_lon)
+    values = np.random.default_rng(0).normal(288., 10., size=shape).astype(np.float32)
+
+    ds = xr.Dataset(
+        {variable: (dims, values, {'units': 'K'}),
+         'lat_bnds': (('lat', 'nbnd'), np.stack([lat_edges[:-1], lat_edges[1:]], axis=1)),
+         'lon_bnds': (('lon', 'nbnd'), np.stack([lon_edges[:-1], lon_edges[1:]], axis=1)),
+         'time_bnds': (('time', 'nbnd'), time_bnds)},
+        coords={'time': ('time', time_bnds.mean(axis=1), {'units': 'days since 1850-01-01'}),
+                'lat': ('lat', (lat_edges[:-1] + lat_edges[1:]) / 2, {'units': 'degrees_north'}),
+                'lon': ('lon', (lon_edges[:-1] + lon_edges[1:]) / 2, {'units': 'degrees_east'})})
+    if plev is not None:
+        ds.coords['plev'] = ('plev', plev, {'units': 'Pa'})
+    ds.to_netcdf(path)
+
+
+def test_default_handler_windows_stay_in_memory_budget(tmp_path, fake_cmor):
+    num_steps, num_lat, num_lon = 24, 256, 512
+    step_bytes = num_lat * num_lon * 4
+    max_memory = 12 * step_bytes
+
+    infile = tmp_path / 'TREFHT_185001_185112.nc'
+    write_input(infile, 'TREFHT', num_steps, num_lat, num_lon)
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    tracemalloc.start()
+    try:
+        result = default_handler(
+            infiles={'TREFHT': [str(infile)]},
+            tables=TABLES_PATH,
+            user_input_path=str(tmp_path / 'metadata.json'),
+            raw_variables=['TREFHT'],
+            table='CMIP6_Amon.json',
+            name='tas',
+            units='K',
+            logdir=str(tmp_path / 'cmor_logs'),
+            max_memory=max_memory)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert result == 'tas'
+    assert sum(fake_cmor.written) == num_steps
+    # the file is read in several windows, and at most one is held at a time
+    assert max_memory < num_steps * step_bytes
+    assert peak < max_memory
+
+
+def test_handle_variables_releases_each_window(tmp_path, fake_cmor):
+    # variables with levels are read eagerly as each window is loaded
+    plev = np.array([100000., 85000., 50000., 25000.])
+    num_steps, num_lat, num_lon = 24, 128, 256
+    step_bytes = len(plev) * num_lat * num_lon * 4
+    max_memory = 12 * step_bytes
+
+    infile = tmp_path / 'T_185001_185112.nc'
+    write_input(infile, 'T', num_steps, num_lat, num_lon, plev=plev)
+
+    def write_data(varid, data, timeval=None, timebnds=None, index=None, **kwargs):
+        fake_cmor.write(varid, data['T'][index, :], time_vals=timeval, time_bnds=timebnds)
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    tracemalloc.start()
+    try:
+        result = handle_variables(
+            infiles={'T': [str(infile)]},
+            raw_variables=['T'],
+            write_data=write_data,
+            outvar_name='ta',
+            outvar_units='K',
+            table='CMIP6_Amon.json',
+            tables=TABLES_PATH,
+            metadata_path=str(tmp_path / 'metadata.json'),
+            levels={'name': 'plev19', 'units': 'Pa', 'e3sm_axis_name': 'plev'},
+            logdir=str(tmp_path / 'cmor_logs'),
+            max_memory=max_memory)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert result == 'ta'
+    assert sum(fake_cmor.written) == num_steps
+    assert peak < max_memory
@@ -0,0 +1,266 @@
+import numpy as np
+import xarray as xr
+
+from e3sm_to_cmip import mpas
+
+
+def make_mesh(verticesOnCell, nVertices, vertexDegree=3, seed=0):
+    """
+    Builds the connectivity and kite areas of a small MPAS-like mesh from the
+    1-based vertices of each cell, padded with 0. The area of each cell is the sum
+    of its kites, so a constant field stays constant on the cells
+    """
+    rng = np.random.default_rng(seed)
+    verticesOnCell = np.asarray(verticesOnCell)
+    nCells, maxEdges = verticesOnCell.shape
+
+    cellsOnVertex = np.zeros((nVertices, vertexDegree), dtype=int)
+    kiteAreasOnVertex = np.zeros((nVertices, vertexDegree))
+    for iCell in range(nCells):
+        for vertex in verticesOnCell[iCell]:
+            if vertex == 0:
+                continue
+            slot = np.count_nonzero(cellsOnVertex[vertex - 1])
+            cellsOnVertex[vertex - 1, slot] = iCell + 1
+            kiteAreasOnVertex[vertex - 1, slot] = rng.uniform(1., 2.)
+
+    areaCell = np.zeros(nCells)
+    for iVertex in range(nVertices):
+        for slot in range(vertexDegree):
+            if cellsOnVertex[iVertex, slot] > 0:
+                areaCell[cellsOnVertex[iVertex, slot] - 1] += kiteAreasOnVertex[iVertex, slot]
+
+    return xr.Dataset({
+        'verticesOnCell': (('nCells', 'maxEdges'), verticesOnCell),
+        'cellsOnVertex': (('nVertices', 'vertexDegree'), cellsOnVertex),
+        'kiteAreasOnVertex': (('nVertices', 'vertexDegree'), kiteAreasOnVertex),
+        'areaCell': (('nCells',), areaCell)})
+
+
+# cell 0 and cell 2 both use the first vertex, which is 1 in verticesOnCell
+MESH_VERTICES = [[1, 2, 3, 0],
+                 [2, 3, 4, 5],
+                 [1, 4, 5, 6]]
+
+
+def interp_vertex_to_cell_loop(values, dsMesh):
+    """
+    The loop over the edges and vertex degree of the implementation the sparse
+    operator replaced, with the padding of verticesOnCell dropped as vertex -1
+    rather than by also dropping vertex 0
+    """
+    nCells = dsMesh.sizes['nCells']
+    verticesOnCell = dsMesh.verticesOnCell.values - 1
+    cellsOnVertex = dsMesh.cellsOnVertex.values - 1
+    kiteAreas = dsMesh.kiteAreasOnVertex.values
+
+    weights = np.zeros((nCells, dsMesh.sizes['maxEdges']))
+    for iVertex in range(dsMesh.sizes['maxEdges']):
+        vertices = verticesOnCell[:, iVertex]
+        for iCell in range(dsMesh.sizes['vertexDegree']):
+            mask = np.logical_and(vertices >= 0, np.equal(
+                cellsOnVertex[vertices, iCell], np.arange(nCells)))
+            weights[:, iVertex] += mask * kiteAreas[vertices, iCell]
+    weights /= dsMesh.areaCell.values[:, np.newaxis]
+
+    return (values[:, verticesOnCell] * weights).sum(axis=-1)
+
+
+def test_vertex_to_cell_operator_uses_the_first_vertex():
+    dsMesh = make_mesh(MESH_VERTICES, nVertices=6)
+    operator = mpas.get_vertex_to_cell_operator(dsMesh)
+
+    assert operator[0, 0] > 0
+    assert operator[2, 0] > 0
+    # a constant field stays constant on every cell, including those of the first vertex
+    np.testing.assert_allclose(operator.dot(np.ones(6)), np.ones(3))
+
+
+def test_interp_vertex_to_cell_matches_loop():
+    dsMesh = make_mesh(MESH_VERTICES, nVertices=6)
+    values = np.random.default_rng(1).normal(size=(5, 6)).astype(np.float32)
+    varOnVertices = xr.DataArray(values, dims=('Time', 'nVertices'))
+
+    varOnCells = mpas.interp_vertex_to_cell(varOnVertices, dsMesh, timeChunkSize=2)
+
+    assert varOnCells.dims == ('Time', 'nCells')
+    assert varOnCells.dtype == np.float32
+    np.testing.assert_allclose(
+        varOnCells.values, interp_vertex_to_cell_loop(values, dsMesh), rtol=1e-6)
+
+
+def write_mapping_file(path, nCells, lonEdges, latEdges, seed=0):
+    """
+    Writes a SCRIP-style mapping file from nCells source cells to the lat/lon
+    grid with the given cell edges in degrees, with random weights
+    """
+    rng = np.random.default_rng(seed)
+    nLat, nLon = len(latEdges) - 1, len(lonEdges) - 1
+    nB = nLat*nLon
+
+    # each destination cell overlaps two source cells
+    row = np.repeat(np.arange(nB), 2)
+    col = rng.integers(0, nCells, size=2*nB)
+    S = rng.uniform(0.1, 0.5, size=2*nB)
+
+    lonCenter = 0.5*(lonEdges[:-1] + lonEdges[1:])
+    latCenter = 0.5*(latEdges[:-1] + latEdges[1:])
+    lonCorner = np.stack([lonEdges[:-1], lonEdges[1:], lonEdges[1:], lonEdges[:-1]], axis=-1)
+    latCorner = np.stack([latEdges[:-1], latEdges[:-1], latEdges[1:], latEdges[1:]], axis=-1)
+
+    ds = xr.Dataset({
+        'S': (('n_s',), S),
+        'row': (('n_s',), (row + 1).astype(np.int32)),
+        'col': (('n_s',), (col + 1).astype(np.int32)),
+        'dst_grid_dims': (('dst_grid_rank',), np.array([nLon, nLat], dtype=np.int32)),
+        'xc_b': (('n_b',), np.tile(np.mod(lonCenter, 360.), nLat), {'units': 'degrees'}),
+        'yc_b': (('n_b',), np.repeat(latCenter, nLon), {'units': 'degrees'}),
+        'xv_b': (('n_b', 'nv_b'), np.tile(np.mod(lonCorner, 360.), (nLat, 1)), {'units': 'degrees'}),
+        'yv_b': (('n_b', 'nv_b'), np.repeat(latCorner, nLon, axis=0), {'units': 'degrees'}),
+        'area_b': (('n_b',), np.ones(nB)),
+        'frac_a': (('n_a',), np.ones(nCells))})
+    ds.to_netcdf(path)
+    return row, col, S
+
+
+def remap_loop(values, row, col, S, nB):
+    """
+    Applies the weights of a mapping file one entry at a time, with missing
+    source values left out, as ncremap did before remap used the sparse matrix
+    """
+    remapped = np.zeros(values.shape[:-1] + (nB,))
+    for iRow, iCol, weight in zip(row, col, S):
+        source = values[..., iCol]
+        remapped[..., iRow] += np.where(np.isfinite(source), weight*source, 0.)
+    return remapped
+
+
+def test_remap_matches_loop(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    nCells, nTime = 7, 5
+    lonEdges = np.array([-60., 60., 180., 300.])
+    latEdges = np.array([-90., 0., 90.])
+    mappingFileName = str(tmp_path / 'map.nc')
+    row, col, S = write_mapping_file(mappingFileName, nCells, lonEdges, latEdges)
+
+    rng = np.random.default_rng(2)
+    values = rng.normal(size=(nTime, nCells)).astype(np.float32)
+    values[1, 3] = np.nan
+    cellMask = np.ones(nCells)
+    cellMask[0] = 0.
+    ds = xr.Dataset({'foo': (('time', 'nCells'), values),
+                     'cellMask': (('nCells',), cellMask)})
+
+    dsOut = mpas.remap(ds, mappingFileName, timeChunkSize=2)
+
+    mask = remap_loop(cellMask, row, col, S, 6)
+    expected = remap_loop(values, row, col, S, 6)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.where(mask > 0.05, expected/mask, np.nan).reshape((nTime, 2, 3))
+    assert dsOut['foo'].dims == ('time', 'lat', 'lon')
+    np.testing.assert_allclose(dsOut['foo'].values, expected, rtol=1e-5)
+
+    # the cached weights give the same result
+    mpas._MAPPING_WEIGHTS.clear()
+    np.testing.assert_allclose(
+        mpas.remap(ds, mappingFileName)['foo'].values, expected, rtol=1e-5)
+
+
+def test_mapping_lon_bnds_across_the_seam(tmp_path):
+    mappingFileName = str(tmp_path / 'map.nc')
+    write_mapping_file(mappingFileName, 4, np.array([-60., 60., 180., 300.]),
+                       np.array([-90., 0., 90.]))
+
+    weights = mpas.get_mapping_weights(mappingFileName, cacheDir=str(tmp_path))
+
+    np.testing.assert_allclose(weights['lon'], [0., 120., 240.])
+    np.testing.assert_allclose(weights['lon_bnds'], [[-60., 60.], [60., 180.], [180., 300.]])
+    np.testing.assert_allclose(weights['lat_bnds'], [[-90., 0.], [0., 90.]])
+
+
+def compute_moc_loop(normalVelocity, vertVelocityTop, layerThicknessEdge,
+                     dsMesh, dsMasks):
+    """
+    The MOC of the implementation the binned kernel replaced, which masks the
+    cells of each region and latitude bin in turn
+    """
+    dvEdge = dsMesh.dvEdge
+    areaCell = dsMesh.areaCell
+    latCell = np.rad2deg(dsMesh.latCell)
+    nTime = normalVelocity.sizes['Time']
+    nVertLevels = dsMesh.sizes['nVertLevels']
+    regionNames = ['Global'] + [str(name.values) for name in dsMasks.regionNames]
+    lat_bnds = np.stack([np.arange(-90., 90.), np.arange(-89., 91.)], axis=1)
+
+    transport = {'Global': xr.DataArray(np.zeros((nTime, nVertLevels)),
+                                        dims=('Time', 'nVertLevels'))}
+    cellMasks = {'Global': xr.DataArray(np.ones(dsMesh.sizes['nCells']), dims=('nCells',))}
+    for regionIndex, regionName in enumerate(regionNames[1:]):
+        dsMask = dsMasks.isel(nTransects=regionIndex, nRegions=regionIndex)
+        edgeIndices = dsMask.transectEdgeGlobalIDs
+        edgeIndices = edgeIndices[edgeIndices > 0] - 1
+        edgeSigns = dsMask.transectEdgeMaskSigns[edgeIndices]
+        v = normalVelocity[:, edgeIndices, :]
+        h = layerThicknessEdge[:, edgeIndices, :]
+        transport[regionName] = (v*h*dvEdge[edgeIndices]*edgeSigns).sum(
+            dim='maxEdgesInTransect')
+        cellMasks[regionName] = dsMask.regionCellMasks
+
+    mocs = []
+    for regionName in regionNames:
+        mocSlice = np.zeros((nTime, nVertLevels + 1))
+        mocSlice[:, 1:] = transport[regionName].cumsum(dim='nVertLevels').values
+        mocSlices = [xr.DataArray(mocSlice, dims=('Time', 'nVertLevelsP1'))]
+        binCounts = []
+        for iLat in range(lat_bnds.shape[0]):
+            mask = np.logical_and(np.logical_and(
+                cellMasks[regionName] == 1, latCell >= lat_bnds[iLat, 0]),
+                latCell < lat_bnds[iLat, 1])
+            binCounts.append(np.count_nonzero(mask))
+            mocSlices.append(mocSlices[iLat] + (vertVelocityTop[:, mask, :] *
+                                                areaCell[mask]).sum(dim='nCells'))
+        moc = xr.concat(mocSlices, dim='lat').transpose('Time', 'nVertLevelsP1', 'lat')
+        moc = 0.25*(moc[:, 0:-1, 0:-1] + moc[:, 0:-1, 1:] +
+                    moc[:, 1:, 0:-1] + moc[:, 1:, 1:])
+        moc = moc.rename({'nVertLevelsP1': 'depth'})
+        mocs.append(moc.where(xr.DataArray(binCounts, dims=('lat',)) > 0))
+
+    return xr.concat(mocs, dim='basin').transpose('Time', 'basin', 'depth', 'lat')
+
+
+def test_compute_moc_matches_loop():
+    rng = np.random.default_rng(3)
+    nTime, nCells, nEdges, nVertLevels = 5, 60, 40, 4
+
+    dsMesh = xr.Dataset({
+        'dvEdge': (('nEdges',), rng.uniform(1., 2., nEdges)),
+        'areaCell': (('nCells',), rng.uniform(1., 2., nCells)),
+        'latCell': (('nCells',), np.deg2rad(rng.uniform(-80., 80., nCells))),
+        'refBottomDepth': (('nVertLevels',), np.arange(1., nVertLevels + 1)*10.)})
+
+    transectEdgeGlobalIDs = np.zeros((2, 6), dtype=int)
+    transectEdgeGlobalIDs[0, :4] = rng.choice(nEdges, 4, replace=False) + 1
+    transectEdgeGlobalIDs[1, :6] = rng.choice(nEdges, 6, replace=False) + 1
+    dsMasks = xr.Dataset({
+        'regionNames': (('nRegions',), np.array(['Atlantic', 'IndoPacific'])),
+        'transectEdgeGlobalIDs': (('nTransects', 'maxEdgesInTransect'), transectEdgeGlobalIDs),
+        'transectEdgeMaskSigns': (('nTransects', 'nEdges'), rng.choice([-1, 1], (2, nEdges))),
+        'regionCellMasks': (('nCells', 'nRegions'), rng.integers(0, 2, (nCells, 2)))})
+
+    normalVelocity = xr.DataArray(rng.normal(size=(nTime, nEdges, nVertLevels)),
+                                  dims=('Time', 'nEdges', 'nVertLevels'))
+    layerThicknessEdge = xr.DataArray(rng.uniform(5., 10., (nTime, nEdges, nVertLevels)),
+                                      dims=('Time', 'nEdges', 'nVertLevels'))
+    vertVelocityTop = xr.DataArray(rng.normal(size=(nTime, nCells, nVertLevels + 1)),
+                                   dims=('Time', 'nCells', 'nVertLevelsP1'))
+
+    mocs, coords = mpas._compute_moc_time_series(
+        normalVelocity, vertVelocityTop, layerThicknessEdge, dsMesh, dsMasks,
+        showProgress=False, timeChunkSize=2)
+    expected = compute_moc_loop(normalVelocity, vertVelocityTop, layerThicknessEdge,
+                                dsMesh, dsMasks)
+
+    assert mocs.dims == ('Time', 'basin', 'depth', 'lat')
+    assert list(coords['regionNames'].values) == ['Global', 'Atlantic', 'IndoPacific']
+    assert np.isfinite(mocs.values).any() and np.isnan(mocs.values).any()
+    np.testing.assert_allclose(mocs.values, expected.values, rtol=1e-10, atol=1e-10)